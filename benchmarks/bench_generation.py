@@ -0,0 +1,602 @@
+"""
+Benchmark the generation backends: prefill and decode throughput, time to first token
+(TTFT), peak memory and end-to-end simulate_conversation rounds per second.
+
+By default a tiny randomly initialised model is built locally (no downloads), so the
+numbers track the overhead of the wrappers rather than model quality. Pass --model_path
+to benchmark a real model instead. If torch/transformers are not installed, the
+deterministic stub backend is used.
+
+Results are written as JSON (default: benchmarks/results/<timestamp>-<commit>.json) so
+that runs can be compared across commits with --baseline. With --model_name and
+--record, the measured weights footprint and decode speed are also written to the model
+entry in configs/models.toml.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+# run from a checkout without installing the package
+ROOT_DIR = Path(__file__).parents[1]
+sys.path.insert(0, str(ROOT_DIR / "src"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from interact_llm.data_models.chat import ChatHistory, ChatMessage  # noqa: E402
+from interact_llm.data_models.prompt import SystemPrompt  # noqa: E402
+
+MODELS_CONFIG_PATH = ROOT_DIR / "configs" / "models.toml"
+RESULTS_DIR = Path(__file__).parent / "results"
+TINY_MODEL_DIR = Path(tempfile.gettempdir()) / "interact_llm_tiny_model"
+
+TUTOR_SYSTEM_PROMPT = SystemPrompt(
+    id="bench",
+    content=(
+        "Eres un tutor de español. El estudiante está aprendiendo español a nivel A1. "
+        "Responde solo en español."
+    ),
+)
+
+# lower-is-better metrics (everything else is higher-is-better) for the baseline
+# comparison
+LOWER_IS_BETTER = {
+    "ttft_s",
+    "prefill_s",
+    "decode_s",
+    "peak_rss_mb",
+    "peak_cuda_mb",
+    "weights_mb",
+}
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--backend",
+        help=(
+            "hf, gemma, mlx or stub (default: hf if torch/transformers are installed, "
+            "otherwise stub)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--model_path",
+        help=(
+            "local path or HF id of the model (default: a tiny random model built "
+            "locally, hf backend only)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--model_name",
+        help=(
+            "benchmark the hf model of this entry in configs/models.toml (instead of "
+            "--model_path)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--quantization",
+        help=(
+            "CPU weight quantization of hf models: int8 or int4 (see "
+            "interact_llm/llm/quantization.py)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--record",
+        help=(
+            "write the measured weights footprint and decode speed to the "
+            "--model_name entry in configs/models.toml"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prompt_tokens",
+        help="approximate number of prompt tokens",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--new_tokens",
+        help="number of tokens to generate per call",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="number of timed repeats per metric (the median is reported)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--n_rounds",
+        help="number of rounds in the simulate_conversation benchmark",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--out", help="path of the JSON results file", type=Path, default=None
+    )
+    parser.add_argument(
+        "--baseline",
+        help="JSON results file of an earlier run to compare against",
+        type=Path,
+        default=None,
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+def default_backend() -> str:
+    try:
+        import torch  # noqa: F401
+        import transformers  # noqa: F401
+    except ImportError:
+        return "stub"
+    return "hf"
+
+
+def load_backend(
+    backend: str, model_path: Optional[str] = None, quantization: Optional[str] = None
+):
+    """
+    Load a backend on the benchmark model (the tiny local model if no model_path is
+    given)
+    """
+    if quantization is not None and backend != "hf":
+        raise ValueError("--quantization is only supported for the hf backend")
+
+    if backend == "stub":
+        from stub_backend import ChatStub
+
+        return ChatStub()
+
+    if model_path is None:
+        if backend != "hf":
+            raise ValueError(f"--model_path is required for the {backend} backend")
+        from tiny_model import build_tiny_model
+
+        model_path = str(build_tiny_model(TINY_MODEL_DIR))
+
+    if backend == "hf":
+        from interact_llm.llm.hf_wrapper import ChatHF
+
+        model = ChatHF(model_id=model_path, quantization=quantization)
+    elif backend == "gemma":
+        from interact_llm.llm.hf_gemma import ChatHFGemma
+
+        model = ChatHFGemma(model_id=model_path)
+    elif backend == "mlx":
+        from interact_llm.llm.mlx_wrapper import ChatMLX
+
+        model = ChatMLX(model_id=model_path)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+
+    model.load()
+
+    return model
+
+
+def fixed_length_params(backend: str, n_tokens: int) -> Optional[dict]:
+    """
+    Greedy sampling params that make every call generate n_tokens tokens where the
+    backend allows it (EOS is suppressed on HF, MLX may stop early, the stub always
+    returns n_tokens words)
+    """
+    if backend in ("hf", "gemma"):
+        return {"top_k": 1, "min_new_tokens": n_tokens}
+    if backend == "mlx":
+        return {"temp": 0.0}
+    return None
+
+
+def count_tokens(model, text: str) -> int:
+    return len(model.tokenizer.encode(text, add_special_tokens=False))
+
+
+def build_prompt(model, n_tokens: int) -> list[ChatMessage]:
+    """
+    A tutor chat (system prompt and one user turn) of approximately n_tokens tokens
+    after templating
+    """
+    filler = "Hola, ¿cómo estás? Me llamo Ana y vivo en Madrid con mi familia. "
+    content = TUTOR_SYSTEM_PROMPT.content
+    while True:
+        messages = [
+            ChatMessage(role="system", content=content),
+            ChatMessage(role="user", content="Hola"),
+        ]
+        n_prompt = len(
+            model.tokenizer.apply_chat_template(
+                [message.model_dump() for message in messages],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+        )
+        if n_prompt >= n_tokens:
+            return messages
+        content += " " + filler
+
+
+def time_generate(
+    model, backend: str, messages: list[ChatMessage], max_new_tokens: int
+) -> tuple[float, int]:
+    """
+    Time a generate call on a fresh chat history (so no KV state is reused between
+    calls)
+
+    Returns:
+        seconds: Wall time of the call.
+        n_generated: Number of generated tokens (exact for hf/gemma, re-tokenized from
+            the response otherwise).
+    """
+    chat = ChatHistory(messages=list(messages))
+    start = time.perf_counter()
+    response = model.generate(
+        chat,
+        max_new_tokens=max_new_tokens,
+        sampling_params=fixed_length_params(backend, max_new_tokens),
+    )
+    seconds = time.perf_counter() - start
+
+    if backend in ("hf", "gemma"):
+        return seconds, max_new_tokens
+    return seconds, count_tokens(model, response.content)
+
+
+def time_first_chunk(
+    model, messages: list[ChatMessage], max_new_tokens: int, params: Optional[dict]
+) -> float:
+    """
+    Time from calling generate_stream until the first non-empty chunk arrives (the rest
+    of the stream is drained)
+    """
+    chat = ChatHistory(messages=list(messages))
+    start = time.perf_counter()
+    ttft = None
+    for chunk in model.generate_stream(
+        chat, max_new_tokens=max_new_tokens, sampling_params=params
+    ):
+        if ttft is None and chunk:
+            ttft = time.perf_counter() - start
+
+    return ttft if ttft is not None else time.perf_counter() - start
+
+
+def bench_generation(
+    model, backend: str, prompt_tokens: int, new_tokens: int, repeats: int
+) -> dict:
+    """
+    Prefill throughput (from 1-token generate calls), decode throughput (full calls
+    minus prefill) and TTFT
+    """
+    messages = build_prompt(model, prompt_tokens)
+    n_prompt = len(
+        model.tokenizer.apply_chat_template(
+            [message.model_dump() for message in messages],
+            tokenize=True,
+            add_generation_prompt=True,
+        )
+    )
+
+    # warm-up (kernels, lazy allocations)
+    time_generate(model, backend, messages, 2)
+
+    prefill_s = statistics.median(
+        time_generate(model, backend, messages, 1)[0] for _ in range(repeats)
+    )
+
+    full_runs = [
+        time_generate(model, backend, messages, new_tokens) for _ in range(repeats)
+    ]
+    full_s = statistics.median(seconds for seconds, _ in full_runs)
+    n_generated = statistics.median(n for _, n in full_runs)
+    decode_s = max(full_s - prefill_s, 1e-9)
+
+    ttft_s = statistics.median(
+        time_first_chunk(
+            model, messages, new_tokens, fixed_length_params(backend, new_tokens)
+        )
+        for _ in range(repeats)
+    )
+
+    return {
+        "prompt_tokens": n_prompt,
+        "generated_tokens": n_generated,
+        "prefill_s": prefill_s,
+        "prefill_tok_per_s": n_prompt / prefill_s,
+        "decode_s": decode_s,
+        "decode_tok_per_s": max(n_generated - 1, 0) / decode_s,
+        "ttft_s": ttft_s,
+    }
+
+
+def bench_simulation(
+    model, backend: str, n_rounds: int, new_tokens: int, random_model: bool = False
+) -> dict:
+    """
+    End-to-end simulate_conversation throughput (generation, language detection and
+    retries), in tutor rounds per second, with the number of tutor retries and whether
+    the conversation was rejected.
+
+    The responses of a randomly initialised model (random_model) are replaced by
+    deterministic Spanish of the same length (see stub_backend.SpanishResponses), so the
+    conversation is not rejected and the timing covers full rounds rather than retries.
+    """
+    try:
+        from scripts.alignment_drift.detect_lang import _detect_lang
+        from scripts.alignment_drift.simulate import simulate_conversation
+    except ImportError as e:
+        print(f"[WARNING]: Skipping simulate_conversation benchmark ({e})")
+        return {"skipped": str(e)}
+
+    if random_model:
+        from stub_backend import SpanishResponses
+
+        model = SpanishResponses(model)
+
+    _detect_lang("Hola, ¿cómo estás?")  # build the language detector before timing
+
+    n_tutor_rounds = 0
+    n_generate_calls = 0
+    generate = model.generate
+
+    def counted_generate(*args, **kwargs) -> ChatMessage:
+        nonlocal n_generate_calls
+        n_generate_calls += 1
+        return generate(*args, **kwargs)
+
+    model.generate = counted_generate
+
+    def on_message(turn: int, message: ChatMessage) -> None:
+        nonlocal n_tutor_rounds
+        if message.role == "assistant":
+            n_tutor_rounds += 1
+
+    start = time.perf_counter()
+    try:
+        tutor_history = simulate_conversation(
+            model=model,
+            n_total_rounds=n_rounds,
+            tutor_system_prompt=TUTOR_SYSTEM_PROMPT,
+            sampling_params=fixed_length_params(backend, new_tokens),
+            on_message=on_message,
+            max_new_tokens=new_tokens,
+        )
+    finally:
+        del model.generate
+    seconds = time.perf_counter() - start
+
+    # every accepted tutor response is followed by one student response
+    n_retries = n_generate_calls - 2 * n_tutor_rounds
+
+    return {
+        "rounds": n_tutor_rounds,
+        "completed": tutor_history is not None,
+        "rejected": tutor_history is None,
+        "retries": n_retries,
+        "spanish_responses": random_model,
+        "seconds": seconds,
+        "rounds_per_s": n_tutor_rounds / seconds,
+    }
+
+
+def weights_memory(model) -> dict:
+    """
+    Memory taken by the model weights in MB (torch backends only)
+    """
+    if "torch" not in sys.modules or not isinstance(
+        model.model, sys.modules["torch"].nn.Module
+    ):
+        return {}
+
+    from interact_llm.llm.quantization import model_footprint_mb
+
+    return {"weights_mb": model_footprint_mb(model.model)}
+
+
+def peak_memory() -> dict:
+    """
+    Peak resident set size of the process and, if CUDA is in use, peak allocated CUDA
+    memory (in MB)
+    """
+    memory = {"peak_rss_mb": None}
+    try:
+        import resource
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes on Linux
+        memory["peak_rss_mb"] = (
+            max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+        )
+    except ImportError:
+        pass
+
+    if "torch" in sys.modules:
+        import torch
+
+        if torch.cuda.is_available():
+            memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+
+    return memory
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    env = {"python": platform.python_version(), "platform": platform.platform()}
+    for package in ("torch", "transformers", "mlx_lm"):
+        if package in sys.modules:
+            env[package] = getattr(sys.modules[package], "__version__", None)
+    return env
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Print the relative change of every metric against a baseline run (positive is an
+    improvement)
+    """
+    print(f"[INFO]: Comparison with baseline (commit {baseline.get('commit')}):")
+    current, previous = flatten(results["results"]), flatten(baseline["results"])
+    for metric, value in current.items():
+        if metric not in previous or previous[metric] == 0:
+            continue
+        change = (value - previous[metric]) / previous[metric]
+        if metric.split(".")[-1] in LOWER_IS_BETTER:
+            change = -change
+        print(
+            f"  {metric:40s} {previous[metric]:12.4g} -> {value:12.4g} ({change:+.1%})"
+        )
+
+
+def record(
+    model_name: str, backend: str, quantization: Optional[str], results: dict
+) -> None:
+    """
+    Write the measured footprint and decode speed to the model entry in
+    configs/models.toml (as [models.measured.<backend>-<quantization>-<device>])
+    """
+    from interact_llm.utils.model_load import record_measurement
+
+    memory, generation = results["results"]["memory"], results["results"]["generation"]
+    device = "cuda" if memory.get("peak_cuda_mb") is not None else "cpu"
+    key = f"{backend}-{quantization or 'none'}-{device}"
+    measurement = {
+        "weights_mb": memory.get("weights_mb"),
+        "peak_rss_mb": memory.get("peak_rss_mb"),
+        "decode_tok_per_s": generation["decode_tok_per_s"],
+        "prefill_tok_per_s": generation["prefill_tok_per_s"],
+    }
+    # TOML has no null
+    measurement = {
+        metric: round(value, 2)
+        for metric, value in measurement.items()
+        if value is not None
+    }
+    measurement.update(
+        platform=results["environment"]["platform"],
+        commit=results["commit"] or "",
+        date=results["timestamp"][:10],
+    )
+    record_measurement(MODELS_CONFIG_PATH, model_name, key, measurement)
+    print(
+        f"[INFO]: Recorded measurement {key} for {model_name} in {MODELS_CONFIG_PATH}"
+    )
+
+
+def main():
+    args = input_parse()
+    backend = args.backend or default_backend()
+
+    if args.record and args.model_name is None:
+        raise ValueError("--record requires --model_name")
+
+    model_path = args.model_path
+    if args.model_name is not None and model_path is None:
+        from interact_llm.utils.model_load import get_model_id
+
+        model_path = get_model_id(
+            MODELS_CONFIG_PATH,
+            args.model_name,
+            backend="mlx" if backend == "mlx" else "hf",
+        )
+
+    print(
+        f"[INFO]: Benchmarking the {backend} backend on "
+        f"{model_path or 'a tiny local model'}"
+    )
+    model = load_backend(backend, model_path, args.quantization)
+
+    generation = bench_generation(
+        model, backend, args.prompt_tokens, args.new_tokens, args.repeats
+    )
+    simulation = bench_simulation(
+        model,
+        backend,
+        args.n_rounds,
+        args.new_tokens,
+        # the tiny model is randomly initialised
+        random_model=model_path is None and backend != "stub",
+    )
+
+    commit = git_commit()
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "backend": backend,
+        "model": model_path or "tiny-random-llama",
+        "params": {
+            "quantization": args.quantization,
+            "prompt_tokens": args.prompt_tokens,
+            "new_tokens": args.new_tokens,
+            "repeats": args.repeats,
+            "n_rounds": args.n_rounds,
+        },
+        "environment": environment(),
+        "results": {
+            "generation": generation,
+            "simulation": simulation,
+            "memory": {**weights_memory(model), **peak_memory()},
+        },
+    }
+
+    out = (
+        args.out
+        or RESULTS_DIR
+        / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'nocommit'}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2))
+
+    print(json.dumps(results["results"], indent=2))
+    print(f"[INFO]: Results saved to {out}")
+
+    if args.baseline is not None:
+        compare(results, json.loads(args.baseline.read_text()))
+
+    if args.record:
+        record(args.model_name, backend, args.quantization, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark CLI startup: wall time of `--help` for every command line entry point (each
+run in a fresh interpreter), and a check that none of them imports a model backend
+(torch, transformers, mlx, mlx_lm) before one is selected.
+
+Exits with status 1 if an entry point is over the time budget or imports a backend, so
+it can be used as a check.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parents[1]
+SRC_DIR = ROOT_DIR / "src"
+
+ENTRY_POINTS = [
+    "interact_llm",
+    "interact_llm.serve",
+    "scripts.alignment_drift.simulate",
+    "scripts.alignment_drift.sweep",
+    "scripts.alignment_drift.analyse",
+]
+BACKEND_MODULES = ("torch", "transformers", "mlx", "mlx_lm")
+DEFAULT_BUDGET_S = 1.0
+
+# runs `python -m <module> --help` and reports the backend modules imported on the way
+PROBE = """
+import json, runpy, sys
+sys.argv = [{module!r}, "--help"]
+try:
+    runpy.run_module({module!r}, run_name="__main__", alter_sys=True)
+except SystemExit:
+    pass
+imported = [name for name in {backends!r} if name in sys.modules]
+print(json.dumps(imported), file=sys.stderr)
+"""
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--budget_s",
+        help="max startup time of an entry point in seconds",
+        type=float,
+        default=DEFAULT_BUDGET_S,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="number of timed runs per entry point (the median is reported)",
+        type=int,
+        default=5,
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+def time_startup() -> float:
+    """
+    Wall time of an interpreter that does nothing (the floor of every entry point)
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - start
+
+
+def time_help(module: str) -> tuple[float, list[str]]:
+    """
+    Time `--help` of an entry point in a fresh interpreter
+
+    Returns:
+        seconds: Wall time of the process.
+        backends: Backend modules imported by the entry point.
+    """
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(
+            filter(None, [str(SRC_DIR), os.environ.get("PYTHONPATH")])
+        ),
+    }
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, backends=BACKEND_MODULES)],
+        cwd=SRC_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{module} --help failed:\n{process.stderr}")
+
+    return seconds, json.loads(process.stderr.strip().splitlines()[-1])
+
+
+def main():
+    args = input_parse()
+
+    startup = statistics.median(time_startup() for _ in range(args.repeats))
+    print(
+        f"[INFO]: Interpreter startup {startup:.3f}s, budget per entry point "
+        f"{args.budget_s:.2f}s"
+    )
+
+    failed = False
+    for module in ENTRY_POINTS:
+        runs = [time_help(module) for _ in range(args.repeats)]
+        seconds = statistics.median(run[0] for run in runs)
+        backends = runs[-1][1]
+
+        ok = seconds <= args.budget_s and not backends
+        failed |= not ok
+        note = f" imports {', '.join(backends)}" if backends else ""
+        print(f"  {module:40s} {seconds:6.3f}s {'ok' if ok else 'FAILED'}{note}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Check that concurrent streaming clients of interact_llm.serve are served at the same
+time: a server with the hf backend is started in-process, several clients stream a
+response at once (through ChatHTTP), and the time of each client's first and last
+chunk is reported.
+
+By default the tiny randomly initialised model of bench_generation.py is used (no
+downloads). Exits with status 1 if the streams do not overlap (i.e., one stream only
+starts once another has finished), so it can be used as a check.
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# run from a checkout without installing the package
+ROOT_DIR = Path(__file__).parents[1]
+sys.path.insert(0, str(ROOT_DIR / "src"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from interact_llm.data_models.chat import ChatMessage, CompactChatHistory  # noqa: E402
+
+TINY_MODEL_DIR = Path(tempfile.gettempdir()) / "interact_llm_tiny_model"
+
+QUESTIONS = [
+    "Hola, ¿cómo estás?",
+    "¿Qué te gusta hacer los fines de semana?",
+    "¿Dónde vives?",
+    "¿Cómo se llama tu familia?",
+]
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--model_path",
+        help="local path or HF id of the model (default: a tiny random model)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--n_clients",
+        help="number of clients streaming at once",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--new_tokens",
+        help="max number of tokens streamed to each client",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        help="max_wait of the server's batch scheduler (in milliseconds)",
+        type=float,
+        default=10.0,
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def stream_client(base_url: str, question: str, new_tokens: int, start: float):
+    """
+    Stream one response and time its chunks (relative to start)
+    """
+    from interact_llm.llm.http_client import ChatHTTP
+
+    client = ChatHTTP(base_url)
+    await asyncio.to_thread(client.load)
+
+    chat = CompactChatHistory([ChatMessage(role="user", content=question)])
+    times = []
+    async for _ in client.agenerate_stream(chat, new_tokens):
+        times.append(time.perf_counter() - start)
+
+    if not times:
+        raise RuntimeError(f"No chunks were streamed for {question!r}")
+
+    return {"first_chunk_s": times[0], "last_chunk_s": times[-1], "chunks": len(times)}
+
+
+async def bench_streams(
+    model, n_clients: int, new_tokens: int, max_wait: float
+) -> dict:
+    """
+    Serve model and stream to n_clients clients at once
+    """
+    from interact_llm.serve import InferenceServer
+
+    server = InferenceServer(model, max_wait=max_wait)
+    port = free_port()
+    ready = asyncio.Event()
+    server_task = asyncio.create_task(server.serve("127.0.0.1", port, ready))
+    await ready.wait()
+
+    try:
+        start = time.perf_counter()
+        streams = await asyncio.gather(
+            *(
+                stream_client(
+                    f"http://127.0.0.1:{port}",
+                    QUESTIONS[i % len(QUESTIONS)],
+                    new_tokens,
+                    start,
+                )
+                for i in range(n_clients)
+            )
+        )
+        seconds = time.perf_counter() - start
+    finally:
+        server_task.cancel()
+
+    return {
+        "streams": streams,
+        "seconds": seconds,
+        "batches": server.scheduler.n_batches,
+        # every stream has started before any of them has finished
+        "overlap": max(stream["first_chunk_s"] for stream in streams)
+        < min(stream["last_chunk_s"] for stream in streams),
+    }
+
+
+def main():
+    args = input_parse()
+
+    from interact_llm.llm.hf_wrapper import ChatHF
+
+    model_path = args.model_path
+    if model_path is None:
+        from tiny_model import build_tiny_model
+
+        model_path = str(build_tiny_model(TINY_MODEL_DIR))
+
+    model = ChatHF(model_id=model_path)
+    model.load()
+
+    results = asyncio.run(
+        bench_streams(model, args.n_clients, args.new_tokens, args.max_wait_ms / 1000)
+    )
+    print(json.dumps(results, indent=2))
+
+    if not results["overlap"]:
+        print("[ERROR]: The streams were served one after another")
+        sys.exit(1)
+
+    print(f"[INFO]: {args.n_clients} streams were served at the same time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Deterministic stub backend with the same interface as ChatHF/ChatHFGemma/ChatMLX
+
+Used by the benchmarks when torch/transformers are not available, so that the harness
+itself (e.g., simulate_conversation with language detection) can still be measured.
+"""
+
+from itertools import cycle, islice
+from typing import Callable, Iterator, Optional
+
+from interact_llm.data_models.chat import ChatHistory, ChatMessage
+from interact_llm.llm.stopping import SentenceMonitor
+
+WORDS = (
+    "hola me llamo ana y vivo en madrid con mi familia . ¿ qué te gusta hacer ?".split()
+)
+
+
+class StubTokenizer:
+    """
+    Whitespace "tokenizer" (one token per word)
+    """
+
+    def __call__(self, text: str) -> dict:
+        return {"input_ids": self.encode(text)}
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> list[int]:
+        return list(range(len(text.split())))
+
+    def apply_chat_template(
+        self,
+        conversation: list[dict],
+        tokenize: bool = True,
+        add_generation_prompt: bool = True,
+    ) -> list[int] | str:
+        text = " ".join(f"{msg['role']}: {msg['content']}" for msg in conversation)
+        return self.encode(text) if tokenize else text
+
+
+class ChatStub:
+    """
+    Returns a deterministic Spanish response of max_new_tokens words (capped by
+    response_len)
+    """
+
+    def __init__(self, model_id: str = "stub", response_len: int = 64):
+        self.model_id = model_id
+        self.response_len = response_len
+        self.tokenizer = StubTokenizer()
+        self.model = self  # the app and benchmarks check that a model is loaded
+
+    def load(self) -> None:
+        pass
+
+    def _words(
+        self, max_new_tokens: int, stop_on: Optional[Callable[[str], bool]] = None
+    ) -> Iterator[str]:
+        monitor = SentenceMonitor(stop_on) if stop_on is not None else None
+        text = ""
+        for word in islice(cycle(WORDS), min(max_new_tokens, self.response_len)):
+            yield word + " "
+            text += word + " "
+            if monitor is not None and monitor.check(text):
+                break
+
+    def generate(
+        self,
+        chat: list[ChatMessage],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        return ChatMessage(
+            role="assistant",
+            content="".join(self._words(max_new_tokens, stop_on)).strip(),
+        )
+
+    def generate_stream(
+        self,
+        chat: list[ChatMessage],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        yield from self._words(max_new_tokens, stop_on)
+
+    def generate_candidates(
+        self,
+        chat: list[ChatMessage],
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        return [
+            self.generate(chat, max_new_tokens, stop_on=stop_on)
+            for _ in range(n_candidates)
+        ]
+
+    def generate_batch(
+        self,
+        chats: list[ChatHistory],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        return [self.generate(chat, max_new_tokens, stop_on=stop_on) for chat in chats]
+
+
+class SpanishResponses:
+    """
+    Wraps a backend on a randomly initialised model (e.g., the tiny benchmark model):
+    generation runs as usual, but the response is replaced by deterministic Spanish with
+    the same number of words, so simulate_conversation does not reject the random text.
+    Early aborts are disabled, as they would trigger on the random text.
+    """
+
+    def __init__(self, model):
+        self.backend = model
+
+    def __getattr__(self, name: str):
+        return getattr(self.backend, name)
+
+    def generate(
+        self,
+        chat: ChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        message = self.backend.generate(
+            chat, max_new_tokens, sampling_params, penalty_params
+        )
+        n_words = max(len(message.content.split()), 1)
+        message.content = " ".join(islice(cycle(WORDS), n_words))
+        return message
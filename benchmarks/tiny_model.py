@@ -0,0 +1,88 @@
+"""
+Tiny randomly initialised causal LM (and tokenizer with a chat template) built locally,
+so that the generation backends can be benchmarked without downloading any weights
+"""
+
+from pathlib import Path
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+CORPUS = [
+    "Hola, ¿cómo estás? Me llamo Ana y vivo en Madrid con mi familia.",
+    "Eres un tutor de español. El estudiante está aprendiendo español a nivel A1.",
+    "You are a student learning Spanish, responding to a teacher.",
+    "¿Qué te gusta hacer los fines de semana? Me gusta leer y pasear por el parque.",
+]
+
+
+def build_tiny_model(
+    out_dir: Path,
+    vocab_size: int = 1024,
+    hidden_size: int = 64,
+    n_layers: int = 2,
+    seed: int = 0,
+) -> Path:
+    """
+    Build (or reuse, if out_dir already holds one) a tiny Llama model with a byte-level
+    BPE tokenizer
+
+    Args:
+        out_dir: Dir to save the model and tokenizer to (loadable with from_pretrained).
+        vocab_size: Size of the BPE vocab trained on a small built-in corpus.
+        hidden_size: Hidden size of the model.
+        n_layers: Number of decoder layers.
+        seed: Seed for the random weights.
+
+    Returns:
+        out_dir: The dir with the saved model.
+    """
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    out_dir = Path(out_dir)
+    if (out_dir / "config.json").exists() and (out_dir / "tokenizer.json").exists():
+        return out_dir
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|im_start|>", "<|im_end|>", "<pad>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS * 10, trainer)
+
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|im_start|>",
+        eos_token="<|im_end|>",
+        pad_token="<pad>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    hf_tokenizer.chat_template = CHAT_TEMPLATE
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(hf_tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=n_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=hf_tokenizer.bos_token_id,
+        eos_token_id=hf_tokenizer.eos_token_id,
+        pad_token_id=hf_tokenizer.pad_token_id,
+    )
+
+    hf_tokenizer.save_pretrained(out_dir)
+    LlamaForCausalLM(config).save_pretrained(out_dir)
+
+    return out_dir
@@ -3,26 +3,33 @@ Initial inspiration:https://textual.textualize.io/blog/2024/09/15/anatomy-of-a-t
 """
 
 import argparse
-import json
-from datetime import datetime
+import asyncio
+import os
+import time
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 from textual import on, work
 from textual.app import App, ComposeResult
 from textual.containers import Grid, VerticalScroll
 from textual.screen import ModalScreen
 from textual.widgets import Button, Footer, Input, Label, Markdown
-from transformers.utils.logging import disable_progress_bar
 
 from .data_models.chat import ChatHistory, ChatMessage
 from .data_models.prompt import load_prompt_by_id
-from .llm.hf_wrapper import ChatHF
-from .llm.mlx_wrapper import ChatMLX
+from .llm.context import ContextWindow, make_model_summariser, token_counter
+from .utils.transcript_store import ConversationKey, TranscriptStore, new_run_id
 
-disable_progress_bar()
+# the model backends (torch, transformers, mlx_lm) are only imported in main, once the
+# one to use is known
+if TYPE_CHECKING:
+    from .llm.hf_wrapper import ChatHF
+    from .llm.http_client import ChatHTTP
+    from .llm.mlx_wrapper import ChatMLX
 
 DEFAULT_PROMPT_VERSION = 3.0
+STREAM_UPDATE_INTERVAL = 0.05  # seconds between re-renders of a streamed response
+
 
 def input_parse():
     parser = argparse.ArgumentParser()
@@ -32,7 +39,42 @@ def input_parse():
         "--prompt_id", help="id of prompt in toml", type=str, default="A1"
     )
     parser.add_argument(
-        "--prompt_version", help="version of prompt toml file", type=float, default=DEFAULT_PROMPT_VERSION
+        "--prompt_version",
+        help="version of prompt toml file",
+        type=float,
+        default=DEFAULT_PROMPT_VERSION,
+    )
+    parser.add_argument(
+        "--max_context_tokens",
+        help=(
+            "token budget of the chat history sent to the model, e.g., 6144 (older "
+            "turns are dropped), 0 (default) sends the full history"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--server_url",
+        help=(
+            "use the model served at this URL (see interact_llm.serve) instead of "
+            "loading one"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--quantization",
+        help=(
+            "CPU weight quantization of the HF fallback model: int8, int4 or none "
+            "(ignored on GPU)"
+        ),
+        type=str,
+        default="int8",
+    )
+    parser.add_argument(
+        "--summarise_dropped",
+        help="replace dropped turns with a summary written by the model",
+        action="store_true",
     )
 
     # save arguments to be parsed from the CLI
@@ -84,17 +126,17 @@ class ChatApp(App):
     UserMessage {
         background: $primary 10%;
         color: $text;
-        margin: 1;        
+        margin: 1;
         margin-right: 8;
         padding: 1 2 0 2;
     }
 
     Response {
         border: wide $success;
-        background: $success 10%;   
-        color: $text;             
-        margin: 1;      
-        margin-left: 8; 
+        background: $success 10%;
+        color: $text;
+        margin: 1;
+        margin-left: 8;
         padding: 1 2 0 2;
     }
 
@@ -127,17 +169,27 @@ class ChatApp(App):
 
     def __init__(
         self,
-        model: ChatHF | ChatMLX,
+        model: "ChatHF | ChatMLX | ChatHTTP",
         chat_history: Optional[ChatHistory] = None,
         chat_messages_dir: Optional[Path] = None,
+        context_window: Optional[ContextWindow] = None,
     ):
         """
-        Initializes the terminal app with a loaded ChatHF or ChatMLX model. The application will not start if the model is not loaded.
+        Initializes the terminal app with a loaded ChatHF or ChatMLX model (or a
+        ChatHTTP client of a model server). The application will not start if the model
+        is not loaded.
 
         Args:
-            model: The loaded language model wrapped in either ChatHF or ChatMLX.
-            chat_history: An optional chat history to initialize the application with, e.g., to include a system prompt.
-            chat_messages_dir: The directory to save chat messages. If None, chat messages will not be saved.
+            model: The loaded language model wrapped in either ChatHF or ChatMLX (or
+                ChatHTTP).
+            chat_history: An optional chat history to initialize the application with,
+                e.g., to include a system prompt.
+            chat_messages_dir: The directory with the transcript log that chat messages
+                are appended to as they are sent. If None, chat messages will not be
+                saved.
+            context_window: An optional token budget for the chat history sent to the
+                model. If None, the full chat history is sent. The full history is
+                always saved.
         """
 
         super().__init__()
@@ -146,12 +198,15 @@ class ChatApp(App):
             ChatHistory(messages=[]) if chat_history is None else chat_history
         )
         self.chat_messages_dir = chat_messages_dir
+        self.context_window = context_window
 
         # run prelim checks
         self._check_model_is_loaded()
 
+        self.transcript_store = None
         if self.chat_messages_dir is not None:
             self._ensure_chat_dir_exists()
+            self._open_transcript()
 
     def _check_model_is_loaded(self):
         if self.model.model is None:
@@ -163,10 +218,32 @@ class ChatApp(App):
     def _ensure_chat_dir_exists(self):
         self.chat_messages_dir.mkdir(parents=True, exist_ok=True)
 
+    def _open_transcript(self):
+        """
+        Open the transcript log and append the initial chat history (e.g., the system
+        prompt).
+        """
+        prompt_id, prompt_version = self.chat_history.prompt_key or ("none", "none")
+        self.transcript_key = ConversationKey(
+            self.model.model_id, prompt_version, prompt_id, new_run_id()
+        )
+        self.transcript_store = TranscriptStore(
+            self.chat_messages_dir / "transcripts.jsonl"
+        )
+        self.transcript_store.append_history(self.transcript_key, self.chat_history)
+
     def update_chat_history(self, chat_message: ChatMessage) -> None:
-        """Update chat history with a single new message."""
+        """
+        Update chat history with a single new message (and append it to the transcript
+        log).
+        """
         self.chat_history.messages.append(chat_message)
 
+        if self.transcript_store is not None:
+            self.transcript_store.append(
+                self.transcript_key, len(self.chat_history.messages) - 1, chat_message
+            )
+
     # app buttons
     def compose(self) -> ComposeResult:
         with VerticalScroll(id="chat-view"):
@@ -180,17 +257,9 @@ class ChatApp(App):
         def check_quit(quit: bool | None) -> None:
             """Called when QuitScreen is dismissed."""
             if quit:
-                if self.chat_messages_dir is not None:
-                    chat_json = json.dumps(
-                        [msg.dict() for msg in self.chat_history.messages],
-                        indent=3,
-                        ensure_ascii=False,
-                    )
-                    save_file_name = datetime.now().strftime("%Y%m%d-%H%M%S")
-                    with open(
-                        self.chat_messages_dir / f"{save_file_name}.json", "w"
-                    ) as outfile:
-                        outfile.write(chat_json)
+                if self.transcript_store is not None:
+                    self.transcript_store.end(self.transcript_key, status="complete")
+                    self.transcript_store.close()
                 self.exit()
 
         self.push_screen(QuitScreen(), check_quit)
@@ -206,26 +275,44 @@ class ChatApp(App):
 
         self.get_model_response(user_message.value, response)
 
-    @work(thread=True)
-    def get_model_response(self, user_message: str, response: Response) -> None:
+    @work()
+    async def get_model_response(self, user_message: str, response: Response) -> None:
         """
-        Displays model response to user message, updating chat history
+        Streams model response to user message into the app, updating chat history.
+        Generation runs in the model's worker thread (agenerate_stream), so the app
+        stays responsive.
         """
         self.update_chat_history(ChatMessage(role="user", content=user_message))
 
-        model_response = self.model.generate(self.chat_history)
+        # only the system prompt and the most recent turns are sent if a context window
+        # is set (trimming may ask the model for a summary, so it runs off the event
+        # loop)
+        chat = (
+            self.chat_history
+            if self.context_window is None
+            else await asyncio.to_thread(self.context_window.view, self.chat_history)
+        )
+
+        # coalesce streamed chunks so that the markdown is re-rendered at most once per
+        # interval
+        chunks = []
+        last_update = 0.0
+        async for chunk in self.model.agenerate_stream(chat):
+            chunks.append(chunk)
 
-        # replace weird <|im_end|>
-        model_response.content = model_response.content.replace("<|im_end|>", "")
+            now = time.monotonic()
+            if now - last_update >= STREAM_UPDATE_INTERVAL:
+                # replace weird <|im_end|>
+                await response.update("".join(chunks).replace("<|im_end|>", ""))
+                last_update = now
 
-        # display in APP
-        response_content = ""
-        for chunk in model_response.content:
-            response_content += chunk  # add words in a "stream-like" way
-            self.call_from_thread(response.update, response_content)
+        response_content = "".join(chunks).replace("<|im_end|>", "")
+        await response.update(response_content)
 
         # update history again with model response
-        self.update_chat_history(model_response)
+        self.update_chat_history(
+            ChatMessage(role="assistant", content=response_content)
+        )
 
 
 def main():
@@ -251,31 +338,55 @@ def main():
     )
 
     # format initial chat msg w. system prompt
-    chat_history = ChatHistory(
-        messages=[ChatMessage(role=system_prompt.role, content=system_prompt.content)]
-    )
+    chat_history = ChatHistory.from_system_prompt(system_prompt)
 
     # define sampler params
     sampling_params = {"temp": 0.8, "top_p": 0.95, "min_p": 0.95, "top_k": 40}
     penality_params = {"repetition_penalty": 1.1}
 
-    # load model with MLX if possible, default to HF instead
-    try:
-        model_id = "mlx-community/Qwen2.5-7B-Instruct-1M-4bit"
-        model = ChatMLX(
-            model_id=model_id,
+    # disable HF progress bars (read by huggingface_hub/transformers on import)
+    os.environ.setdefault("HF_HUB_DISABLE_PROGRESS_BARS", "1")
+
+    # load model with MLX if possible, default to HF instead (unless a model server is
+    # used)
+    if args.server_url is not None:
+        from .llm.http_client import ChatHTTP
+
+        model = ChatHTTP(
+            base_url=args.server_url,
             sampling_params=sampling_params,
             penalty_params=penality_params,
         )
-        print(f"[INFO]: Loading model {model_id} ... please wait")
-        model.load()
-    except Exception as e:
-        print(f"[INFO:] Failed to run using MLX. Defaulting to HuggingFace. Error: {e}")
-        model_id = "BSC-LT/salamandra-2b-instruct"
-        cache_dir = Path(__file__).parents[3] / "models"
-        model = ChatHF(model_id=model_id, cache_dir=cache_dir)
-        print(f"[INFO]: Loading model {model_id} ... please wait")
         model.load()
+        model_id = model.model_id
+        print(f"[INFO]: Using model {model_id} served at {args.server_url}")
+    else:
+        try:
+            # fails without mlx_lm (e.g., on Linux)
+            from .llm.mlx_wrapper import ChatMLX
+
+            model_id = "mlx-community/Qwen2.5-7B-Instruct-1M-4bit"
+            model = ChatMLX(
+                model_id=model_id,
+                sampling_params=sampling_params,
+                penalty_params=penality_params,
+            )
+            print(f"[INFO]: Loading model {model_id} ... please wait")
+            model.load()
+        except Exception as e:
+            print(
+                "[INFO:] Failed to run using MLX. Defaulting to HuggingFace. Error: "
+                f"{e}"
+            )
+            from .llm.hf_wrapper import ChatHF
+
+            model_id = "BSC-LT/salamandra-2b-instruct"
+            cache_dir = Path(__file__).parents[3] / "models"
+            model = ChatHF(
+                model_id=model_id, cache_dir=cache_dir, quantization=args.quantization
+            )
+            print(f"[INFO]: Loading model {model_id} ... please wait")
+            model.load()
 
     # define save dir
     save_dir = (
@@ -286,11 +397,22 @@ def main():
         / prompt_id
     )
 
+    # keep the chat sent to the model within the token budget
+    context_window = None
+    if args.max_context_tokens > 0:
+        context_window = ContextWindow(
+            count_tokens=token_counter(model),
+            max_tokens=args.max_context_tokens,
+            summarise=make_model_summariser(model) if args.summarise_dropped else None,
+            counter_key=model_id,
+        )
+
     # open tui app -> pass loaded model
     app = ChatApp(
         model=model,
         chat_history=chat_history,
         chat_messages_dir=save_dir,
+        context_window=context_window,
     )
     app.run()
 
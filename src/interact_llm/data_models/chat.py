@@ -2,9 +2,13 @@
 Chat formatting using pydantic
 """
 
-from typing import Literal
+import weakref
+from array import array
+from typing import Any, Iterable, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
+
+from interact_llm.data_models.prompt import SystemPrompt
 
 
 class ChatMessage(BaseModel):
@@ -13,15 +17,339 @@ class ChatMessage(BaseModel):
         role: sender of the content
             user = input, assistant = LLM output, system = initial system message only
         content: text written by role
+
+    The token count of the content is cached per tokenizer (not serialised), see
+    llm.context, as is the message in the nested format of multimodal processors (see
+    ChatHFGemma). metadata holds data about the message that is not serialised either,
+    e.g., the telemetry record of the generate call that returned it (see
+    llm.telemetry).
     """
 
     role: Literal["user", "assistant", "system"]
     content: str
+    metadata: dict[str, Any] = Field(default_factory=dict, exclude=True)
+
+    _n_tokens: dict[str, int] = PrivateAttr(default_factory=dict)
+    _formatted: Optional[dict] = PrivateAttr(default=None)
 
 
 class ChatHistory(BaseModel):
     """
     Chat history formatting.
+
+    The history also holds the KV cache of the backend it was last generated with (not
+    serialised), so that the next turn only has to prefill the newly appended messages.
+    Histories made with from_system_prompt also remember (prompt_id, prompt_version) so
+    that the backends can share the system prompt KV state across conversations.
     """
 
     messages: list[ChatMessage]
+
+    _kv_cache: Any = PrivateAttr(default=None)
+    _prompt_key: Optional[tuple[str, Optional[str]]] = PrivateAttr(default=None)
+
+    @classmethod
+    def from_system_prompt(
+        cls, system_prompt: SystemPrompt, messages: Optional[list[ChatMessage]] = None
+    ) -> "ChatHistory":
+        """
+        Start a chat history with a system prompt (optionally followed by messages)
+        """
+        chat = cls(
+            messages=[
+                ChatMessage(role=system_prompt.role, content=system_prompt.content)
+            ]
+            + (messages or [])
+        )
+        chat._prompt_key = (system_prompt.id, system_prompt.version)
+        return chat
+
+    @property
+    def prompt_key(self) -> Optional[tuple[str, Optional[str]]]:
+        return self._prompt_key
+
+
+ROLES = ("system", "user", "assistant")
+
+
+class CompactChatHistory:
+    """
+    Append-only chat history for long simulations, accepted by the backends wherever a
+    ChatHistory is.
+
+    Roles and contents are kept in flat arrays, and the chat template segment of every
+    message is rendered and tokenized once per tokenizer (the first time the history is
+    sent to a model), so a new turn only tokenizes the messages appended since the
+    previous one and input_ids concatenates the cached token ids. A segment is rendered
+    as the difference between the template rendered with and without the message, given
+    the system prompt, the first message and (if needed to keep the roles alternating)
+    the previous message. Templates for which that is not a prefix (rare) fall back to
+    rendering and tokenizing the full chat.
+
+    Like a ChatHistory, it holds the KV cache of the backend it was last generated with
+    and (if made with from_system_prompt) the (prompt_id, prompt_version) of its system
+    prompt.
+    """
+
+    __slots__ = (
+        "_roles",
+        "_contents",
+        "_ids",
+        "_ends",
+        "_suffix",
+        "_binding",
+        "_incremental",
+        "_verified",
+        "_kv_cache",
+        "_prompt_key",
+    )
+
+    def __init__(self, messages: Optional[Iterable[ChatMessage]] = None):
+        self._roles = bytearray()  # index into ROLES per message
+        self._contents: list[str] = []
+        # token ids of the rendered segments of all tokenized messages
+        self._ids = array("I")
+        self._ends = array("I")  # end offset in _ids per tokenized message
+        self._suffix: Optional[array] = None  # token ids of the generation prompt
+        # (tokenizer, add_special_tokens) of the cached ids
+        self._binding: Optional[tuple[weakref.ref, bool]] = None
+        self._incremental = True
+        self._verified = False  # whether the ids were compared to the full rendering
+        self._kv_cache: Any = None
+        self._prompt_key: Optional[tuple[str, Optional[str]]] = None
+
+        for message in messages or []:
+            self.append(message)
+
+    @classmethod
+    def from_system_prompt(
+        cls, system_prompt: SystemPrompt, messages: Optional[list[ChatMessage]] = None
+    ) -> "CompactChatHistory":
+        """
+        Start a chat history with a system prompt (optionally followed by messages)
+        """
+        chat = cls(
+            [ChatMessage(role=system_prompt.role, content=system_prompt.content)]
+            + (messages or [])
+        )
+        chat._prompt_key = (system_prompt.id, system_prompt.version)
+        return chat
+
+    @classmethod
+    def from_chat_history(cls, chat: ChatHistory) -> "CompactChatHistory":
+        compact = cls(chat.messages)
+        compact._prompt_key = chat.prompt_key
+        return compact
+
+    def to_chat_history(self) -> ChatHistory:
+        chat = ChatHistory(messages=list(self.messages))
+        chat._prompt_key = self._prompt_key
+        return chat
+
+    @property
+    def prompt_key(self) -> Optional[tuple[str, Optional[str]]]:
+        return self._prompt_key
+
+    def __len__(self) -> int:
+        return len(self._roles)
+
+    def append(self, message: ChatMessage) -> None:
+        self._roles.append(ROLES.index(message.role))
+        self._contents.append(message.content)
+        # the generation prompt may depend on the last message (e.g., its role)
+        self._suffix = None
+
+    def is_prefix_of(self, messages: list[ChatMessage]) -> bool:
+        """
+        Whether the history equals the first messages of messages (e.g., the chat a
+        client sends with its next turn)
+        """
+        return len(self) <= len(messages) and all(
+            ROLES[role] == message.role and content == message.content
+            for role, content, message in zip(self._roles, self._contents, messages)
+        )
+
+    def message(self, i: int) -> ChatMessage:
+        return ChatMessage(role=ROLES[self._roles[i]], content=self._contents[i])
+
+    @property
+    def messages(self) -> tuple[ChatMessage, ...]:
+        """
+        The messages as ChatMessage objects (a read-only copy, use append to add
+        messages)
+        """
+        return tuple(self.message(i) for i in range(len(self)))
+
+    def _render(
+        self, tokenizer, indices: list[int], add_generation_prompt: bool = False
+    ) -> str:
+        if not indices:
+            # chat templates cannot render an empty chat
+            return ""
+        return tokenizer.apply_chat_template(
+            [
+                {"role": ROLES[self._roles[i]], "content": self._contents[i]}
+                for i in indices
+            ],
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt,
+        )
+
+    def _context(self, i: int) -> list[int]:
+        """
+        Indices of the messages rendered before message i to get its segment
+        """
+        n_system = 1 if self._roles and ROLES[self._roles[0]] == "system" else 0
+        if i <= n_system + 1:
+            return list(range(i))
+        # keep message i at a position of the same parity, as some templates check that
+        # roles alternate
+        start = i if (i - n_system - 1) % 2 == 0 else i - 1
+        return list(range(n_system + 1)) + list(range(start, i))
+
+    def _system_prompt_ids(self, tokenizer, add_special_tokens: bool):
+        """
+        Token ids (uint32 array) of the segment of the system prompt, from the prompt
+        artifact cache
+        """
+        from interact_llm.llm.prompt_artifacts import PROMPT_ARTIFACTS
+
+        def build() -> tuple[str, list[int]]:
+            text = self._render(tokenizer, [0])
+            return text, tokenizer(text, add_special_tokens=add_special_tokens)[
+                "input_ids"
+            ]
+
+        _, ids = PROMPT_ARTIFACTS.get_or_build(
+            tokenizer, self._prompt_key, self._contents[0], add_special_tokens, build
+        )
+
+        return ids
+
+    def _tokenize_pending(self, tokenizer, add_special_tokens: bool) -> None:
+        """
+        Render and tokenize the segments of the messages appended since the last call
+        """
+        binding = self._binding
+        if (
+            binding is None
+            or binding[0]() is not tokenizer
+            or binding[1] != add_special_tokens
+        ):
+            self._ids = array("I")
+            self._ends = array("I")
+            self._suffix = None
+            self._incremental = True
+            self._verified = False
+            self._binding = (weakref.ref(tokenizer), add_special_tokens)
+
+        for i in range(len(self._ends), len(self)):
+            if (
+                i == 0
+                and self._prompt_key is not None
+                and self._roles[0] == ROLES.index("system")
+            ):
+                # the system prompt segment is shared with every chat with the same
+                # prompt (and cached on disk)
+                self._ids.frombytes(
+                    self._system_prompt_ids(tokenizer, add_special_tokens).tobytes()
+                )
+                self._ends.append(len(self._ids))
+                continue
+
+            context = self._context(i)
+            previous = self._render(tokenizer, context) if context else ""
+            text = self._render(tokenizer, context + [i])
+
+            if not text.startswith(previous):
+                self._incremental = False
+                return
+
+            ids = tokenizer(
+                text[len(previous) :], add_special_tokens=add_special_tokens and i == 0
+            )["input_ids"]
+            self._ids.extend(ids)
+            self._ends.append(len(self._ids))
+
+    def input_ids(
+        self,
+        tokenizer,
+        add_generation_prompt: bool = True,
+        add_special_tokens: bool = True,
+    ) -> list[int]:
+        """
+        Token ids of the chat rendered with the chat template of tokenizer. The ids are
+        tokenized message by message, and compared once per tokenizer to tokenizing the
+        full rendered chat (which is used from then on if they differ). Segments can
+        still tokenize differently at message boundaries in later turns.
+
+        Args:
+            tokenizer: HF tokenizer with a chat template.
+            add_generation_prompt: Whether to end with the start of an assistant turn.
+            add_special_tokens: Whether the tokenizer adds its special tokens (e.g.,
+                BOS) in front of the rendered chat.
+        """
+        if self._incremental:
+            self._tokenize_pending(tokenizer, add_special_tokens)
+
+        if not self._incremental or not self:
+            return self._full_input_ids(
+                tokenizer, add_generation_prompt, add_special_tokens
+            )
+
+        if not add_generation_prompt:
+            return self._verify(
+                tokenizer, self._ids.tolist(), add_generation_prompt, add_special_tokens
+            )
+
+        if self._suffix is None:
+            indices = self._context(len(self) - 1) + [len(self) - 1]
+            text = self._render(tokenizer, indices)
+            prompt_text = self._render(tokenizer, indices, add_generation_prompt=True)
+            self._suffix = array(
+                "I",
+                tokenizer(prompt_text[len(text) :], add_special_tokens=False)[
+                    "input_ids"
+                ],
+            )
+
+        return self._verify(
+            tokenizer,
+            self._ids.tolist() + self._suffix.tolist(),
+            add_generation_prompt,
+            add_special_tokens,
+        )
+
+    def _full_input_ids(
+        self, tokenizer, add_generation_prompt: bool, add_special_tokens: bool
+    ) -> list[int]:
+        text = self._render(tokenizer, list(range(len(self))), add_generation_prompt)
+        return tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+
+    def _verify(
+        self,
+        tokenizer,
+        ids: list[int],
+        add_generation_prompt: bool,
+        add_special_tokens: bool,
+    ) -> list[int]:
+        """
+        Compare the incremental ids to the full rendered chat on the first call for a
+        tokenizer, and stop tokenizing incrementally if they differ
+        """
+        if self._verified:
+            return ids
+
+        self._verified = True
+        full_ids = self._full_input_ids(
+            tokenizer, add_generation_prompt, add_special_tokens
+        )
+        if ids != full_ids:
+            print(
+                "[WARNING]: Tokenizing the chat message by message differs from "
+                "tokenizing the full chat, falling back to the full chat"
+            )
+            self._incremental = False
+            return full_ids
+
+        return ids
@@ -0,0 +1,78 @@
+"""
+Model config data (entries of configs/models.toml)
+"""
+
+from typing import Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+
+# CPU weight quantization of HF models (see interact_llm/llm/quantization.py)
+QUANTIZATION_METHODS = ("int8", "int4")
+
+
+class PlacementProfile(BaseModel):
+    """
+    Model for a placement profile in configs/models.toml: where the weights of a HF
+    model go (resolved against the available memory by interact_llm/llm/placement.py)
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    name: str
+    # CPU only, the first visible GPU, or all visible GPUs
+    devices: Literal["cpu", "single", "multi"]
+    max_memory_per_device: Optional[str] = None  # cap per GPU, e.g., "48GB"
+    # layers that do not fit on the GPUs may use this much RAM (all available RAM minus
+    # the reserve if unset)
+    max_cpu_memory: Optional[str] = None
+    # layers that fit in neither are offloaded to disk here
+    offload_folder: Optional[str] = None
+    # fraction of free memory kept for the KV cache and activations
+    reserve: float = Field(default=0.1, ge=0, lt=1)
+
+
+class ModelConfig(BaseModel):
+    """
+    Model for a model entry in configs/models.toml (unknown keys are rejected to catch
+    typos early)
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    name: str
+    mlx: Optional[str] = None
+    hf: Optional[str] = None
+    draft_mlx: Optional[str] = None
+    draft_hf: Optional[str] = None
+    quantization_hf: Optional[str] = None
+    placement_hf: Optional[str] = None  # name of a placement profile
+    # written by benchmarks/bench_generation.py --record
+    measured: dict[str, dict[str, float | str]] = {}
+
+    @field_validator("quantization_hf")
+    @classmethod
+    def check_quantization(cls, quantization: Optional[str]) -> Optional[str]:
+        if quantization is not None and quantization not in (
+            *QUANTIZATION_METHODS,
+            "none",
+        ):
+            raise ValueError(
+                f"quantization must be one of {QUANTIZATION_METHODS} or 'none', got "
+                f"'{quantization}'"
+            )
+        return quantization
+
+    @model_validator(mode="after")
+    def check_backends(self) -> "ModelConfig":
+        if self.mlx is None and self.hf is None:
+            raise ValueError(
+                f"Model '{self.name}' has no backend entry ('mlx' or 'hf')"
+            )
+        return self
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Value of a key of the entry (e.g., a backend, "draft_hf", "quantization_hf" or
+        "placement_hf"), None if it is not set
+        """
+        return getattr(self, key, None)
@@ -3,8 +3,8 @@ Prompt formatting with meta data (to load configs)
 """
 
 from pathlib import Path
+from typing import Optional
 
-import toml
 from pydantic import BaseModel, Field
 
 
@@ -15,6 +15,8 @@ class Prompt(BaseModel):
 
     id: str
     content: str
+    # stem of the TOML file the prompt was loaded from, e.g., "v3.0"
+    version: Optional[str] = None
 
 
 class SystemPrompt(Prompt):
@@ -29,7 +31,9 @@ def load_prompt_by_id(
     toml_path: Path, prompt_id: str, system_prompt: bool = True
 ) -> Prompt | SystemPrompt | None:
     """
-    Load a prompt by its ID from a TOML file and return it as either a SystemPrompt or a regular Prompt.
+    Load a prompt by its ID from a TOML file and return it as either a SystemPrompt or a
+    regular Prompt. The file is parsed once and cached by the config registry (see
+    interact_llm/utils/config_registry.py).
 
     Args:
         toml_path (Path): Path to the TOML file.
@@ -39,17 +43,16 @@ def load_prompt_by_id(
     Returns:
         Prompt | SystemPrompt | None: The requested prompt if found, otherwise None.
     """
-    data = toml.load(toml_path)
-
-    for p in data.get("prompts", []):
-        if p["id"] == prompt_id:
-            # make data into prompt
-            prompt = Prompt.model_validate(p)
-            return (
-                SystemPrompt(id=prompt.id, content=prompt.content)
-                if system_prompt
-                else prompt
-            )
+    from interact_llm.utils.config_registry import CONFIG_REGISTRY
+
+    prompt = CONFIG_REGISTRY.prompts(toml_path).get(prompt_id)
+
+    if prompt is not None:
+        return (
+            SystemPrompt(id=prompt.id, content=prompt.content, version=prompt.version)
+            if system_prompt
+            else prompt.model_copy()  # the cached prompt is shared
+        )
 
     # print warning and return none if no prompt with ID found
     print(
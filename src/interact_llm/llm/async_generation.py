@@ -0,0 +1,235 @@
+"""
+Asyncio interface for the backends: agenerate, agenerate_stream, agenerate_candidates,
+agenerate_batch and agenerate_batch_stream run the blocking methods in a bounded
+executor, so that many conversations can be interleaved under one event loop (language
+detection and disk writes then overlap with decoding of another conversation's turn)
+"""
+
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+from typing import AsyncIterator, Callable, Optional
+
+from interact_llm.data_models.chat import ChatMessage
+
+_DONE = object()
+
+
+class BoundedExecutor:
+    """
+    Thread pool with back-pressure: at most max_pending calls are submitted at a time,
+    further callers wait (without queuing work) until a slot frees up
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_pending: int = 8,
+        thread_name_prefix: str = "generate",
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+        self._slots: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def slots(self) -> asyncio.Semaphore:
+        """
+        Semaphore of the running event loop (asyncio primitives are bound to one loop)
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._slots:
+            self._slots[loop] = asyncio.Semaphore(self.max_pending)
+        return self._slots[loop]
+
+    async def submit(self, fn: Callable, *args, **kwargs):
+        # the call runs in the context of the caller (e.g., with its telemetry labels),
+        # as with asyncio.to_thread
+        context = contextvars.copy_context()
+        async with self.slots():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(context.run, fn, *args, **kwargs)
+            )
+
+    async def stream(
+        self, fn: Callable, *args, max_buffered: int = 64, **kwargs
+    ) -> AsyncIterator:
+        """
+        Iterate a blocking generator function in the executor. The worker blocks once
+        max_buffered items are waiting to be consumed, so a slow consumer slows down the
+        producer rather than growing the buffer.
+
+        fn is called with a threading.Event that is set when the consumer stops early
+        (e.g., to stop generating).
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffered)
+        cancelled = threading.Event()
+
+        def produce() -> None:
+            try:
+                # closed explicitly on an early stop, so the generator cleans up (e.g.,
+                # joins its generation thread) before the worker is released
+                with closing(fn(*args, cancelled=cancelled, **kwargs)) as items:
+                    for item in items:
+                        if cancelled.is_set():
+                            break
+                        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            except Exception as e:
+                asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+            asyncio.run_coroutine_threadsafe(queue.put(_DONE), loop).result()
+
+        async with self.slots():
+            task = loop.run_in_executor(
+                self.executor, contextvars.copy_context().run, produce
+            )
+            try:
+                while (item := await queue.get()) is not _DONE:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                cancelled.set()
+                # unblock the worker until it has finished
+                while not task.done():
+                    try:
+                        await asyncio.wait_for(queue.get(), 0.1)
+                    except asyncio.TimeoutError:
+                        pass
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class AsyncGenerationMixin:
+    """
+    agenerate* methods for a backend with generate, generate_stream, generate_candidates
+    and (optionally) generate_batch and generate_batch_stream.
+
+    Calls run one at a time in a worker thread per backend (a loaded model is not
+    thread-safe), with at most max_pending calls waiting for it.
+    """
+
+    max_concurrency = 1  # worker threads
+    max_pending = 8
+
+    def _executor(self) -> BoundedExecutor:
+        executor = self.__dict__.get("_bounded_executor")
+        if executor is None:
+            executor = BoundedExecutor(self.max_concurrency, self.max_pending)
+            self._bounded_executor = executor
+        return executor
+
+    async def agenerate(
+        self,
+        chat,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        """
+        Async version of generate
+        """
+        return await self._executor().submit(
+            self.generate,
+            chat,
+            max_new_tokens,
+            sampling_params,
+            penalty_params,
+            stop_on=stop_on,
+        )
+
+    async def agenerate_stream(
+        self,
+        chat,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Async version of generate_stream. If the consumer stops iterating early,
+        generation stops at the end of the current sentence.
+        """
+
+        def stream(cancelled: threading.Event):
+            def stop(sentence: str) -> bool:
+                return cancelled.is_set() or (stop_on is not None and stop_on(sentence))
+
+            yield from self.generate_stream(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on=stop
+            )
+
+        async for chunk in self._executor().stream(stream):
+            yield chunk
+
+    async def agenerate_candidates(
+        self,
+        chat,
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Async version of generate_candidates
+        """
+        return await self._executor().submit(
+            self.generate_candidates,
+            chat,
+            n_candidates,
+            max_new_tokens,
+            sampling_params,
+            penalty_params,
+            stop_on=stop_on,
+        )
+
+    async def agenerate_batch(
+        self,
+        chats: list,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Async version of generate_batch
+        """
+        return await self._executor().submit(
+            self.generate_batch,
+            chats,
+            max_new_tokens,
+            sampling_params,
+            penalty_params,
+            stop_on=stop_on,
+        )
+
+    async def agenerate_batch_stream(
+        self,
+        chats: list,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> AsyncIterator[tuple[int, str]]:
+        """
+        Async version of generate_batch_stream. If the consumer stops iterating early,
+        generation of the whole batch stops.
+        """
+
+        def stream(cancelled: threading.Event):
+            yield from self.generate_batch_stream(
+                chats, max_new_tokens, sampling_params, penalty_params, stop_on=stop_on
+            )
+
+        async for chunk in self._executor().stream(stream):
+            yield chunk
@@ -0,0 +1,219 @@
+"""
+Token budget for the chat history sent to a model in long conversations
+"""
+
+from typing import Callable, Optional
+
+from interact_llm.data_models.chat import ChatHistory, ChatMessage
+
+SUMMARY_TEMPLATE = "Summary of the earlier conversation:\n{summary}"
+SUMMARY_INSTRUCTION = (
+    "Summarise the following conversation between a language tutor and a student in a "
+    "few sentences. "
+    "Keep the topics discussed, facts the student shared about themselves and the "
+    "mistakes the student made."
+)
+
+
+def token_counter(model) -> Callable[[str], int]:
+    """
+    Count the tokens of a text with the tokenizer of a loaded backend (ChatHF,
+    ChatHFGemma or ChatMLX). Backends without a local tokenizer (ChatHTTP) get an
+    estimate of 4 characters per token.
+    """
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None and hasattr(model, "processor"):
+        tokenizer = model.processor.tokenizer
+
+    if tokenizer is None:
+        return lambda text: len(text) // 4 + 1
+
+    def count_tokens(text: str) -> int:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    return count_tokens
+
+
+def make_model_summariser(
+    model, max_new_tokens: int = 256, instruction: str = SUMMARY_INSTRUCTION
+) -> Callable[[Optional[str], list[ChatMessage]], str]:
+    """
+    Summariser for ContextWindow that asks the model itself to summarise the dropped
+    turns (folding in the summary of turns dropped earlier)
+    """
+
+    def summarise(previous_summary: Optional[str], messages: list[ChatMessage]) -> str:
+        transcript = "\n".join(
+            f"{message.role}: {message.content}" for message in messages
+        )
+        if previous_summary:
+            transcript = f"Earlier summary: {previous_summary}\n\n{transcript}"
+
+        chat = ChatHistory(
+            messages=[
+                ChatMessage(role="system", content=instruction),
+                ChatMessage(role="user", content=transcript),
+            ]
+        )
+        return model.generate(chat, max_new_tokens=max_new_tokens).content.strip()
+
+    return summarise
+
+
+class ContextWindow:
+    """
+    Keeps the chat sent to the model within a token budget: the system prompt (with an
+    optional summary of the dropped turns) followed by the most recent turns.
+
+    Token counts are computed once per message and cached on the message. Trimming uses
+    hysteresis: once the chat exceeds max_tokens, whole turns are dropped from the front
+    until it is below low_water * max_tokens, and the kept window then only grows until
+    the next trim. Between trims the rendered prompt of a turn is a prefix of the next
+    one, so the backends' KV cache reuse keeps working (the kept turns are prefilled
+    again only after a trim).
+
+    One ContextWindow serves one conversation: view() returns the same ChatHistory
+    object on every call, so the backends can keep their KV cache on it.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int = 8192,
+        low_water: float = 0.75,
+        summarise: Optional[Callable[[Optional[str], list[ChatMessage]], str]] = None,
+        summary_template: str = SUMMARY_TEMPLATE,
+        message_overhead: int = 8,
+        counter_key: str = "default",
+    ):
+        """
+        Args:
+            count_tokens: Token counter for a text (see token_counter).
+            max_tokens: Token budget of the chat sent to the model (excluding the
+                response).
+            low_water: Fraction of max_tokens the chat is trimmed down to once it
+                exceeds max_tokens.
+            summarise: Called with (previous summary, dropped messages) when turns are
+                dropped, returns the new summary (see make_model_summariser). If None,
+                dropped turns are forgotten.
+            summary_template: Format of the summary appended to the system prompt.
+            message_overhead: Tokens added per message for the chat template (role
+                markers etc.).
+            counter_key: Key of the cached token counts on the messages (counts of
+                different tokenizers differ).
+        """
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.low_water = low_water
+        self.summarise = summarise
+        self.summary_template = summary_template
+        self.message_overhead = message_overhead
+        self.counter_key = counter_key
+
+        self.summary: Optional[str] = None
+        self._start = 0  # index of the first kept message after the system prompt
+        # (system message, head message)
+        self._head: Optional[tuple[Optional[ChatMessage], ChatMessage]] = None
+        self._view = ChatHistory(messages=[])
+
+    def n_tokens(self, message: ChatMessage) -> int:
+        """
+        Token count of a message (counted once, then cached on the message)
+        """
+        counts = message._n_tokens
+        if self.counter_key not in counts:
+            counts[self.counter_key] = (
+                self.count_tokens(message.content) + self.message_overhead
+            )
+        return counts[self.counter_key]
+
+    def _head_messages(self, chat: ChatHistory) -> list[ChatMessage]:
+        """
+        The system prompt, with the summary appended if there is one (the merged message
+        is cached)
+        """
+        system_message = (
+            chat.messages[0]
+            if chat.messages and chat.messages[0].role == "system"
+            else None
+        )
+
+        if self.summary is None:
+            return [system_message] if system_message is not None else []
+
+        if self._head is None or self._head[0] is not system_message:
+            summary = self.summary_template.format(summary=self.summary)
+            content = (
+                f"{system_message.content}\n\n{summary}"
+                if system_message is not None
+                else summary
+            )
+            self._head = (system_message, ChatMessage(role="system", content=content))
+
+        return [self._head[1]]
+
+    def _head_tokens(self, chat: ChatHistory) -> int:
+        return sum(self.n_tokens(message) for message in self._head_messages(chat))
+
+    def _trim(self, chat: ChatHistory, total: int) -> None:
+        """
+        Drop whole turns from the front until the chat, including the system prompt and
+        summary, is below the low water mark (the last message, i.e., the one to respond
+        to, is always kept). If the updated summary pushes the chat back over the low
+        water mark, more turns are dropped and folded into the summary.
+        """
+        target = int(self.max_tokens * self.low_water)
+        last = len(chat.messages) - 1
+
+        n_dropped = 0
+        while True:
+            dropped = []
+            # keep dropping until the kept turns start with a user message, so roles
+            # keep alternating
+            while self._start < last and (
+                total > target or chat.messages[self._start].role != "user"
+            ):
+                message = chat.messages[self._start]
+                dropped.append(message)
+                total -= self.n_tokens(message)
+                self._start += 1
+
+            n_dropped += len(dropped)
+            if not dropped or self.summarise is None:
+                break
+
+            head_tokens = self._head_tokens(chat)
+            self.summary = self.summarise(self.summary, dropped)
+            self._head = None
+            total += self._head_tokens(chat) - head_tokens
+
+            if total <= target:
+                break
+
+        print(
+            f"[INFO]: Dropped {n_dropped} message(s) from the context window "
+            f"({len(chat.messages) - self._start} "
+            f"kept{', summary updated' if n_dropped and self.summarise else ''})"
+        )
+
+    def view(self, chat: ChatHistory) -> ChatHistory:
+        """
+        The part of chat to send to the model (the same ChatHistory object on every
+        call, updated in place)
+        """
+        n_system = 1 if chat.messages and chat.messages[0].role == "system" else 0
+        self._start = max(self._start, n_system)
+
+        total = self._head_tokens(chat) + sum(
+            self.n_tokens(message) for message in chat.messages[self._start :]
+        )
+
+        if total > self.max_tokens:
+            self._trim(chat, total)
+
+        self._view.messages = self._head_messages(chat) + chat.messages[self._start :]
+        # the shared system prompt KV state does not match a system prompt with a
+        # summary appended
+        self._view._prompt_key = chat.prompt_key if self.summary is None else None
+
+        return self._view
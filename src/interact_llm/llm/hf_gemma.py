@@ -1,17 +1,39 @@
 """
-HF wrapper for Gemma 
+HF wrapper for Gemma
 """
 
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional
+from threading import Event, Thread
+from typing import Callable, Iterator, Optional
 
 import torch
-from transformers import AutoProcessor, Gemma3ForConditionalGeneration
+from transformers import (
+    AutoModelForCausalLM,
+    AutoProcessor,
+    Gemma3ForConditionalGeneration,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 
-from interact_llm.data_models.chat import ChatMessage
+from interact_llm.data_models.chat import ChatHistory, ChatMessage, CompactChatHistory
+from interact_llm.data_models.model_config import PlacementProfile
+from interact_llm.llm.async_generation import AsyncGenerationMixin
+from interact_llm.llm.hf_stopping import EventStoppingCriteria, SentenceStoppingCriteria
+from interact_llm.llm.placement import (
+    format_device_map,
+    format_placement,
+    resolve_placement,
+)
+from interact_llm.llm.script_mask import make_hf_script_processor, split_script_params
+from interact_llm.llm.snapshot import local_snapshot
+from interact_llm.llm.speculative import DraftCounter, DraftStats
+from interact_llm.llm.telemetry import Telemetry, count_new_tokens, torch_memory_probe
 
 
-class ChatHFGemma:
+class ChatHFGemma(AsyncGenerationMixin):
     """
     Model wrapper for loading and using a HuggingFace causal language model with HF's own libraries
     """
@@ -22,15 +44,36 @@ class ChatHFGemma:
         cache_dir: Optional[Path] = None,
         sampling_params: Optional[dict] = None,
         penalty_params: Optional[dict] = None,
-        max_memory: Optional[dict] = {0: "48GB", 1: "48GB"} # specify the amount of GPUs and their vrams - Gemma needs this to be able to use 2 gpus (it is too slow on a single)
+        torch_dtype: Optional[str] = "auto",
+        device_map: str = "auto",
+        draft_model_id: Optional[str] = None,
+        placement: Optional[PlacementProfile] = None,
+        offline: bool = False,
     ):
         self.model_id = model_id
         self.cache_dir = cache_dir
-        self.processor = None # multi-modal model does not have a tokenizer, but a processor 
+        # multi-modal model does not have a tokenizer, but a processor
+        self.processor = None
         self.model = None
         self.sampling_params = sampling_params
         self.penalty_params = penalty_params
-        self.max_memory = max_memory
+        # "auto" keeps the dtype of the weights (bfloat16), so they are not converted
+        self.torch_dtype = torch_dtype
+        self.device_map = device_map
+        # small text-only Gemma 3 with the same tokenizer for assisted decoding
+        self.draft_model_id = draft_model_id
+        self.draft_model = None
+        self.draft_stats = DraftStats()
+        # (disallowed scripts, script penalty) -> logits processor
+        self._script_processors = {}
+        # placement profile (see configs/models.toml), resolved once against the free
+        # memory in place of device_map. Gemma 3 12B is too slow on a single GPU, so it
+        # is configured with a multi-GPU profile
+        self.placement = placement
+        # load from the downloaded snapshot without any request to the HF Hub
+        self.offline = offline
+        # per-call records, see llm/telemetry.py
+        self.telemetry = Telemetry("hf", model_id, torch_memory_probe())
 
     def load(self) -> None:
         """
@@ -38,58 +81,149 @@ class ChatHFGemma:
         """
         if self.processor is None:
             self.processor = AutoProcessor.from_pretrained(
-                self.model_id, cache_dir=self.cache_dir, use_fast=True
+                self._source(self.model_id), cache_dir=self.cache_dir, use_fast=True
             )
 
         if self.model is None:
-            try:
-                self.model = Gemma3ForConditionalGeneration.from_pretrained(
-                    self.model_id, device_map="auto", cache_dir=self.cache_dir, 
-                    max_memory=self.max_memory
-                ).eval()
-            except Exception as e:
-                print(f"Failed to load model with max_memory={self.max_memory}. Error: {e}")
-                print("Retrying without max_memory...")
-                try:
-                    self.model = Gemma3ForConditionalGeneration.from_pretrained(
-                        self.model_id, device_map="auto", cache_dir=self.cache_dir
-                    ).eval()
-                except Exception as e:
-                    print(f"Model loading failed even without max_memory. Error: {e}")
-                    raise
+            if self.placement is None:
+                placement_kwargs = {"device_map": self.device_map}
+            else:
+                placement_kwargs = resolve_placement(self.placement)
+                print(
+                    f"[INFO]: Placement '{self.placement.name}': "
+                    f"{format_placement(placement_kwargs)}"
+                )
 
-    
+            start = time.perf_counter()
+            self.model = Gemma3ForConditionalGeneration.from_pretrained(
+                self._source(self.model_id),
+                cache_dir=self.cache_dir,
+                torch_dtype=self.torch_dtype,
+                **placement_kwargs,
+            ).eval()
+            print(
+                f"[INFO]: Loaded {self.model_id} in "
+                f"{time.perf_counter() - start:.1f}s ({format_device_map(self.model)})"
+            )
 
-    def format_params(self):
-        if self.sampling_params:
-            # normalise "temp" to "temperature" (ensures you can pass temp to the model as this is how MLX/HF defines it)
-            if "temp" in self.sampling_params:
-                self.sampling_params["temperature"] = self.sampling_params.pop("temp")
+        if self.draft_model_id is not None and self.draft_model is None:
+            # the draft model is small, so it goes next to the input embeddings of the
+            # main model
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                self._source(self.draft_model_id),
+                device_map={"": str(self.model.device)},
+                cache_dir=self.cache_dir,
+                torch_dtype=self.torch_dtype,
+            ).eval()
 
-            kwargs = self.sampling_params
-        else:
-            kwargs = {}
+    def _source(self, model_id: str) -> str:
+        """
+        What from_pretrained loads: the model id, or its local snapshot directory in
+        offline mode
+        """
+        return local_snapshot(model_id, self.cache_dir) if self.offline else model_id
+
+    def format_params(
+        self,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+    ) -> dict:
+        """
+        Merge sampling and penalty params into kwargs for generate. Params passed per
+        call take precedence over the ones passed at init (which serve as defaults).
+
+        The penalty params "disallowed_scripts" and "script_penalty" become a logits
+        processor that masks (or down-weights) tokens of those scripts (see
+        interact_llm/llm/script_mask.py).
+        """
+        sampling_params = (
+            self.sampling_params if sampling_params is None else sampling_params
+        )
+        penalty_params = (
+            self.penalty_params if penalty_params is None else penalty_params
+        )
+        penalty_params, script_params = split_script_params(penalty_params)
+
+        kwargs = dict(sampling_params) if sampling_params else {}
+
+        # normalise "temp" to "temperature" (ensures you can pass temp to the model as this is how MLX/HF defines it)
+        if "temp" in kwargs:
+            kwargs["temperature"] = kwargs.pop("temp")
+
+        if penalty_params:
+            kwargs.update(penalty_params)
 
-        if self.penalty_params:
-            kwargs.update(self.penalty_params)
+        if script_params.get("disallowed_scripts"):
+            key = (
+                tuple(script_params["disallowed_scripts"]),
+                script_params.get("script_penalty"),
+            )
+            if key not in self._script_processors:
+                self._script_processors[key] = make_hf_script_processor(
+                    self.processor.tokenizer, *key
+                )
+            kwargs["logits_processor"] = LogitsProcessorList(
+                [self._script_processors[key]]
+            )
 
         return kwargs
 
-    def format_chat_for_gemma(self, chat: list[ChatMessage]) -> list[dict]:
+    def format_chat_for_gemma(
+        self, chat: ChatHistory | CompactChatHistory
+    ) -> list[dict]:
         formatted_chat = []
 
         for msg in chat.messages:
-            formatted_chat.append({
-                "role": msg.role,
-                "content": [{"type": "text", "text": msg.content}]
-            })
+            # formatted once per message rather than on every turn
+            if msg._formatted is None:
+                msg._formatted = {
+                    "role": msg.role,
+                    "content": [{"type": "text", "text": msg.content}],
+                }
+            formatted_chat.append(msg._formatted)
 
         return formatted_chat
 
-    def generate(self, chat: list[ChatMessage], max_new_tokens: int = 3000):
-        kwargs = self.format_params()
+    def _tokenize_compact(self, chats: list[CompactChatHistory]) -> dict:
+        """
+        Model inputs of compact histories from their cached token ids (only new messages
+        are tokenized), left-padded like the output of the processor's
+        apply_chat_template
+        """
+        tokenizer = self.processor.tokenizer
+        # nothing left to tokenize
+        tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
+
+        return tokenizer.pad(
+            [
+                {"input_ids": chat.input_ids(tokenizer, add_special_tokens=False)}
+                for chat in chats
+            ],
+            return_tensors="pt",
+            padding_side="left",
+            # params to fix flash attn error: https://github.com/google-deepmind/gemma/issues/169
+            padding="longest",
+            pad_to_multiple_of=8,
+        ).to(self.model.device)
+
+    def _prepare_generate(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+        num_return_sequences: int = 1,
+    ) -> dict:
+        """
+        Tokenize the chat and collect all kwargs for model.generate (shared by generate,
+        generate_stream and generate_candidates)
+        """
+        kwargs = self.format_params(sampling_params, penalty_params)
 
-        if len(kwargs) > 0:
+        if num_return_sequences > 1:
+            do_sample = True  # greedy decoding would return the same sequence n times
+        elif len(kwargs) > 0:
             do_sample = True
         else:
             do_sample = False
@@ -97,38 +231,284 @@ class ChatHFGemma:
                 "[INFO:] No sampling parameters nor penalty parameters were passed. Setting do_sample to 'False'"
             )
 
-        self.processor.use_default_system_prompt = False # ensure no system prompt is there
+        # ensure no system prompt is there
+        self.processor.use_default_system_prompt = False
+
+        if isinstance(chat, CompactChatHistory):
+            model_inputs = self._tokenize_compact([chat])
+        else:
+            model_inputs = self.processor.apply_chat_template(
+                self.format_chat_for_gemma(chat),
+                tokenize=True,
+                return_dict=True,
+                add_generation_prompt=True,
+                return_tensors="pt",
+                # params to fix flash attn error: https://github.com/google-deepmind/gemma/issues/169
+                padding="longest",
+                pad_to_multiple_of=8,
+            ).to(self.model.device)
 
-        formatted_chat = self.format_chat_for_gemma(chat)
-       
-        model_inputs = self.processor.apply_chat_template(
-            formatted_chat,
-            tokenize=True,
-            return_dict=True,
-            add_generation_prompt=True,
-            return_tensors = "pt",
-            # params to fix flash attn error: https://github.com/google-deepmind/gemma/issues/169
-            padding="longest",
-            pad_to_multiple_of=8, 
-        ).to(self.model.device, dtype=torch.bfloat16)
-        
         # fix flash attn error: https://github.com/google-deepmind/gemma/issues/169
         self.processor.tokenizer.padding_side = "left"
 
-        input_len = model_inputs["input_ids"].shape[-1]
-        
-        with torch.inference_mode(): 
-            output = self.model.generate(
-                **model_inputs,
+        generate_kwargs = {
+            **model_inputs,
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            **kwargs,
+        }
+
+        if num_return_sequences > 1:
+            generate_kwargs["num_return_sequences"] = num_return_sequences
+        elif self.draft_model is not None:
+            # assisted decoding only supports a single sequence
+            generate_kwargs["assistant_model"] = self.draft_model
 
-                max_new_tokens=max_new_tokens,
-                do_sample=do_sample,
-                **kwargs,
+        if stop_on is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [
+                    SentenceStoppingCriteria(
+                        self.processor.tokenizer,
+                        model_inputs["input_ids"].shape[-1],
+                        stop_on,
+                        batch_size=num_return_sequences,
+                    )
+                ]
+            )
+
+        return generate_kwargs
+
+    def _draft_counter(self) -> DraftCounter | nullcontext:
+        """
+        Counter of target and draft forward calls for one generate call (a no-op context
+        without a draft model)
+        """
+        if self.draft_model is None:
+            return nullcontext()
+        return DraftCounter(self.model, self.draft_model)
+
+    def _record_draft_stats(
+        self, counter: DraftCounter | nullcontext, n_new_tokens: int
+    ) -> None:
+        if self.draft_model is None:
+            return
+        call_stats = counter.stats(n_new_tokens)
+        self.draft_stats.add(call_stats)
+
+    def generate(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        """
+        Generate a response. If stop_on is given, it is called with every finished
+        sentence during decoding and generation stops early (returning the response so
+        far) as soon as it returns True.
+        """
+        with self.telemetry.track("generate") as call:
+            generate_kwargs = self._prepare_generate(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on
             )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len
+
+            counter = self._draft_counter()
+            with torch.inference_mode(), counter, call.hook(self.model):
+                output = self.model.generate(**generate_kwargs)
+            call.record.generated_tokens = output.shape[-1] - input_len
+        self._record_draft_stats(counter, output.shape[-1] - input_len)
 
         # chat (decoded output)
-        response = self.processor.decode(output[0][input_len:], skip_special_tokens=True)
+        response = self.processor.decode(
+            output[0][input_len:], skip_special_tokens=True
+        )
 
         chat_message = ChatMessage(role="assistant", content=response)
+        self.telemetry.attach([chat_message], call.record)
 
         return chat_message
+
+    def generate_stream(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        Generate a response, yielding decoded text chunks as soon as they are produced.
+        Generation runs in a background thread that feeds a TextIteratorStreamer (see
+        generate for stop_on).
+        """
+        with self.telemetry.track("generate_stream") as call:
+            generate_kwargs = self._prepare_generate(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len
+            streamer = TextIteratorStreamer(
+                self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+
+            errors = []
+            outputs = []
+            counter = self._draft_counter()
+
+            def _generate():
+                try:
+                    # inference mode is thread-local, so it is entered in the generation
+                    # thread
+                    with torch.inference_mode(), counter, call.hook(self.model):
+                        outputs.append(
+                            self.model.generate(**generate_kwargs, streamer=streamer)
+                        )
+                except Exception as e:
+                    errors.append(e)
+                    streamer.end()  # unblock the consumer
+
+            # set when the consumer stops iterating early (closing this generator)
+            closed = Event()
+            generate_kwargs.setdefault(
+                "stopping_criteria", StoppingCriteriaList()
+            ).append(EventStoppingCriteria(closed))
+
+            thread = Thread(target=_generate)
+            thread.start()
+
+            try:
+                yield from streamer
+            finally:
+                # stop and wait for the generation thread, so the model is free for
+                # the next call
+                closed.set()
+                thread.join()
+
+            if errors:
+                raise errors[0]
+
+            call.record.generated_tokens = outputs[0].shape[-1] - input_len
+
+        self._record_draft_stats(counter, outputs[0].shape[-1] - input_len)
+
+    def generate_candidates(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Sample n_candidates responses to the same chat in a single generate call
+        (num_return_sequences), so the prompt is prefilled once. Always samples, and
+        does not use the draft model. With stop_on (see generate), each candidate stops
+        on its own.
+        """
+        with self.telemetry.track(
+            "generate_candidates", batch_size=n_candidates
+        ) as call:
+            generate_kwargs = self._prepare_generate(
+                chat,
+                max_new_tokens,
+                sampling_params,
+                penalty_params,
+                stop_on,
+                num_return_sequences=n_candidates,
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len  # prefilled once for all candidates
+
+            with torch.inference_mode(), call.hook(self.model):
+                output = self.model.generate(**generate_kwargs)
+            call.record.generated_tokens = count_new_tokens(
+                output, input_len, self.processor.tokenizer.pad_token_id
+            )
+
+        responses = self.processor.batch_decode(
+            output[:, input_len:], skip_special_tokens=True
+        )
+
+        messages = [
+            ChatMessage(role="assistant", content=response) for response in responses
+        ]
+        self.telemetry.attach(messages, call.record)
+
+        return messages
+
+    def generate_batch(
+        self,
+        chats: list[ChatHistory | CompactChatHistory],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Generate a response for each of several independent chats with a single
+        left-padded generate call (without the draft model, as assisted decoding only
+        supports a batch size of 1). With stop_on (see generate), each sequence stops on
+        its own while the rest of the batch continues.
+        """
+        with self.telemetry.track("generate_batch", batch_size=len(chats)) as call:
+            kwargs = self.format_params(sampling_params, penalty_params)
+            do_sample = len(kwargs) > 0
+
+            # ensure no system prompt is there
+            self.processor.use_default_system_prompt = False
+            self.processor.tokenizer.padding_side = "left"
+
+            if all(isinstance(chat, CompactChatHistory) for chat in chats):
+                model_inputs = self._tokenize_compact(chats)
+            else:
+                model_inputs = self.processor.apply_chat_template(
+                    [self.format_chat_for_gemma(chat) for chat in chats],
+                    tokenize=True,
+                    return_dict=True,
+                    add_generation_prompt=True,
+                    return_tensors="pt",
+                    # params to fix flash attn error: https://github.com/google-deepmind/gemma/issues/169
+                    padding="longest",
+                    pad_to_multiple_of=8,
+                ).to(self.model.device)
+
+            input_len = model_inputs["input_ids"].shape[-1]
+            call.record.prompt_tokens = int(model_inputs["attention_mask"].sum())
+
+            if stop_on is not None:
+                kwargs["stopping_criteria"] = StoppingCriteriaList(
+                    [
+                        SentenceStoppingCriteria(
+                            self.processor.tokenizer,
+                            input_len,
+                            stop_on,
+                            batch_size=len(chats),
+                        )
+                    ]
+                )
+
+            with torch.inference_mode(), call.hook(self.model):
+                output = self.model.generate(
+                    **model_inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=do_sample,
+                    **kwargs,
+                )
+            call.record.generated_tokens = count_new_tokens(
+                output, input_len, self.processor.tokenizer.pad_token_id
+            )
+
+        responses = self.processor.batch_decode(
+            output[:, input_len:], skip_special_tokens=True
+        )
+
+        messages = [
+            ChatMessage(role="assistant", content=response) for response in responses
+        ]
+        self.telemetry.attach(messages, call.record)
+
+        return messages
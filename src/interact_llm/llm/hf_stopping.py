@@ -0,0 +1,89 @@
+"""
+Stopping criterion for HF generate built on the sentence checks in
+interact_llm/llm/stopping.py
+"""
+
+from threading import Event
+from typing import Callable
+
+import torch
+from transformers import StoppingCriteria
+
+from interact_llm.llm.stopping import SENTENCE_END, SentenceMonitor
+
+
+class SentenceStoppingCriteria(StoppingCriteria):
+    """
+    Stopping criterion for HF generate that stops a sequence once one of its finished
+    sentences fails detect.
+
+    The generated text is only decoded when the newly added tokens contain a sentence
+    delimiter. Works for batches (every row has its own monitor, rows stop
+    independently).
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_len: int,
+        detect: Callable[[str], bool],
+        batch_size: int = 1,
+    ):
+        """
+        Args:
+            tokenizer: Tokenizer used to decode the generated ids.
+            prompt_len: Length of the (padded) prompt, generated ids start after it.
+            detect: Called with each finished sentence, returns True if the sequence
+                should stop.
+            batch_size: Number of sequences generated at once.
+        """
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.monitors = [SentenceMonitor(detect) for _ in range(batch_size)]
+        self.n_seen = prompt_len
+
+    @property
+    def triggered(self) -> list[bool]:
+        return [monitor.triggered for monitor in self.monitors]
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        stop = []
+        for row, monitor in zip(input_ids, self.monitors):
+            if not monitor.triggered:
+                # several tokens can be added per step (e.g., speculative decoding)
+                new_text = self.tokenizer.decode(
+                    row[self.n_seen :], skip_special_tokens=True
+                )
+                if SENTENCE_END.search(new_text):
+                    monitor.check(
+                        self.tokenizer.decode(
+                            row[self.prompt_len :], skip_special_tokens=True
+                        )
+                    )
+            stop.append(monitor.triggered)
+
+        self.n_seen = input_ids.shape[-1]
+
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+class EventStoppingCriteria(StoppingCriteria):
+    """
+    Stopping criterion for HF generate that stops all sequences once event is set (e.g.,
+    when the consumer of a streamed generation stops early)
+    """
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],),
+            self.event.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
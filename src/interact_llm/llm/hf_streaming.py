@@ -0,0 +1,75 @@
+"""
+Streamer for HF generate that streams every row of a batch (TextIteratorStreamer only
+supports a batch size of 1)
+"""
+
+from queue import Queue
+from typing import Iterator, Optional
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+
+class BatchTextIteratorStreamer(BaseStreamer):
+    """
+    Iterator over the (row, text) chunks of a batched generate call, in the order they
+    are produced.
+
+    As with TextIteratorStreamer, a row's text is only released up to its last space (or
+    newline), so that tokens which decode differently once followed by others are not
+    emitted too early. The rest of each row is released when generation ends.
+    """
+
+    def __init__(self, tokenizer, batch_size: int, timeout: Optional[float] = None):
+        """
+        Args:
+            tokenizer: Tokenizer used to decode the generated ids.
+            batch_size: Number of sequences generated at once.
+            timeout: Seconds to wait for the next chunk before raising queue.Empty
+                (None waits forever).
+        """
+        self.tokenizer = tokenizer
+        self.token_caches: list[list[int]] = [[] for _ in range(batch_size)]
+        self.print_lens = [0] * batch_size
+        self.queue: Queue = Queue()
+        self.stop_signal = None
+        self.timeout = timeout
+        self.next_tokens_are_prompt = True
+
+    def put(self, value: torch.Tensor) -> None:
+        # the first call holds the (padded) prompts
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        # one token per row and step
+        for row, token in enumerate(value.reshape(len(self.token_caches), -1).tolist()):
+            self.token_caches[row].extend(token)
+            text = self.tokenizer.decode(
+                self.token_caches[row], skip_special_tokens=True
+            )
+
+            if text.endswith("\n"):
+                printable = text[self.print_lens[row] :]
+                self.token_caches[row] = []
+                self.print_lens[row] = 0
+            else:
+                printable = text[self.print_lens[row] : text.rfind(" ") + 1]
+                self.print_lens[row] += len(printable)
+
+            if printable:
+                self.queue.put((row, printable))
+
+    def end(self) -> None:
+        for row, tokens in enumerate(self.token_caches):
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            if printable := text[self.print_lens[row] :]:
+                self.queue.put((row, printable))
+            self.token_caches[row] = []
+            self.print_lens[row] = 0
+
+        self.queue.put(self.stop_signal)
+
+    def __iter__(self) -> Iterator[tuple[int, str]]:
+        while (chunk := self.queue.get(timeout=self.timeout)) is not self.stop_signal:
+            yield chunk
@@ -2,15 +2,51 @@
 Chat Model
 """
 
+import time
+from contextlib import nullcontext
+from copy import deepcopy
 from pathlib import Path
-from typing import Optional
+from threading import Event, Thread
+from typing import Callable, Iterator, Optional
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 
-from interact_llm.data_models.chat import ChatMessage
+from interact_llm.data_models.chat import ChatHistory, ChatMessage, CompactChatHistory
+from interact_llm.data_models.model_config import PlacementProfile
+from interact_llm.llm.async_generation import AsyncGenerationMixin
+from interact_llm.llm.hf_stopping import EventStoppingCriteria, SentenceStoppingCriteria
+from interact_llm.llm.hf_streaming import BatchTextIteratorStreamer
+from interact_llm.llm.kv_cache import (
+    PROMPT_PREFIX_CACHE,
+    PrefixCache,
+    cache_owner,
+    common_prefix_length,
+)
+from interact_llm.llm.placement import (
+    format_device_map,
+    format_placement,
+    resolve_placement,
+)
+from interact_llm.llm.quantization import (
+    check_quantization,
+    model_footprint_mb,
+    quantize_model,
+)
+from interact_llm.llm.script_mask import make_hf_script_processor, split_script_params
+from interact_llm.llm.snapshot import local_snapshot
+from interact_llm.llm.speculative import DraftCounter, DraftStats
+from interact_llm.llm.telemetry import Telemetry, count_new_tokens, torch_memory_probe
 
 
-class ChatHF:
+class ChatHF(AsyncGenerationMixin):
     """
     Model wrapper for loading and using a HuggingFace causal language model with HF's own libraries
     """
@@ -21,7 +57,14 @@ class ChatHF:
         cache_dir: Optional[Path] = None,
         sampling_params: Optional[dict] = None,
         penalty_params: Optional[dict] = None,
-        eos_token: Optional[str] = None
+        eos_token: Optional[str] = None,
+        reuse_kv_cache: bool = True,
+        torch_dtype: str = "auto",
+        device_map: str = "auto",
+        draft_model_id: Optional[str] = None,
+        quantization: Optional[str] = None,
+        placement: Optional[PlacementProfile] = None,
+        offline: bool = False,
     ):
         self.model_id = model_id
         self.cache_dir = cache_dir
@@ -30,6 +73,30 @@ class ChatHF:
         self.sampling_params = sampling_params
         self.penalty_params = penalty_params
         self.eos_token = eos_token
+        # keep past_key_values on the chat history between turns
+        self.reuse_kv_cache = reuse_kv_cache
+        # KV states are only reused by this instance (not by instances of the same model
+        # with another dtype, quantization or placement)
+        self.cache_owner = cache_owner(model_id)
+        self.torch_dtype = torch_dtype
+        self.device_map = device_map
+        # small model with the same tokenizer for assisted (speculative) decoding
+        self.draft_model_id = draft_model_id
+        self.draft_model = None
+        self.draft_stats = DraftStats()
+        # (disallowed scripts, script penalty) -> logits processor
+        self._script_processors = {}
+        # CPU weight quantization ("int8" or "int4", see
+        # interact_llm/llm/quantization.py), ignored on GPU
+        self.quantization = check_quantization(quantization)
+        # placement profile (see configs/models.toml), resolved once against the free
+        # memory in place of device_map
+        self.placement = placement
+        self._placement_kwargs = None
+        # load from the downloaded snapshot without any request to the HF Hub
+        self.offline = offline
+        # per-call records, see llm/telemetry.py
+        self.telemetry = Telemetry("hf", model_id, torch_memory_probe())
 
     def load(self) -> None:
         """
@@ -37,36 +104,238 @@ class ChatHF:
         """
         if self.tokenizer is None:
             self.tokenizer = AutoTokenizer.from_pretrained(
-                self.model_id, cache_dir=self.cache_dir
+                self._source(self.model_id), cache_dir=self.cache_dir
             )
 
         if self.model is None:
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_id,
+            self.model = self._load_model(self.model_id, self._resolve_placement())
+
+        if self.draft_model_id is not None and self.draft_model is None:
+            # the draft model is small, so it goes next to the input embeddings of the
+            # main model
+            self.draft_model = self._load_model(
+                self.draft_model_id, {"device_map": {"": str(self.model.device)}}
+            )
+
+    def _source(self, model_id: str) -> str:
+        """
+        What from_pretrained loads: the model id, or its local snapshot directory in
+        offline mode
+        """
+        return local_snapshot(model_id, self.cache_dir) if self.offline else model_id
+
+    def _resolve_placement(self) -> dict:
+        """
+        from_pretrained kwargs that place the model (computed once, from the placement
+        profile if one is set)
+        """
+        if self._placement_kwargs is None:
+            if self.placement is None:
+                self._placement_kwargs = {"device_map": self.device_map}
+            else:
+                self._placement_kwargs = resolve_placement(self.placement)
+                print(
+                    f"[INFO]: Placement '{self.placement.name}': "
+                    f"{format_placement(self._placement_kwargs)}"
+                )
+
+        return self._placement_kwargs
+
+    def _quantize_on_cpu(self, device_map) -> bool:
+        """
+        Whether the model is quantized (quantization runs on CPU only, so it is skipped
+        if the model goes to a GPU)
+        """
+        if self.quantization is None:
+            return False
+        if device_map != "cpu" and torch.cuda.is_available():
+            print(
+                f"[INFO]: Skipping {self.quantization} quantization (CPU only) as the "
+                "model is loaded on GPU"
+            )
+            return False
+        return True
+
+    def _load_model(self, model_id: str, placement_kwargs: dict):
+        start = time.perf_counter()
+
+        if not self._quantize_on_cpu(placement_kwargs["device_map"]):
+            # safetensors weights are memory-mapped, and "auto" keeps their dtype, so
+            # they are not copied to convert
+            model = AutoModelForCausalLM.from_pretrained(
+                self._source(model_id),
                 cache_dir=self.cache_dir,
-                torch_dtype="auto",
-                device_map="auto",
+                torch_dtype=self.torch_dtype,
+                **placement_kwargs,
             )
+            print(
+                f"[INFO]: Loaded {model_id} in {time.perf_counter() - start:.1f}s "
+                f"({format_device_map(model)})"
+            )
+            return model
 
-    def format_params(self):
-        if self.sampling_params:
-            # normalise "temp" to "temperature" (ensures you can pass temp to the model as this is how MLX/HF defines it)
-            if "temp" in self.sampling_params:
-                self.sampling_params["temperature"] = self.sampling_params.pop("temp")
+        # the quantized kernels take float32 weights
+        model = AutoModelForCausalLM.from_pretrained(
+            self._source(model_id),
+            cache_dir=self.cache_dir,
+            torch_dtype=torch.float32,
+            device_map="cpu",
+        )
+        quantize_model(model, self.quantization)
+        print(
+            f"[INFO]: Loaded {model_id} in {time.perf_counter() - start:.1f}s and "
+            f"quantized it to {self.quantization}"
+            f" ({model_footprint_mb(model):.1f} MB of weights)"
+        )
 
-            kwargs = self.sampling_params
-        else:
-            kwargs = {}
+        return model
 
-        if self.penalty_params:
-            kwargs.update(self.penalty_params)
+    def format_params(
+        self,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+    ) -> dict:
+        """
+        Merge sampling and penalty params into kwargs for generate. Params passed per
+        call take precedence over the ones passed at init (which serve as defaults).
+
+        The penalty params "disallowed_scripts" and "script_penalty" become a logits
+        processor that masks (or down-weights) tokens of those scripts (see
+        interact_llm/llm/script_mask.py).
+        """
+        sampling_params = (
+            self.sampling_params if sampling_params is None else sampling_params
+        )
+        penalty_params = (
+            self.penalty_params if penalty_params is None else penalty_params
+        )
+        penalty_params, script_params = split_script_params(penalty_params)
+
+        kwargs = dict(sampling_params) if sampling_params else {}
+
+        # normalise "temp" to "temperature" (ensures you can pass temp to the model as this is how MLX/HF defines it)
+        if "temp" in kwargs:
+            kwargs["temperature"] = kwargs.pop("temp")
+
+        if penalty_params:
+            kwargs.update(penalty_params)
+
+        if script_params.get("disallowed_scripts"):
+            key = (
+                tuple(script_params["disallowed_scripts"]),
+                script_params.get("script_penalty"),
+            )
+            if key not in self._script_processors:
+                self._script_processors[key] = make_hf_script_processor(
+                    self.tokenizer, *key
+                )
+            kwargs["logits_processor"] = LogitsProcessorList(
+                [self._script_processors[key]]
+            )
 
         return kwargs
 
-    def generate(self, chat: list[ChatMessage], max_new_tokens: int = 3000):
-        kwargs = self.format_params()
+    def _prefill_system_prompt(
+        self, chat: ChatHistory, input_ids: list[int]
+    ) -> Optional[PrefixCache]:
+        """
+        Compute the KV state of the part of input_ids that is rendered from the system
+        prompt alone
+        """
+        if chat.messages[0].role != "system":
+            return None
+
+        def build() -> tuple[str, list[int]]:
+            system_text = self.tokenizer.apply_chat_template(
+                list(chat.messages[:1]), tokenize=False, add_generation_prompt=False
+            )
+            return system_text, self.tokenizer(system_text)["input_ids"]
+
+        if chat.prompt_key is not None:
+            from interact_llm.llm.prompt_artifacts import PROMPT_ARTIFACTS
+
+            _, system_ids = PROMPT_ARTIFACTS.get_or_build(
+                self.tokenizer, chat.prompt_key, chat.messages[0].content, True, build
+            )
+            system_ids = system_ids.tolist()
+        else:
+            _, system_ids = build()
+        n_prefix = min(common_prefix_length(system_ids, input_ids), len(input_ids) - 1)
 
-        if len(kwargs) > 0:
+        if n_prefix <= 0:
+            return None
+
+        past_key_values = DynamicCache()
+        with torch.inference_mode():
+            self.model(
+                input_ids=torch.tensor(
+                    [input_ids[:n_prefix]], device=self.model.device
+                ),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+
+        entry = PrefixCache(self.cache_owner)
+        entry.update(input_ids[:n_prefix], past_key_values)
+
+        return entry
+
+    def _get_prefix_cache(self, chat: ChatHistory, input_ids: list[int]) -> PrefixCache:
+        """
+        Get the prefix cache stored on the chat history.
+
+        A history without one (or last used with another model instance) is seeded from
+        the shared system prompt cache if it was made with
+        ChatHistory.from_system_prompt.
+        """
+        prefix_cache = getattr(chat, "_kv_cache", None)
+
+        if (
+            isinstance(prefix_cache, PrefixCache)
+            and prefix_cache.owner == self.cache_owner
+        ):
+            return prefix_cache
+
+        prefix_cache = None
+        if chat.prompt_key is not None:
+            key = (self.cache_owner, *chat.prompt_key)
+            prefix_cache = PROMPT_PREFIX_CACHE.get(key, input_ids)
+
+            if prefix_cache is None:
+                entry = self._prefill_system_prompt(chat, input_ids)
+                if entry is not None:
+                    PROMPT_PREFIX_CACHE.put(key, entry)
+                    prefix_cache = entry.clone()
+
+        if prefix_cache is None:
+            prefix_cache = PrefixCache(self.cache_owner)
+
+        chat._kv_cache = prefix_cache
+
+        return prefix_cache
+
+    def _prepare_generate(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+        num_return_sequences: int = 1,
+    ) -> tuple[dict, Optional[PrefixCache]]:
+        """
+        Tokenize the chat and collect all kwargs for model.generate (shared by generate,
+        generate_stream and generate_candidates).
+
+        With num_return_sequences > 1, the prefix KV cache is copied and expanded to one
+        row per sequence, and no prefix cache is returned (it cannot be updated from
+        several sequences).
+        """
+        kwargs = self.format_params(sampling_params, penalty_params)
+
+        if num_return_sequences > 1:
+            do_sample = True  # greedy decoding would return the same sequence n times
+        elif len(kwargs) > 0:
             do_sample = True
         else:
             do_sample = False
@@ -74,32 +343,407 @@ class ChatHF:
                 "[INFO:] No sampling parameters nor penalty parameters were passed. Setting do_sample to 'False'"
             )
 
-        self.tokenizer.use_default_system_prompt = False # ensure no system prompt is there
-        
-        text = self.tokenizer.apply_chat_template(
-            chat,
-            tokenize=False,
-            add_generation_prompt=True,
-        )
+        # ensure no system prompt is there
+        self.tokenizer.use_default_system_prompt = False
 
-        # tokenized inputs and outputs
-        model_inputs = self.tokenizer(
-            text, return_tensors="pt"
-        ).to(self.model.device)
+        if isinstance(chat, CompactChatHistory):
+            # only the messages appended since the last call are tokenized
+            input_ids = torch.tensor(
+                [chat.input_ids(self.tokenizer)], device=self.model.device
+            )
+            model_inputs = {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+            }
+        else:
+            text = self.tokenizer.apply_chat_template(
+                chat,
+                tokenize=False,
+                add_generation_prompt=True,
+            )
 
-        input_len = model_inputs["input_ids"].shape[-1]
+            # tokenized inputs and outputs
+            model_inputs = self.tokenizer(text, return_tensors="pt").to(
+                self.model.device
+            )
 
-        output = self.model.generate(
-            **model_inputs,
+        # only prefill the tokens after the longest common prefix with the previous turn
+        prefix_cache = None
+        past_key_values = None
+        if self.reuse_kv_cache and isinstance(chat, (ChatHistory, CompactChatHistory)):
+            input_ids = model_inputs["input_ids"][0].tolist()
+            prefix_cache = self._get_prefix_cache(chat, input_ids)
+            past_key_values = prefix_cache.reuse(input_ids)
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+            elif num_return_sequences > 1:
+                past_key_values = deepcopy(past_key_values)
+                past_key_values.batch_repeat_interleave(num_return_sequences)
+
+            if num_return_sequences > 1:
+                prefix_cache = None
 
-            max_new_tokens=max_new_tokens,
-            do_sample=do_sample,
+        generate_kwargs = {
+            **model_inputs,
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "past_key_values": past_key_values,
             **kwargs,
-        )
+        }
+
+        if num_return_sequences > 1:
+            generate_kwargs["num_return_sequences"] = num_return_sequences
+            generate_kwargs["pad_token_id"] = (
+                self.tokenizer.pad_token_id or self.tokenizer.eos_token_id
+            )
+        elif self.draft_model is not None:
+            # assisted decoding only supports a single sequence
+            generate_kwargs["assistant_model"] = self.draft_model
+
+        if stop_on is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [
+                    SentenceStoppingCriteria(
+                        self.tokenizer,
+                        model_inputs["input_ids"].shape[-1],
+                        stop_on,
+                        batch_size=num_return_sequences,
+                    )
+                ]
+            )
+
+        return generate_kwargs, prefix_cache
+
+    def _draft_counter(self) -> DraftCounter | nullcontext:
+        """
+        Counter of target and draft forward calls for one generate call (a no-op context
+        without a draft model)
+        """
+        if self.draft_model is None:
+            return nullcontext()
+        return DraftCounter(self.model, self.draft_model)
+
+    def _record_draft_stats(
+        self, counter: DraftCounter | nullcontext, n_new_tokens: int
+    ) -> None:
+        if self.draft_model is None:
+            return
+        call_stats = counter.stats(n_new_tokens)
+        self.draft_stats.add(call_stats)
+
+    def generate(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        """
+        Generate a response. If stop_on is given, it is called with every finished
+        sentence during decoding and generation stops early (returning the response so
+        far) as soon as it returns True.
+        """
+        with self.telemetry.track("generate") as call:
+            generate_kwargs, prefix_cache = self._prepare_generate(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len
+
+            counter = self._draft_counter()
+            with counter, call.hook(self.model):
+                output = self.model.generate(**generate_kwargs)
+            call.record.generated_tokens = output.shape[-1] - input_len
+        self._record_draft_stats(counter, output.shape[-1] - input_len)
+
+        if prefix_cache is not None:
+            prefix_cache.update(output[0].tolist(), generate_kwargs["past_key_values"])
 
         # chat (decoded output)
-        response = self.tokenizer.decode(output[0][input_len:], skip_special_tokens=True)
+        response = self.tokenizer.decode(
+            output[0][input_len:], skip_special_tokens=True
+        )
 
         chat_message = ChatMessage(role="assistant", content=response)
+        self.telemetry.attach([chat_message], call.record)
 
         return chat_message
+
+    def generate_stream(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        Generate a response, yielding decoded text chunks as soon as they are produced.
+        Generation runs in a background thread that feeds a TextIteratorStreamer (see
+        generate for stop_on).
+        """
+        with self.telemetry.track("generate_stream") as call:
+            generate_kwargs, prefix_cache = self._prepare_generate(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len
+            streamer = TextIteratorStreamer(
+                self.tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+
+            result = {}
+            counter = self._draft_counter()
+
+            def _generate():
+                try:
+                    with counter, call.hook(self.model):
+                        result["output"] = self.model.generate(
+                            **generate_kwargs, streamer=streamer
+                        )
+                except Exception as e:
+                    result["error"] = e
+                    streamer.end()  # unblock the consumer
+
+            # set when the consumer stops iterating early (closing this generator)
+            closed = Event()
+            generate_kwargs.setdefault(
+                "stopping_criteria", StoppingCriteriaList()
+            ).append(EventStoppingCriteria(closed))
+
+            thread = Thread(target=_generate)
+            thread.start()
+
+            try:
+                yield from streamer
+            finally:
+                # stop and wait for the generation thread, so the model is free for
+                # the next call
+                closed.set()
+                thread.join()
+
+            if "error" in result:
+                raise result["error"]
+
+            call.record.generated_tokens = result["output"].shape[-1] - input_len
+
+        self._record_draft_stats(counter, result["output"].shape[-1] - input_len)
+
+        if prefix_cache is not None:
+            prefix_cache.update(
+                result["output"][0].tolist(), generate_kwargs["past_key_values"]
+            )
+
+    def generate_candidates(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Sample n_candidates responses to the same chat in a single generate call
+        (num_return_sequences), so the prompt is prefilled once. Always samples, and
+        does not use the draft model.
+
+        The prefix KV cache of the chat is used for the prompt but not updated, as the
+        caller picks the candidate that is added to the chat. With stop_on (see
+        generate), each candidate stops on its own.
+        """
+        with self.telemetry.track(
+            "generate_candidates", batch_size=n_candidates
+        ) as call:
+            generate_kwargs, _ = self._prepare_generate(
+                chat,
+                max_new_tokens,
+                sampling_params,
+                penalty_params,
+                stop_on,
+                num_return_sequences=n_candidates,
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = input_len  # prefilled once for all candidates
+
+            with call.hook(self.model):
+                output = self.model.generate(**generate_kwargs)
+            call.record.generated_tokens = count_new_tokens(
+                output, input_len, self.tokenizer.pad_token_id
+            )
+
+        responses = self.tokenizer.batch_decode(
+            output[:, input_len:], skip_special_tokens=True
+        )
+
+        messages = [
+            ChatMessage(role="assistant", content=response) for response in responses
+        ]
+        self.telemetry.attach(messages, call.record)
+
+        return messages
+
+    def _prepare_batch(
+        self,
+        chats: list[ChatHistory | CompactChatHistory],
+        max_new_tokens: int,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> dict:
+        """
+        Tokenize and left-pad the chats and collect all kwargs for model.generate
+        (shared by generate_batch and generate_batch_stream)
+        """
+        kwargs = self.format_params(sampling_params, penalty_params)
+        do_sample = len(kwargs) > 0
+
+        # ensure no system prompt is there
+        self.tokenizer.use_default_system_prompt = False
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # left-pad so that every sequence continues from the same position
+        if all(isinstance(chat, CompactChatHistory) for chat in chats):
+            # compact histories only tokenize the messages appended since their last
+            # call
+            # nothing left to tokenize
+            self.tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
+            model_inputs = self.tokenizer.pad(
+                [{"input_ids": chat.input_ids(self.tokenizer)} for chat in chats],
+                return_tensors="pt",
+                padding=True,
+                padding_side="left",
+            ).to(self.model.device)
+        else:
+            texts = [
+                self.tokenizer.apply_chat_template(
+                    chat, tokenize=False, add_generation_prompt=True
+                )
+                for chat in chats
+            ]
+
+            model_inputs = self.tokenizer(
+                texts, return_tensors="pt", padding=True, padding_side="left"
+            ).to(self.model.device)
+
+        if stop_on is not None:
+            kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [
+                    SentenceStoppingCriteria(
+                        self.tokenizer,
+                        model_inputs["input_ids"].shape[-1],
+                        stop_on,
+                        batch_size=len(chats),
+                    )
+                ]
+            )
+
+        return {
+            **model_inputs,
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            **kwargs,
+        }
+
+    def generate_batch(
+        self,
+        chats: list[ChatHistory | CompactChatHistory],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Generate a response for each of several independent chats with a single
+        left-padded generate call. With stop_on (see generate), each sequence stops on
+        its own while the rest of the batch continues.
+
+        Prefix KV caches are not used (each call prefills the full batch), and neither
+        is the draft model (assisted decoding only supports a batch size of 1).
+        """
+        with self.telemetry.track("generate_batch", batch_size=len(chats)) as call:
+            generate_kwargs = self._prepare_batch(
+                chats, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = int(generate_kwargs["attention_mask"].sum())
+
+            with call.hook(self.model):
+                output = self.model.generate(**generate_kwargs)
+            call.record.generated_tokens = count_new_tokens(
+                output, input_len, self.tokenizer.pad_token_id
+            )
+
+        responses = self.tokenizer.batch_decode(
+            output[:, input_len:], skip_special_tokens=True
+        )
+
+        messages = [
+            ChatMessage(role="assistant", content=response) for response in responses
+        ]
+        self.telemetry.attach(messages, call.record)
+
+        return messages
+
+    def generate_batch_stream(
+        self,
+        chats: list[ChatHistory | CompactChatHistory],
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Generate a response for each of several chats as in generate_batch, yielding
+        (index of the chat, decoded text chunk) pairs as soon as they are produced.
+        Generation runs in a background thread (see generate_stream).
+        """
+        with self.telemetry.track(
+            "generate_batch_stream", batch_size=len(chats)
+        ) as call:
+            generate_kwargs = self._prepare_batch(
+                chats, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            input_len = generate_kwargs["input_ids"].shape[-1]
+            call.record.prompt_tokens = int(generate_kwargs["attention_mask"].sum())
+            streamer = BatchTextIteratorStreamer(self.tokenizer, len(chats))
+
+            result = {}
+
+            def _generate():
+                try:
+                    with call.hook(self.model):
+                        result["output"] = self.model.generate(
+                            **generate_kwargs, streamer=streamer
+                        )
+                except Exception as e:
+                    result["error"] = e
+                    streamer.end()  # unblock the consumer
+
+            # set when the consumer stops iterating early (closing this generator)
+            closed = Event()
+            generate_kwargs.setdefault(
+                "stopping_criteria", StoppingCriteriaList()
+            ).append(EventStoppingCriteria(closed))
+
+            thread = Thread(target=_generate)
+            thread.start()
+
+            try:
+                yield from streamer
+            finally:
+                # stop and wait for the generation thread, so the model is free for
+                # the next call
+                closed.set()
+                thread.join()
+
+            if "error" in result:
+                raise result["error"]
+
+            call.record.generated_tokens = count_new_tokens(
+                result["output"], input_len, self.tokenizer.pad_token_id
+            )
@@ -0,0 +1,266 @@
+"""
+Client backend for a model served with interact_llm.serve (or any OpenAI-compatible chat
+completions server), with the same interface as ChatHF and ChatMLX
+"""
+
+import json
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+from interact_llm.data_models.chat import ChatMessage
+from interact_llm.llm.async_generation import AsyncGenerationMixin
+from interact_llm.llm.stopping import SentenceMonitor
+
+
+class ChatHTTP(AsyncGenerationMixin):
+    """
+    Model wrapper that sends chats to a model server instead of loading the model
+    in-process
+
+    Every chat history gets a session id (kept where the local backends keep their KV
+    cache), which is sent as the OpenAI "user" field, so that the server can keep the
+    chat and its KV cache between turns.
+    """
+
+    # concurrent requests are batched by the server, so the async methods do not wait
+    # for each other
+    max_concurrency = 16
+    max_pending = 64
+
+    def __init__(
+        self,
+        base_url: str = "http://127.0.0.1:8000",
+        model_id: Optional[str] = None,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        timeout: float = 600.0,
+    ):
+        """
+        Args:
+            base_url: URL of the server (without /v1).
+            model_id: Model to request (None uses the model the server reports on load).
+            sampling_params: Default sampling params (temp, top_p, top_k, min_p).
+            penalty_params: Default penalty params (repetition_penalty,
+                disallowed_scripts, script_penalty).
+            timeout: Seconds to wait for the server to respond.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.model_id = model_id
+        self.model = None  # the served model id once load has reached the server
+        self.sampling_params = sampling_params
+        self.penalty_params = penalty_params
+        self.timeout = timeout
+
+    def load(self) -> None:
+        """
+        Check that the server is up (and get the id of the model it serves)
+        """
+        with urllib.request.urlopen(
+            f"{self.base_url}/v1/models", timeout=self.timeout
+        ) as response:
+            served = json.load(response)["data"][0]["id"]
+
+        if self.model_id is None:
+            self.model_id = served
+        self.model = served
+
+    def _payload(
+        self,
+        chat,
+        max_new_tokens: int,
+        sampling_params: Optional[dict],
+        penalty_params: Optional[dict],
+        **fields,
+    ) -> dict:
+        """
+        Request body for a chat. Params passed per call take precedence over the ones
+        passed at init.
+        """
+        sampling_params = (
+            self.sampling_params if sampling_params is None else sampling_params
+        )
+        penalty_params = (
+            self.penalty_params if penalty_params is None else penalty_params
+        )
+
+        payload = {
+            "model": self.model_id,
+            "messages": [message.model_dump() for message in chat.messages],
+            "max_tokens": max_new_tokens,
+            **fields,
+        }
+
+        # the session id lives where the local backends keep their KV cache
+        if hasattr(chat, "_kv_cache"):
+            if not isinstance(chat._kv_cache, str):
+                chat._kv_cache = uuid.uuid4().hex
+            payload["user"] = chat._kv_cache
+
+        for key, value in (sampling_params or {}).items():
+            payload["temperature" if key == "temp" else key] = value
+        payload.update(penalty_params or {})
+
+        return payload
+
+    def _post(self, payload: dict):
+        request = urllib.request.Request(
+            f"{self.base_url}/v1/chat/completions",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def generate(
+        self,
+        chat,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        """
+        Generate a response. If stop_on is given, the response is streamed and the
+        request is closed as soon as a finished sentence makes stop_on return True (the
+        server then stops at the end of its current sentence).
+        """
+        if stop_on is not None:
+            return ChatMessage(
+                role="assistant",
+                content="".join(
+                    self.generate_stream(
+                        chat, max_new_tokens, sampling_params, penalty_params, stop_on
+                    )
+                ),
+            )
+
+        with self._post(
+            self._payload(chat, max_new_tokens, sampling_params, penalty_params)
+        ) as response:
+            completion = json.load(response)
+
+        return ChatMessage(
+            role="assistant", content=completion["choices"][0]["message"]["content"]
+        )
+
+    def generate_stream(
+        self,
+        chat,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        Generate a response, yielding text chunks as the server sends them (see generate
+        for stop_on)
+        """
+        monitor = SentenceMonitor(stop_on) if stop_on is not None else None
+        text = ""
+
+        payload = self._payload(
+            chat, max_new_tokens, sampling_params, penalty_params, stream=True
+        )
+        with self._post(payload) as response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+
+                event = json.loads(data)
+                if "error" in event:
+                    # the server failed after the response had started
+                    raise RuntimeError(f"Server error: {event['error']['message']}")
+
+                chunk = event["choices"][0]["delta"].get("content")
+                if not chunk:
+                    continue
+
+                yield chunk
+
+                if monitor is not None:
+                    text += chunk
+                    if monitor.check(text):
+                        break
+
+    def generate_candidates(
+        self,
+        chat,
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Sample n_candidates responses to the same chat in one request (the OpenAI "n"
+        param). With stop_on (see generate), the candidates are requested as concurrent
+        streams that stop on their own.
+        """
+        if stop_on is not None:
+            with ThreadPoolExecutor(max_workers=n_candidates) as executor:
+                return list(
+                    executor.map(
+                        lambda _: self.generate(
+                            chat,
+                            max_new_tokens,
+                            sampling_params,
+                            penalty_params,
+                            stop_on,
+                        ),
+                        range(n_candidates),
+                    )
+                )
+
+        payload = self._payload(
+            chat, max_new_tokens, sampling_params, penalty_params, n=n_candidates
+        )
+        payload.pop("user", None)  # candidates are not added to the chat on the server
+        with self._post(payload) as response:
+            completion = json.load(response)
+
+        return [
+            ChatMessage(role="assistant", content=choice["message"]["content"])
+            for choice in completion["choices"]
+        ]
+
+    def generate_batch(
+        self,
+        chats: list,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Generate a response for each of several chats with concurrent requests, which
+        the server batches.
+
+        Streamed requests are not batched, so stop_on (see generate) is applied to the
+        full responses instead:
+        a response is cut after the first finished sentence that makes stop_on return
+        True.
+        """
+        with ThreadPoolExecutor(max_workers=len(chats)) as executor:
+            responses = list(
+                executor.map(
+                    lambda chat: self.generate(
+                        chat, max_new_tokens, sampling_params, penalty_params
+                    ),
+                    chats,
+                )
+            )
+
+        if stop_on is not None:
+            for response in responses:
+                monitor = SentenceMonitor(stop_on)
+                if monitor.check(response.content):
+                    response.content = response.content[: monitor.n_checked]
+
+        return responses
@@ -0,0 +1,165 @@
+"""
+Prefix KV-cache reuse across chat turns for the HF backends
+"""
+
+import itertools
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Optional
+
+from transformers import DynamicCache
+
+_OWNER_IDS = itertools.count()
+
+
+def common_prefix_length(a: list[int], b: list[int]) -> int:
+    """
+    Length of the longest common prefix of two token id sequences
+    """
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def cache_owner(model_id: str) -> str:
+    """
+    Unique owner id for the KV states of one loaded model instance (instances of the
+    same model_id loaded with another dtype, quantization or placement must not share
+    them)
+    """
+    return f"{model_id}#{next(_OWNER_IDS)}"
+
+
+class PrefixCache:
+    """
+    The past_key_values of a chat together with the token ids they were computed for.
+
+    A new turn only needs to prefill the tokens after the longest common prefix with the
+    cached ids. If the chat diverges (e.g., a retried tutor turn), the cache is cropped
+    to that prefix rather than dropped.
+    """
+
+    def __init__(self, owner: str):
+        self.owner = owner
+        self.token_ids: list[int] = []
+        self.past_key_values: Optional[DynamicCache] = None
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+    def clear(self) -> None:
+        self.token_ids = []
+        self.past_key_values = None
+
+    def reuse(self, input_ids: list[int]) -> Optional[DynamicCache]:
+        """
+        Crop the cache to the longest common prefix with input_ids and return it (None
+        if nothing can be reused).
+
+        At least one input token is always left uncached, as generation needs the logits
+        of the last position.
+        """
+        if self.past_key_values is None:
+            return None
+
+        n_keep = min(
+            common_prefix_length(self.token_ids, input_ids), len(input_ids) - 1
+        )
+
+        if n_keep <= 0:
+            self.clear()
+            return None
+
+        if n_keep < self.past_key_values.get_seq_length():
+            self.past_key_values.crop(n_keep)
+        self.token_ids = self.token_ids[:n_keep]
+
+        return self.past_key_values
+
+    def update(self, token_ids: list[int], past_key_values: DynamicCache) -> None:
+        """
+        Store the cache after a generate call (token_ids = prompt + generated ids). The
+        last generated token is never fed back to the model, so only the ids covered by
+        the cache are kept.
+        """
+        self.token_ids = list(token_ids[: past_key_values.get_seq_length()])
+        self.past_key_values = past_key_values
+
+    def clone(self) -> "PrefixCache":
+        """
+        Deep copy (tensors included) so the clone can be extended without touching the
+        original
+        """
+        clone = PrefixCache(self.owner)
+        clone.token_ids = list(self.token_ids)
+        clone.past_key_values = deepcopy(self.past_key_values)
+        return clone
+
+
+class PromptPrefixCache:
+    """
+    Process-wide cache of system prompt KV states keyed by (owner, prompt_id,
+    prompt_version), where owner identifies the loaded model instance (see
+    cache_owner).
+
+    Each new conversation started from the same system prompt gets a clone of the cached
+    state, so the system prompt is prefilled once per model instead of once per
+    conversation. The entries hold model tensors (on the GPU if the model is there), so
+    at most max_entries are kept (least recently used are dropped first), and the
+    entries of a model are dropped when it is removed from the model registry (see
+    interact_llm/utils/model_load.py).
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, PrefixCache] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, input_ids: list[int]) -> Optional[PrefixCache]:
+        """
+        Return a clone of the cached prefix for key if it is a strict prefix of
+        input_ids, otherwise None
+        """
+        entry = self._entries.get(key)
+
+        usable = (
+            entry is not None
+            and len(entry) < len(input_ids)
+            and common_prefix_length(entry.token_ids, input_ids) == len(entry)
+        )
+
+        if not usable:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.clone()
+
+    def put(self, key: tuple, entry: PrefixCache) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def evict(self, owner: str) -> None:
+        """
+        Drop the entries of a model instance (keys start with its owner id)
+        """
+        for key in [key for key in self._entries if key[0] == owner]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+# shared by all ChatHF models of the process (entries are keyed by model instance)
+PROMPT_PREFIX_CACHE = PromptPrefixCache()
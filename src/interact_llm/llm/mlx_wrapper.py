@@ -3,15 +3,27 @@ MLX wrapper for running quantized mdls
 """
 
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
-from mlx_lm import generate, load
+import mlx.core as mx
+from mlx_lm import load, stream_generate
 from mlx_lm.sample_utils import make_logits_processors, make_sampler
 
-from interact_llm.data_models.chat import ChatMessage
+from interact_llm.data_models.chat import ChatHistory, ChatMessage, CompactChatHistory
+from interact_llm.llm.async_generation import AsyncGenerationMixin
+from interact_llm.llm.script_mask import make_mlx_script_processor, split_script_params
+from interact_llm.llm.snapshot import local_snapshot
+from interact_llm.llm.stopping import SENTENCE_END, SentenceMonitor
+from interact_llm.llm.telemetry import CallTracker, Telemetry
 
 
-class ChatMLX:
+def _reset_peak_memory() -> None:
+    # moved out of mx.metal in newer mlx
+    reset = getattr(mx, "reset_peak_memory", None) or mx.metal.reset_peak_memory
+    reset()
+
+
+class ChatMLX(AsyncGenerationMixin):
     """
     Model wrapper for loading and using a Huggingface model through MLX
     """
@@ -24,49 +36,224 @@ class ChatMLX:
         cache_dir: Optional[Path] = None,
         sampling_params: Optional[dict] = None,
         penalty_params: Optional[dict] = None,
+        offline: bool = False,
     ):
         self.model_id = model_id
         self.device = device
         self.device_map = device_map
         self.cache_dir = cache_dir
+        # load from the downloaded snapshot without any request to the HF Hub
+        self.offline = offline
+        # per-call records, see llm/telemetry.py (the peak memory is reported by mlx_lm
+        # with every token)
+        self.telemetry = Telemetry("mlx", model_id, (_reset_peak_memory, lambda: None))
         self.tokenizer = None
         self.model = None
 
-        # for generation hyperparams (only set once if params passed to generate)
+        # default generation hyperparams (can be overridden per call to generate)
         self.sampler = make_sampler(**sampling_params) if sampling_params else None
+        penalty_params, self.script_params = split_script_params(penalty_params)
         self.logits_processor = (
             make_logits_processors(**penalty_params) if penalty_params else None
         )
+        # (disallowed scripts, script penalty) -> logits processor
+        self._script_processors = {}
 
     def load(self) -> None:
         """
         Lazy-loading (loads model and tokenizer if not already loaded)
         """
         if self.tokenizer is None or self.model is None:
-            self.model, self.tokenizer = load(self.model_id)
+            self.model, self.tokenizer = load(
+                local_snapshot(self.model_id, self.cache_dir)
+                if self.offline
+                else self.model_id
+            )
 
             if self.device:
                 self.model.to(self.device)
 
-    def generate(self, chat: list, max_new_tokens: int = 3000):
-        prompt = self.tokenizer.apply_chat_template(  # nb see https://huggingface.co/mlx-community/Qwen2.5-7B-Instruct-1M-4bit
-            chat,
-            tokenize=False,
-            add_generation_prompt=True,
-        )
+    def make_sampling(
+        self,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+    ) -> tuple:
+        """
+        Sampler and logits processors for a call (per-call params take precedence over
+        the ones passed at init). The penalty params "disallowed_scripts" and
+        "script_penalty" add a processor masking tokens of those scripts.
+        """
+        sampler = make_sampler(**sampling_params) if sampling_params else self.sampler
+
+        if penalty_params:
+            penalty_params, script_params = split_script_params(penalty_params)
+            logits_processor = (
+                make_logits_processors(**penalty_params) if penalty_params else None
+            )
+        else:
+            logits_processor, script_params = self.logits_processor, self.script_params
+
+        if script_params.get("disallowed_scripts"):
+            key = (
+                tuple(script_params["disallowed_scripts"]),
+                script_params.get("script_penalty"),
+            )
+            if key not in self._script_processors:
+                self._script_processors[key] = make_mlx_script_processor(
+                    self.tokenizer, *key
+                )
+            logits_processor = list(logits_processor or []) + [
+                self._script_processors[key]
+            ]
 
-        # chat (decoded output)
-        response = generate(
+        return sampler, logits_processor
+
+    def _stream(
+        self,
+        prompt: str | list[int],
+        max_new_tokens: int,
+        sampler,
+        logits_processor,
+        call: CallTracker,
+    ) -> Iterator[str]:
+        """
+        stream_generate, recording the telemetry of the call from the stats mlx_lm
+        reports with every token
+        """
+        for response in stream_generate(
             self.model,
             self.tokenizer,
             prompt=prompt,
-            verbose=False,
             max_tokens=max_new_tokens,
-            sampler=self.sampler,
-            logits_processors=self.logits_processor,
+            sampler=sampler,
+            logits_processors=logits_processor,
+        ):
+            call.first_token()
+            call.record.prompt_tokens = response.prompt_tokens
+            call.record.generated_tokens = response.generation_tokens
+            call.record.prefill_s = (
+                response.prompt_tokens / response.prompt_tps
+                if response.prompt_tps
+                else None
+            )
+            call.record.peak_memory_mb = response.peak_memory * 1e3  # GB
+            yield response.text
+
+    def _stream_with_stop(
+        self, stream: Iterator[str], stop_on: Callable[[str], bool]
+    ) -> Iterator[str]:
+        """
+        Stream that stops as soon as a finished sentence makes stop_on return True
+        """
+        monitor = SentenceMonitor(stop_on)
+        text = ""
+
+        for chunk in stream:
+            yield chunk
+            text += chunk
+            if SENTENCE_END.search(chunk) and monitor.check(text):
+                break  # closing the generator stops decoding
+
+    def format_prompt(self, chat: ChatHistory | CompactChatHistory) -> str | list[int]:
+        """
+        Render the chat with the chat template. Compact histories give token ids
+        instead, tokenizing only the messages appended since their last call (mlx_lm
+        accepts both as prompt).
+        """
+        if isinstance(chat, CompactChatHistory):
+            # mlx_lm wraps the HF tokenizer
+            tokenizer = getattr(self.tokenizer, "_tokenizer", self.tokenizer)
+            # mlx_lm only adds special tokens to a text prompt that does not start with
+            # BOS already
+            add_special_tokens = "bos_token" not in (tokenizer.chat_template or "")
+            return chat.input_ids(tokenizer, add_special_tokens=add_special_tokens)
+
+        # nb see https://huggingface.co/mlx-community/Qwen2.5-7B-Instruct-1M-4bit
+        return self.tokenizer.apply_chat_template(
+            chat,
+            tokenize=False,
+            add_generation_prompt=True,
         )
 
+    def generate(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> ChatMessage:
+        """
+        Generate a response. If stop_on is given, it is called with every finished
+        sentence during decoding and generation stops early (returning the response so
+        far) as soon as it returns True.
+        """
+        with self.telemetry.track("generate") as call:
+            sampler, logits_processor = self.make_sampling(
+                sampling_params, penalty_params
+            )
+
+            prompt = self.format_prompt(chat)
+
+            # chat (decoded output)
+            stream = self._stream(
+                prompt, max_new_tokens, sampler, logits_processor, call
+            )
+            if stop_on is not None:
+                stream = self._stream_with_stop(stream, stop_on)
+            response = "".join(stream)
+
         # formatting
         chat_message = ChatMessage(role="assistant", content=response)
+        self.telemetry.attach([chat_message], call.record)
 
         return chat_message
+
+    def generate_candidates(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        n_candidates: int,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> list[ChatMessage]:
+        """
+        Sample n_candidates responses to the same chat (see generate for stop_on).
+
+        mlx_lm has no batched sampling for a single prompt in the versions supported
+        here, so the candidates are generated one after another (same interface as the
+        HF backends, without the speed-up).
+        """
+        return [
+            self.generate(
+                chat, max_new_tokens, sampling_params, penalty_params, stop_on
+            )
+            for _ in range(n_candidates)
+        ]
+
+    def generate_stream(
+        self,
+        chat: ChatHistory | CompactChatHistory,
+        max_new_tokens: int = 3000,
+        sampling_params: Optional[dict] = None,
+        penalty_params: Optional[dict] = None,
+        stop_on: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        Generate a response, yielding decoded text segments as soon as they are produced
+        (see generate for stop_on)
+        """
+        with self.telemetry.track("generate_stream") as call:
+            sampler, logits_processor = self.make_sampling(
+                sampling_params, penalty_params
+            )
+
+            prompt = self.format_prompt(chat)
+
+            stream = self._stream(
+                prompt, max_new_tokens, sampler, logits_processor, call
+            )
+            if stop_on is not None:
+                stream = self._stream_with_stop(stream, stop_on)
+            yield from stream
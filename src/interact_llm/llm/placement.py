@@ -0,0 +1,98 @@
+"""
+Placement of HF model weights from a placement profile (see [[placements]] in
+configs/models.toml)
+
+The device map and memory caps are computed once from the profile and the memory that is
+free when the model is loaded, so that from_pretrained places every layer in a single
+pass instead of loading, failing and retrying.
+"""
+
+from collections import Counter
+from typing import Optional
+
+import torch
+from accelerate.utils import convert_file_size_to_int, get_max_memory
+
+from interact_llm.data_models.model_config import PlacementProfile
+
+
+def _cap(available: int, reserve: float, limit: Optional[str]) -> int:
+    """
+    Bytes a device may hold: its free memory minus the reserve, at most limit (e.g.,
+    "48GB")
+    """
+    usable = int(available * (1 - reserve))
+    if limit is not None:
+        usable = min(usable, convert_file_size_to_int(limit))
+    return usable
+
+
+def resolve_placement(profile: PlacementProfile) -> dict:
+    """
+    Resolve a placement profile against the devices and memory of this machine
+
+    Args:
+        profile: The placement profile.
+
+    Returns:
+        kwargs for from_pretrained: device_map, and max_memory (bytes per device) and
+        offload_folder if they apply.
+    """
+    n_gpus = torch.cuda.device_count()
+
+    if profile.devices == "cpu" or n_gpus == 0:
+        if profile.devices != "cpu":
+            print(
+                f"[WARNING]: Placement '{profile.name}' needs a GPU, but none is "
+                "available. Loading on CPU"
+            )
+        return {"device_map": "cpu"}
+
+    gpus = [0] if profile.devices == "single" else list(range(n_gpus))
+    available = get_max_memory()  # free memory per GPU and available RAM, in bytes
+
+    max_memory = {
+        gpu: _cap(available[gpu], profile.reserve, profile.max_memory_per_device)
+        for gpu in gpus
+    }
+    # layers that do not fit on the GPUs go to RAM (a device missing from max_memory
+    # gets nothing, so they would go to disk and fail without an offload_folder)
+    max_memory["cpu"] = _cap(available["cpu"], profile.reserve, profile.max_cpu_memory)
+
+    kwargs = {"device_map": "auto", "max_memory": max_memory}
+    if profile.offload_folder is not None:
+        kwargs["offload_folder"] = profile.offload_folder
+
+    return kwargs
+
+
+def format_placement(kwargs: dict) -> str:
+    """
+    Short description of resolved placement kwargs for logging, e.g., "auto, max_memory
+    {0: '43.2GB', 1: '43.2GB'}"
+    """
+    description = str(kwargs["device_map"])
+    if "max_memory" in kwargs:
+        caps = {
+            device: f"{size / 1e9:.1f}GB"
+            for device, size in kwargs["max_memory"].items()
+        }
+        description += f", max_memory {caps}"
+    if "offload_folder" in kwargs:
+        description += f", offload_folder {kwargs['offload_folder']}"
+    return description
+
+
+def format_device_map(model) -> str:
+    """
+    Layout of a loaded model: number of modules placed on each device (from its
+    hf_device_map)
+    """
+    device_map = getattr(model, "hf_device_map", None)
+    if not device_map:
+        return f"on {model.device}"
+    if list(device_map) == [""]:
+        return f"on {device_map['']}"
+
+    counts = Counter(str(device) for device in device_map.values())
+    return ", ".join(f"{device}: {count} modules" for device, count in counts.items())
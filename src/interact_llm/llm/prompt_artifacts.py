@@ -0,0 +1,204 @@
+"""
+On-disk cache of system prompts rendered with a chat template and tokenized, per
+(tokenizer, prompt_version, prompt_id)
+
+Token ids are stored as uint32 .npy arrays and memory-mapped on load, so the worker
+processes of a sweep share one copy (from the page cache) instead of each rendering and
+tokenizing the prompt. An artifact is keyed by a hash of the tokenizer (its serialised
+vocabulary, merges, normalisation and special tokens), its chat template, the prompt
+content and whether special tokens are added: when a prompt TOML changes, the artifact
+is rebuilt and the outdated one removed.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import weakref
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+# next to the HF model cache
+PROMPT_ARTIFACTS_DIR = Path(__file__).parents[4] / "models" / "prompt_artifacts"
+FORMAT_VERSION = 1
+
+_FINGERPRINTS: "weakref.WeakKeyDictionary[object, str]" = weakref.WeakKeyDictionary()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of everything that determines how a tokenizer renders and tokenizes a chat
+    (computed once per tokenizer)
+    """
+    fingerprint = _FINGERPRINTS.get(tokenizer)
+    if fingerprint is not None:
+        return fingerprint
+
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        state = backend.to_str()
+    else:  # slow tokenizers
+        state = json.dumps(
+            [
+                type(tokenizer).__name__,
+                sorted(tokenizer.get_vocab().items()),
+                tokenizer.all_special_tokens,
+            ]
+        )
+
+    digest = hashlib.sha256(state.encode("utf-8"))
+    digest.update(b"\0" + (tokenizer.chat_template or "").encode("utf-8"))
+    fingerprint = digest.hexdigest()
+    _FINGERPRINTS[tokenizer] = fingerprint
+
+    return fingerprint
+
+
+def _safe(part: Optional[str]) -> str:
+    return re.sub(r"[^A-Za-z0-9._]", "_", str(part))
+
+
+class PromptArtifactCache:
+    """
+    Rendered system prompts and their token ids, on disk (shared between processes) and
+    in memory
+    """
+
+    def __init__(self, cache_dir: Path = PROMPT_ARTIFACTS_DIR, enabled: bool = True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        # artifact name -> (text, ids) opened in this process
+        self._loaded: dict[str, tuple[str, np.ndarray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _names(
+        self,
+        tokenizer,
+        prompt_key: tuple[str, Optional[str]],
+        content: str,
+        add_special_tokens: bool,
+    ) -> tuple[str, str]:
+        """
+        (prefix, name) of the artifact files: the prefix identifies (tokenizer,
+        prompt_version, prompt_id), the name also the prompt content
+        """
+        prompt_id, prompt_version = prompt_key
+        content_hash = hashlib.sha256(
+            json.dumps([FORMAT_VERSION, content, add_special_tokens]).encode("utf-8")
+        )
+        prefix = "-".join(
+            [
+                tokenizer_fingerprint(tokenizer)[:16],
+                _safe(prompt_version),
+                _safe(prompt_id),
+                str(int(add_special_tokens)),
+            ]
+        )
+        return prefix, f"{prefix}-{content_hash.hexdigest()[:16]}"
+
+    def get_or_build(
+        self,
+        tokenizer,
+        prompt_key: tuple[str, Optional[str]],
+        content: str,
+        add_special_tokens: bool,
+        build: Callable[[], tuple[str, list[int]]],
+    ) -> tuple[str, np.ndarray]:
+        """
+        Rendered text and token ids of a system prompt, loaded from the cache or built
+        (and cached) with build
+
+        Args:
+            tokenizer: The tokenizer (with chat template) the prompt is rendered and
+                tokenized with.
+            prompt_key: (prompt_id, prompt_version) of the prompt.
+            content: Content of the prompt.
+            add_special_tokens: Whether the tokenizer adds its special tokens (e.g.,
+                BOS) to the ids.
+            build: Renders and tokenizes the prompt, returns (text, ids).
+
+        Returns:
+            text: The rendered prompt.
+            ids: The token ids (a read-only uint32 array, memory-mapped if the cache
+                directory is writable).
+        """
+        if not self.enabled:
+            text, ids = build()
+            return text, np.asarray(ids, dtype=np.uint32)
+
+        prefix, name = self._names(tokenizer, prompt_key, content, add_special_tokens)
+
+        if name in self._loaded:
+            self.hits += 1
+            return self._loaded[name]
+
+        ids_path = self.cache_dir / f"{name}.npy"
+        try:
+            ids = np.load(ids_path, mmap_mode="r")
+            text = (self.cache_dir / f"{name}.txt").read_text(encoding="utf-8")
+            self.hits += 1
+        except (OSError, ValueError):
+            text, ids = build()
+            ids = np.asarray(ids, dtype=np.uint32)
+            self.misses += 1
+            # an empty file cannot be memory-mapped
+            if self._write(prefix, name, text, ids) and len(ids) > 0:
+                ids = np.load(ids_path, mmap_mode="r")
+
+        self._loaded[name] = (text, ids)
+
+        return text, ids
+
+    def _write(self, prefix: str, name: str, text: str, ids: np.ndarray) -> bool:
+        """
+        Write an artifact (atomically, as workers may build the same one at once) and
+        remove outdated artifacts of the same (tokenizer, prompt_version, prompt_id).
+        Returns whether the artifact was written.
+        """
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+            # only the content hash may follow the prefix (another prompt id can start
+            # with this one, e.g., "A1-1" after "A1")
+            outdated = re.compile(rf"{re.escape(prefix)}-[0-9a-f]{{16}}\.(txt|npy)")
+            for path in self.cache_dir.glob(f"{prefix}-*"):
+                if path.stem != name and outdated.fullmatch(path.name):
+                    path.unlink(missing_ok=True)
+
+            buffer = io.BytesIO()
+            np.save(buffer, ids)
+
+            # the text first: an artifact counts as cached once its ids exist
+            self._replace(self.cache_dir / f"{name}.txt", text.encode("utf-8"))
+            self._replace(self.cache_dir / f"{name}.npy", buffer.getvalue())
+        except OSError as e:
+            print(
+                f"[WARNING]: Could not write prompt artifact {name} to "
+                f"{self.cache_dir}: {e}"
+            )
+            return False
+
+        return True
+
+    def _replace(self, path: Path, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{path.name}")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "loaded": len(self._loaded)}
+
+    def clear(self) -> None:
+        """
+        Forget the artifacts opened in this process (the files on disk are kept)
+        """
+        self._loaded.clear()
+
+
+PROMPT_ARTIFACTS = PromptArtifactCache()
@@ -0,0 +1,202 @@
+"""
+CPU weight quantization of HF models (the counterpart of the 4-bit MLX models on
+machines without Apple silicon)
+
+- "int8": dynamic int8 quantization with torch (int8 weights, activations are quantized
+  on the fly per batch)
+- "int4": weight-only int4 quantization in groups of INT4_GROUP_SIZE input features,
+  using torch's packed int4 CPU matmul kernel (no extra dependencies). The kernel is
+  only fast with bfloat16 activations, so layer inputs are cast to bfloat16: decoding is
+  faster and smaller than with int8, prefill of long prompts is slower.
+
+Both run on CPU only and expect a model loaded in float32.
+"""
+
+from typing import Optional
+
+import torch
+
+from interact_llm.data_models.model_config import QUANTIZATION_METHODS
+
+INT4_GROUP_SIZE = 64
+# output projection is kept in full precision (quantizing it costs the most quality)
+SKIP_MODULES = ("lm_head",)
+
+
+def check_quantization(quantization: Optional[str]) -> Optional[str]:
+    """
+    Validate a quantization method ("none" is the same as None)
+    """
+    if quantization is None or quantization == "none":
+        return None
+    if quantization not in QUANTIZATION_METHODS:
+        raise ValueError(
+            f"Unknown quantization '{quantization}', choose between "
+            f"{QUANTIZATION_METHODS} or 'none'"
+        )
+    return quantization
+
+
+class Int4Linear(torch.nn.Module):
+    """
+    Linear layer with int4 weights (asymmetric, one scale and zero point per group of
+    group_size input features)
+    """
+
+    def __init__(
+        self, in_features: int, out_features: int, group_size: int = INT4_GROUP_SIZE
+    ):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer(
+            "weight_packed",
+            torch.empty(out_features, in_features // 2, dtype=torch.uint8),
+            persistent=False,
+        )
+        self.register_buffer(
+            "scales_and_zeros",
+            torch.empty(
+                in_features // group_size, out_features, 2, dtype=torch.bfloat16
+            ),
+            persistent=False,
+        )
+        self.bias = None
+
+    @classmethod
+    def from_linear(
+        cls, linear: torch.nn.Linear, group_size: int = INT4_GROUP_SIZE
+    ) -> "Int4Linear":
+        module = cls(linear.in_features, linear.out_features, group_size)
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(module.out_features, -1, group_size)
+
+        w_min = groups.amin(dim=-1, keepdim=True)
+        w_max = groups.amax(dim=-1, keepdim=True)
+        scales = (w_max - w_min).clamp(min=1e-6) / 15
+        q = ((groups - w_min) / scales).round().clamp(0, 15).to(torch.int32)
+
+        # the kernel dequantizes as (q - 8) * scale + zero
+        zeros = w_min + 8 * scales
+        module.weight_packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(
+            q.reshape(module.out_features, module.in_features), 1
+        )
+        module.scales_and_zeros = (
+            torch.cat([scales, zeros], dim=-1)
+            .transpose(0, 1)
+            .contiguous()
+            .to(torch.bfloat16)
+        )
+        if linear.bias is not None:
+            module.bias = torch.nn.Parameter(
+                linear.bias.detach().float(), requires_grad=False
+            )
+
+        return module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        out = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features).to(torch.bfloat16),
+            self.weight_packed,
+            self.group_size,
+            self.scales_and_zeros,
+        ).to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"group_size={self.group_size}"
+        )
+
+
+def _linear_layers(
+    model: torch.nn.Module, skip_modules: tuple[str, ...]
+) -> list[tuple[str, torch.nn.Linear]]:
+    return [
+        (name, module)
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+        and name.split(".")[-1] not in skip_modules
+    ]
+
+
+def quantize_model(
+    model: torch.nn.Module,
+    quantization: str,
+    skip_modules: tuple[str, ...] = SKIP_MODULES,
+    group_size: int = INT4_GROUP_SIZE,
+) -> torch.nn.Module:
+    """
+    Quantize the linear layers of a (float32, CPU) model in place
+
+    Args:
+        model: The model to quantize.
+        quantization: "int8" or "int4" (see QUANTIZATION_METHODS).
+        skip_modules: Names of linear layers to keep in full precision.
+        group_size: Number of input features sharing a scale and zero point (int4 only).
+            Layers whose number of input features is not a multiple of it are kept in
+            full precision.
+
+    Returns:
+        The quantized model.
+    """
+    quantization = check_quantization(quantization)
+    layers = _linear_layers(model, skip_modules)
+
+    if quantization == "int8":
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        torch.ao.quantization.quantize_dynamic(
+            model,
+            {name: qconfig for name, _ in layers},
+            dtype=torch.qint8,
+            inplace=True,
+        )
+    elif quantization == "int4":
+        for name, linear in layers:
+            if linear.in_features % group_size != 0:
+                continue
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child_name, Int4Linear.from_linear(linear, group_size))
+
+    return model
+
+
+def model_footprint_mb(model: torch.nn.Module) -> float:
+    """
+    Memory taken by the weights of a model (including quantized and packed weights) in
+    MB. Tied weights are counted once.
+    """
+    seen = set()
+    n_bytes = 0
+
+    def add(tensor: torch.Tensor) -> None:
+        nonlocal n_bytes
+        key = (
+            (tensor.data_ptr(), tensor.nbytes)
+            if not tensor.is_quantized
+            else id(tensor)
+        )
+        if key not in seen:
+            seen.add(key)
+            n_bytes += (
+                tensor.nbytes
+                if not tensor.is_quantized
+                else tensor.numel() * tensor.element_size()
+            )
+
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        add(tensor)
+
+    # packed int8 weights are neither parameters nor buffers
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor) and tensor.is_quantized:
+                add(tensor)
+
+    return n_bytes / 2**20
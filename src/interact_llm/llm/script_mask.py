@@ -0,0 +1,300 @@
+"""
+Logits processors that mask (or down-weight) vocabulary tokens of disallowed scripts,
+e.g., CJK for a Spanish tutor
+
+Configured through the penalty params of a backend:
+    penalty_params = {
+        "repetition_penalty": 1.1,
+        "disallowed_scripts": ["cjk"],
+        "script_penalty": None,
+    }
+where script_penalty None masks the tokens and a float is subtracted from their logits
+instead.
+
+Which tokens belong to a script is computed once per tokenizer and cached on disk. For
+byte-level BPE tokenizers, tokens holding only part of a multi-byte character are caught
+through the UTF-8 lead bytes of the script, so a disallowed character cannot be
+assembled from byte tokens either.
+"""
+
+import hashlib
+import json
+import re
+import weakref
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+SCRIPT_INDEX_DIR = Path.home() / ".cache" / "interact_llm" / "script_index"
+INDEX_VERSION = 1  # bump when the classification below changes
+
+# unicode code point ranges per script
+SCRIPT_RANGES: dict[str, list[tuple[int, int]]] = {
+    "cjk": [
+        (0x3000, 0x303F),  # CJK symbols and punctuation
+        (0x3040, 0x30FF),  # hiragana, katakana
+        # bopomofo, hangul compatibility jamo, kanbun, katakana extensions
+        (0x3100, 0x31FF),
+        (0x3400, 0x4DBF),  # CJK unified ideographs extension A
+        (0x4E00, 0x9FFF),  # CJK unified ideographs
+        (0xAC00, 0xD7AF),  # hangul syllables
+        (0xF900, 0xFAFF),  # CJK compatibility ideographs
+        (0xFF00, 0xFFEF),  # halfwidth and fullwidth forms
+        # CJK unified ideographs extensions B-F, compatibility supplement
+        (0x20000, 0x2FA1F),
+    ],
+    "cyrillic": [(0x0400, 0x052F)],
+    "arabic": [(0x0600, 0x06FF), (0x0750, 0x077F)],
+}
+
+SCRIPT_PARAMS = ("disallowed_scripts", "script_penalty")
+
+# byte fallback tokens of SentencePiece tokenizers
+_BYTE_TOKEN = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+
+def split_script_params(penalty_params: Optional[dict]) -> tuple[Optional[dict], dict]:
+    """
+    Separate the script masking params from the other penalty params
+
+    Returns:
+        penalty_params: The penalty params without the script params (None if none are
+            left).
+        script_params: The script params (empty if none were given).
+    """
+    if not penalty_params:
+        return penalty_params, {}
+
+    script_params = {
+        key: penalty_params[key] for key in SCRIPT_PARAMS if key in penalty_params
+    }
+    rest = {
+        key: value for key, value in penalty_params.items() if key not in SCRIPT_PARAMS
+    }
+
+    return rest or None, script_params
+
+
+@lru_cache(maxsize=None)
+def _lead_bytes(script: str) -> frozenset[int]:
+    """
+    First bytes of the 2- and 3-byte UTF-8 encodings of the characters of a script.
+
+    For CJK these are only shared with rarely used blocks (e.g., Yi), never with Latin
+    script. Lead bytes of 4-byte encodings are skipped, as they are shared with emoji
+    (characters beyond U+FFFF are still caught when whole).
+    """
+    return frozenset(
+        chr(code_point).encode("utf-8")[0]
+        for start, end in SCRIPT_RANGES[script]
+        for code_point in range(start, min(end, 0xFFFF) + 1)
+        if not 0xD800 <= code_point <= 0xDFFF
+    )
+
+
+@lru_cache(maxsize=None)
+def _byte_decoder() -> dict[str, int]:
+    """
+    Inverse of the byte-to-unicode map used by byte-level BPE vocabularies (GPT-2, Llama
+    3, Qwen, ...)
+    """
+    bytes_ = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    chars = list(bytes_)
+    n = 0
+    for byte in range(256):
+        if byte not in bytes_:
+            bytes_.append(byte)
+            chars.append(256 + n)
+            n += 1
+    return {chr(char): byte for byte, char in zip(bytes_, chars)}
+
+
+def _tokenizer_json(tokenizer) -> Optional[dict]:
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    return json.loads(backend.to_str()) if backend is not None else None
+
+
+def _is_byte_level(tokenizer_json: Optional[dict]) -> bool:
+    return tokenizer_json is not None and "ByteLevel" in json.dumps(
+        tokenizer_json.get("decoder")
+    )
+
+
+_FINGERPRINTS: "weakref.WeakKeyDictionary[object, str]" = weakref.WeakKeyDictionary()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of the tokenizer definition (vocab, merges, normalizer, decoder) identifying it
+    across processes (memoized per tokenizer object)
+    """
+    if tokenizer in _FINGERPRINTS:
+        return _FINGERPRINTS[tokenizer]
+
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        content = backend.to_str()
+    else:
+        content = json.dumps(sorted(tokenizer.get_vocab().items()))
+    fingerprint = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+    _FINGERPRINTS[tokenizer] = fingerprint
+
+    return fingerprint
+
+
+def build_script_index(tokenizer, script: str) -> np.ndarray:
+    """
+    Boolean array over the vocab, True for tokens that contain (part of) a character of
+    the script. Special tokens are never flagged.
+    """
+    ranges = SCRIPT_RANGES[script]
+    lead_bytes = _lead_bytes(script)
+    byte_level = _is_byte_level(_tokenizer_json(tokenizer))
+    byte_decoder = _byte_decoder()
+    special_ids = set(tokenizer.all_special_ids)
+
+    n_vocab = len(tokenizer)
+    index = np.zeros(n_vocab, dtype=bool)
+
+    for token_id, token in enumerate(
+        tokenizer.convert_ids_to_tokens(list(range(n_vocab)))
+    ):
+        if token is None or token_id in special_ids:
+            continue
+
+        if byte_level and all(char in byte_decoder for char in token):
+            token_bytes = bytes(byte_decoder[char] for char in token)
+        elif match := _BYTE_TOKEN.match(token):
+            token_bytes = bytes([int(match.group(1), 16)])
+        else:
+            token_bytes = token.encode("utf-8")
+
+        if any(byte in lead_bytes for byte in token_bytes):
+            index[token_id] = True
+            continue
+
+        text = token_bytes.decode("utf-8", errors="ignore")
+        index[token_id] = any(
+            start <= ord(char) <= end for char in text for start, end in ranges
+        )
+
+    return index
+
+
+_INDEX_CACHE: dict[tuple[str, str], np.ndarray] = {}
+
+
+def get_script_index(
+    tokenizer, script: str, cache_dir: Path = SCRIPT_INDEX_DIR
+) -> np.ndarray:
+    """
+    Token-script index of a tokenizer, built once and cached in memory and on disk
+    (keyed by a hash of the tokenizer)
+    """
+    if script not in SCRIPT_RANGES:
+        raise ValueError(
+            f"Unknown script '{script}'. Choose between: {list(SCRIPT_RANGES)}"
+        )
+
+    key = (tokenizer_fingerprint(tokenizer), script)
+    if key in _INDEX_CACHE:
+        return _INDEX_CACHE[key]
+
+    path = Path(cache_dir) / f"{key[0]}-{script}-v{INDEX_VERSION}.npy"
+    if path.exists():
+        index = np.load(path)
+    else:
+        index = build_script_index(tokenizer, script)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, index)
+        tmp_path.replace(path)
+        print(
+            f"[INFO]: Built {script} token index ({index.sum()} of {len(index)} "
+            f"tokens) and cached it at {path}"
+        )
+
+    _INDEX_CACHE[key] = index
+
+    return index
+
+
+def get_disallowed_mask(
+    tokenizer, scripts: list[str], cache_dir: Path = SCRIPT_INDEX_DIR
+) -> np.ndarray:
+    """
+    Union of the token-script indices of several scripts
+    """
+    mask = np.zeros(len(tokenizer), dtype=bool)
+    for script in scripts:
+        mask |= get_script_index(tokenizer, script, cache_dir)
+    return mask
+
+
+def make_hf_script_processor(
+    tokenizer, disallowed_scripts: list[str], script_penalty: Optional[float] = None
+):
+    """
+    LogitsProcessor for HF generate (script_penalty None masks the tokens, otherwise it
+    is subtracted from their logits)
+    """
+    import torch
+    from transformers import LogitsProcessor
+
+    mask = torch.from_numpy(get_disallowed_mask(tokenizer, disallowed_scripts))
+
+    class ScriptMaskLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self._mask = {}  # per device
+
+        def __call__(
+            self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+        ) -> torch.FloatTensor:
+            if scores.device not in self._mask:
+                self._mask[scores.device] = mask.to(scores.device)
+            device_mask = self._mask[scores.device]
+
+            # the model's logits can be wider than the tokenizer's vocab (padding)
+            scores_view = scores[:, : device_mask.shape[0]]
+            if script_penalty is None:
+                scores_view.masked_fill_(device_mask, -float("inf"))
+            else:
+                scores_view.sub_(device_mask.to(scores.dtype) * script_penalty)
+            return scores
+
+    return ScriptMaskLogitsProcessor()
+
+
+def make_mlx_script_processor(
+    tokenizer, disallowed_scripts: list[str], script_penalty: Optional[float] = None
+):
+    """
+    Logits processor for mlx_lm (a callable of tokens and logits, as returned by
+    make_logits_processors)
+    """
+    import mlx.core as mx
+
+    # mlx_lm wraps the HF tokenizer
+    mask = get_disallowed_mask(
+        getattr(tokenizer, "_tokenizer", tokenizer), disallowed_scripts
+    )
+    bias = np.where(
+        mask, -np.inf if script_penalty is None else -script_penalty, 0.0
+    ).astype(np.float32)
+    bias = mx.array(bias)
+
+    def processor(tokens, logits):
+        n = bias.shape[0]
+        if logits.shape[-1] == n:
+            return logits + bias
+        # the model's logits can be wider than the tokenizer's vocab (padding)
+        return mx.concatenate([logits[..., :n] + bias, logits[..., n:]], axis=-1)
+
+    return processor
@@ -0,0 +1,38 @@
+"""
+Offline model loading: resolve a HF Hub model id to its downloaded snapshot directory
+without any request to the Hub
+
+Loading a model by its Hub id makes transformers (and mlx_lm) ask the Hub for the latest
+revision of every file, even if all of them are cached. Loading the snapshot directory
+instead reads the weights straight from the local disk.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+
+def local_snapshot(model_id: str, cache_dir: Optional[Path] = None) -> str:
+    """
+    Local directory of a model (its id if it is already a directory, else its cached
+    snapshot of the main branch)
+
+    Args:
+        model_id: HF Hub model id (or a local model directory).
+        cache_dir: HF cache the model was downloaded to (None for the default HF cache).
+
+    Returns:
+        Path to the directory with the model files.
+    """
+    if Path(model_id).is_dir():
+        return model_id
+
+    from huggingface_hub import snapshot_download
+    from huggingface_hub.errors import LocalEntryNotFoundError
+
+    try:
+        return snapshot_download(model_id, cache_dir=cache_dir, local_files_only=True)
+    except LocalEntryNotFoundError as e:
+        raise OSError(
+            f"Model {model_id} is not downloaded to {cache_dir or 'the HF cache'}. "
+            "Load it once without offline mode first"
+        ) from e
@@ -0,0 +1,117 @@
+"""
+Acceptance-rate statistics for speculative (assisted) decoding with a draft model in the
+HF backends
+"""
+
+from typing import Optional
+
+from torch import nn
+
+
+class DraftCounter:
+    """
+    Counts forward calls of the target and the draft model during an assisted generate
+    call.
+
+    Every forward call of the draft proposes one token and every forward call of the
+    target verifies the proposed tokens and adds one token of its own, so: accepted =
+    new tokens - target calls, drafted = draft calls.
+    """
+
+    def __init__(self, model: nn.Module, draft_model: nn.Module):
+        self.model = model
+        self.draft_model = draft_model
+        self.target_calls = 0
+        self.draft_calls = 0
+        self._handles = []
+
+    def _count_target(self, *args) -> None:
+        self.target_calls += 1
+
+    def _count_draft(self, *args) -> None:
+        self.draft_calls += 1
+
+    def __enter__(self) -> "DraftCounter":
+        self._handles = [
+            self.model.register_forward_hook(self._count_target),
+            self.draft_model.register_forward_hook(self._count_draft),
+        ]
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def stats(self, n_new_tokens: int) -> dict:
+        """
+        Statistics of the counted call given the number of tokens it generated
+        """
+        accepted = max(n_new_tokens - self.target_calls, 0)
+        return {
+            "new_tokens": n_new_tokens,
+            "target_calls": self.target_calls,
+            "drafted": self.draft_calls,
+            "accepted": accepted,
+            "acceptance_rate": accepted / self.draft_calls
+            if self.draft_calls
+            else None,
+        }
+
+
+class DraftStats:
+    """
+    Running totals of speculative decoding over all generate calls of a backend
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.new_tokens = 0
+        self.target_calls = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def add(self, call_stats: dict) -> None:
+        self.calls += 1
+        self.new_tokens += call_stats["new_tokens"]
+        self.target_calls += call_stats["target_calls"]
+        self.drafted += call_stats["drafted"]
+        self.accepted += call_stats["accepted"]
+
+    @property
+    def acceptance_rate(self) -> Optional[float]:
+        return self.accepted / self.drafted if self.drafted else None
+
+    @property
+    def tokens_per_target_call(self) -> Optional[float]:
+        """
+        Mean number of tokens per forward call of the target model (1.0 without a draft
+        model)
+        """
+        return self.new_tokens / self.target_calls if self.target_calls else None
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "new_tokens": self.new_tokens,
+            "target_calls": self.target_calls,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_target_call": self.tokens_per_target_call,
+        }
+
+
+def log_draft_stats(totals: DraftStats) -> None:
+    """
+    Log the totals of speculative decoding (once, e.g., at the end of a run)
+    """
+    rate = totals.acceptance_rate
+    tokens_per_call = totals.tokens_per_target_call
+    print(
+        f"[INFO]: Speculative decoding accepted {totals.accepted}/{totals.drafted} "
+        f"draft tokens ({'n/a' if rate is None else f'{rate:.1%}'}), "
+        f"{totals.new_tokens} tokens in {totals.target_calls} target forward passes "
+        f"({'n/a' if tokens_per_call is None else f'{tokens_per_call:.2f}'} tokens "
+        f"per pass) over {totals.calls} calls"
+    )
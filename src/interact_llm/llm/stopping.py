@@ -0,0 +1,57 @@
+"""
+Early stopping of a generation as soon as a finished sentence fails a check (e.g.,
+language drift), so that a rejected response costs a few dozen tokens rather than a full
+generation
+
+(backend-independent, the HF stopping criterion is in interact_llm/llm/hf_stopping.py)
+"""
+
+import re
+from typing import Callable
+
+# same delimiters as the sentence split of the language detection
+SENTENCE_END = re.compile(r"[.?!]")
+
+
+class SentenceMonitor:
+    """
+    Runs a check on every sentence of a growing text once the sentence is finished (ends
+    with a delimiter)
+    """
+
+    def __init__(self, detect: Callable[[str], bool]):
+        """
+        Args:
+            detect: Called with each finished sentence, returns True if generation
+                should stop.
+        """
+        self.detect = detect
+        self.n_checked = 0  # number of characters of the text that have been checked
+        self.triggered = False
+
+    def check(self, text: str) -> bool:
+        """
+        Check the sentences finished since the last call (text is the full generated
+        text so far).
+
+        Returns:
+            triggered: Whether any sentence checked so far made detect return True.
+        """
+        if self.triggered:
+            return True
+
+        ends = [match.end() for match in SENTENCE_END.finditer(text, self.n_checked)]
+        if not ends:
+            return False
+
+        start = self.n_checked
+        for end in ends:
+            sentence = text[start:end].strip()
+            start = end
+            if len(sentence) > 1 and self.detect(sentence):
+                self.triggered = True
+                break
+
+        self.n_checked = start
+
+        return self.triggered
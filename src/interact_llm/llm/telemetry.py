@@ -0,0 +1,422 @@
+"""
+Per-call telemetry of the local backends (ChatHF, ChatHFGemma and ChatMLX)
+
+Every generate call is recorded with its prompt and generated tokens, prefill time,
+decode time, time to first token and peak memory. The record is attached to the returned
+messages (message.metadata["telemetry"]) and kept by the backend's Telemetry, which
+aggregates the records per label (e.g., per simulation run, see telemetry_labels) and
+exports them as JSONL or in the Prometheus text format. Selected calls can be profiled
+with torch.profiler or cProfile.
+
+This module does not import a backend, so that it can be shared by all of them.
+"""
+
+import cProfile
+import io
+import itertools
+import pstats
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Literal, Optional
+
+from pydantic import BaseModel
+
+from interact_llm.data_models.chat import ChatMessage
+
+PROFILES_DIR = Path(__file__).parents[3] / "profiles"
+
+# labels of the calls made in the current context (e.g., {"run_id": ...}), copied into
+# every record
+TELEMETRY_LABELS: ContextVar[dict] = ContextVar("telemetry_labels", default={})
+
+
+@contextmanager
+def telemetry_labels(**labels) -> Iterator[None]:
+    """
+    Label the calls made within the block (also in tasks created and executor calls
+    submitted from it)
+    """
+    token = TELEMETRY_LABELS.set({**TELEMETRY_LABELS.get(), **labels})
+    try:
+        yield
+    finally:
+        TELEMETRY_LABELS.reset(token)
+
+
+class CallRecord(BaseModel):
+    """
+    Model for the telemetry of one generate call (times in seconds)
+    """
+
+    backend: str
+    model_id: str
+    method: str  # e.g., "generate" or "generate_batch"
+    call: int  # index of the call on the backend
+    timestamp: float  # wall clock time at the start of the call
+    batch_size: int = 1  # number of sequences generated by the call
+    prompt_tokens: int = 0  # summed over the batch
+    generated_tokens: int = 0  # summed over the batch
+    prefill_s: Optional[float] = None
+    decode_s: Optional[float] = None
+    ttft_s: Optional[float] = None  # time to first token (includes tokenization)
+    total_s: float = 0.0
+    # peak accelerator memory of the call, or peak RSS of the process on CPU
+    peak_memory_mb: Optional[float] = None
+    # rejected attempts before the response of this call was accepted (set by the
+    # caller)
+    retries: int = 0
+    labels: dict[str, Any] = {}
+
+
+class CallTracker:
+    """
+    Measures one generate call: call first_token (or hook it on the model) as soon as
+    the first token is generated
+    """
+
+    def __init__(self, record: CallRecord):
+        self.record = record
+        self._start = time.perf_counter()
+        self._first_token: Optional[float] = None
+
+    def first_token(self, *args) -> None:
+        if self._first_token is None:
+            self._first_token = time.perf_counter()
+
+    @contextmanager
+    def hook(self, model) -> Iterator[None]:
+        """
+        Take the end of the first forward pass of a (torch) model as the first token
+        """
+        handle = model.register_forward_hook(self.first_token)
+        try:
+            yield
+        finally:
+            handle.remove()
+
+    def finish(self) -> None:
+        end = time.perf_counter()
+        self.record.total_s = end - self._start
+
+        if self._first_token is not None:
+            self.record.ttft_s = self._first_token - self._start
+            if self.record.prefill_s is None:
+                self.record.prefill_s = self.record.ttft_s
+            if self.record.decode_s is None:
+                self.record.decode_s = end - self._first_token
+
+
+def process_peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process so far (it cannot be reset per call)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def torch_memory_probe() -> tuple[Callable[[], None], Callable[[], float]]:
+    """
+    (reset, peak) functions for the peak memory of a call with torch: allocated CUDA
+    memory, or the process on CPU
+    """
+    import torch
+
+    if not torch.cuda.is_available():
+        return lambda: None, process_peak_rss_mb
+
+    def reset() -> None:
+        for device in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(device)
+
+    def peak() -> float:
+        return (
+            sum(
+                torch.cuda.max_memory_allocated(device)
+                for device in range(torch.cuda.device_count())
+            )
+            / 2**20
+        )
+
+    return reset, peak
+
+
+class Telemetry:
+    """
+    Records of the generate calls of a backend, with aggregation, export and opt-in
+    profiling. Recording is opt-in too (set enabled), since records are kept in memory
+    until they are cleared.
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        model_id: str,
+        memory_probe: Optional[
+            tuple[Callable[[], None], Callable[[], Optional[float]]]
+        ] = None,
+        enabled: bool = False,
+    ):
+        self.backend = backend
+        self.model_id = model_id
+        self.enabled = enabled
+        self.records: list[CallRecord] = []
+        self._reset_peak_memory, self._peak_memory = memory_probe or (
+            lambda: None,
+            lambda: None,
+        )
+        self._calls = itertools.count()
+        self._lock = threading.Lock()
+        self._profile_calls: set[int] = set()
+        self._profiler: Literal["torch", "cprofile"] = "cprofile"
+        self._profile_dir = PROFILES_DIR
+
+    def profile(
+        self,
+        calls: Iterable[int],
+        profiler: Literal["torch", "cprofile"] = "cprofile",
+        profile_dir: Path = PROFILES_DIR,
+    ) -> None:
+        """
+        Profile the calls with these indices (0 is the first generate call of the
+        backend). torch.profiler writes a Chrome trace (open in chrome://tracing or
+        Perfetto), cProfile a .prof file.
+        """
+        self._profile_calls = set(calls)
+        self._profiler = profiler
+        self._profile_dir = profile_dir
+
+    @contextmanager
+    def track(
+        self, method: str, prompt_tokens: int = 0, batch_size: int = 1
+    ) -> Iterator[CallTracker]:
+        """
+        Record a generate call made within the block (the caller sets generated_tokens
+        on tracker.record)
+        """
+        record = CallRecord(
+            backend=self.backend,
+            model_id=self.model_id,
+            method=method,
+            call=next(self._calls),
+            timestamp=time.time(),
+            batch_size=batch_size,
+            prompt_tokens=prompt_tokens,
+            labels=TELEMETRY_LABELS.get(),
+        )
+        tracker = CallTracker(record)
+
+        if not self.enabled:
+            yield tracker
+            return
+
+        self._reset_peak_memory()
+        try:
+            with self._profiling(record):
+                yield tracker
+        finally:
+            # also record calls that were stopped early (e.g., a stream the consumer
+            # stopped iterating)
+            tracker.finish()
+            if record.peak_memory_mb is None:
+                record.peak_memory_mb = self._peak_memory()
+            with self._lock:
+                self.records.append(record)
+
+    @contextmanager
+    def _profiling(self, record: CallRecord) -> Iterator[None]:
+        if record.call not in self._profile_calls:
+            yield
+            return
+
+        self._profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self._profile_dir / f"{self.backend}-{record.method}-call{record.call}"
+
+        if self._profiler == "torch":
+            import torch
+            from torch.profiler import ProfilerActivity, profile
+
+            activities = [ProfilerActivity.CPU] + (
+                [ProfilerActivity.CUDA] if torch.cuda.is_available() else []
+            )
+            with profile(activities=activities) as profiler:
+                yield
+            profiler.export_chrome_trace(f"{path}.json")
+            print(
+                profiler.key_averages().table(
+                    sort_by="self_cpu_time_total", row_limit=15
+                )
+            )
+            print(f"[INFO]: Profile of call {record.call} saved to {path}.json")
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:  # another call is being profiled in this process
+            print(f"[WARNING]: Not profiling call {record.call}: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+        profiler.dump_stats(f"{path}.prof")
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats("cumulative").print_stats(15)
+        print(stats.getvalue())
+        print(f"[INFO]: Profile of call {record.call} saved to {path}.prof")
+
+    @staticmethod
+    def attach(messages: Iterable[ChatMessage], record: CallRecord) -> None:
+        """
+        Attach the record of a call to the messages it returned
+        """
+        for message in messages:
+            message.metadata["telemetry"] = record
+
+    def summary(self, by: Optional[str] = None) -> dict:
+        """
+        Aggregate the records: totals, and means per call. With by (a label, e.g.,
+        "run_id"), one aggregate per value of the label. A record whose label is a list
+        (e.g., a batched call serving several runs) counts for each value.
+        """
+        if by is None:
+            return _aggregate(self.records)
+
+        groups: dict[Any, list[CallRecord]] = {}
+        for record in self.records:
+            values = record.labels.get(by)
+            for value in values if isinstance(values, list) else [values]:
+                groups.setdefault(value, []).append(record)
+
+        return {value: _aggregate(records) for value, records in groups.items()}
+
+    def write_jsonl(self, path: Path) -> None:
+        """
+        Append the records to a JSONL file (one record per line)
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(record.model_dump_json() + "\n")
+
+    def prometheus(self) -> str:
+        """
+        The aggregated records in the Prometheus text format (e.g., for the textfile
+        collector of node_exporter)
+        """
+        labels = f'backend="{self.backend}",model_id="{self.model_id}"'
+        summary = self.summary()
+        lines = []
+
+        for name, key, kind, help_text in PROMETHEUS_METRICS:
+            value = summary[key]
+            if value is None:
+                continue
+            lines += [
+                f"# HELP interact_llm_{name} {help_text}",
+                f"# TYPE interact_llm_{name} {kind}",
+                f"interact_llm_{name}{{{labels}}} {value}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records = []
+
+
+# (metric name, summary key, type, help)
+PROMETHEUS_METRICS = [
+    ("generate_calls_total", "calls", "counter", "Generate calls"),
+    (
+        "prompt_tokens_total",
+        "prompt_tokens",
+        "counter",
+        "Prompt tokens of all generate calls",
+    ),
+    (
+        "generated_tokens_total",
+        "generated_tokens",
+        "counter",
+        "Generated tokens of all generate calls",
+    ),
+    (
+        "retries_total",
+        "retries",
+        "counter",
+        "Rejected attempts before accepted responses",
+    ),
+    ("prefill_seconds_total", "prefill_s", "counter", "Time spent on prefill"),
+    ("decode_seconds_total", "decode_s", "counter", "Time spent on decoding"),
+    ("generate_seconds_total", "total_s", "counter", "Time spent in generate calls"),
+    ("ttft_seconds_mean", "mean_ttft_s", "gauge", "Mean time to first token"),
+    (
+        "decode_tokens_per_second",
+        "decode_tok_per_s",
+        "gauge",
+        "Generated tokens per second of decoding",
+    ),
+    (
+        "peak_memory_megabytes",
+        "peak_memory_mb",
+        "gauge",
+        "Highest peak memory of a generate call",
+    ),
+]
+
+
+def _aggregate(records: list[CallRecord]) -> dict:
+    def total(key: str) -> Optional[float]:
+        values = [
+            getattr(record, key)
+            for record in records
+            if getattr(record, key) is not None
+        ]
+        return sum(values) if values else None
+
+    ttfts = [record.ttft_s for record in records if record.ttft_s is not None]
+    peaks = [
+        record.peak_memory_mb for record in records if record.peak_memory_mb is not None
+    ]
+    decode_s = total("decode_s")
+
+    return {
+        "calls": len(records),
+        "prompt_tokens": total("prompt_tokens") or 0,
+        "generated_tokens": total("generated_tokens") or 0,
+        "retries": total("retries") or 0,
+        "prefill_s": total("prefill_s"),
+        "decode_s": decode_s,
+        "total_s": total("total_s"),
+        "mean_ttft_s": sum(ttfts) / len(ttfts) if ttfts else None,
+        "decode_tok_per_s": total("generated_tokens") / decode_s if decode_s else None,
+        "peak_memory_mb": max(peaks) if peaks else None,
+    }
+
+
+def count_new_tokens(output, input_len: int, pad_token_id: Optional[int] = None) -> int:
+    """
+    Number of tokens generated in a (batch, sequence) tensor of output ids, not counting
+    padding
+    """
+    new_tokens = output[:, input_len:]
+    if pad_token_id is None:
+        return new_tokens.numel()
+    return int((new_tokens != pad_token_id).sum())
+
+
+def record_retries(message: ChatMessage, retries: int) -> None:
+    """
+    Set the retry count on the record of the call that generated an accepted message (if
+    it has one)
+    """
+    record = message.metadata.get("telemetry")
+    if record is not None:
+        record.retries = retries
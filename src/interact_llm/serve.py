@@ -0,0 +1,687 @@
+"""
+OpenAI-compatible inference server around one loaded backend, so that several chat apps
+or simulation workers share a single resident model (see interact_llm/llm/http_client.py
+for the matching client backend)
+
+Run:
+    python -m interact_llm.serve --model_name qwen2.5:7b --backend hf --port 8000
+
+Endpoints:
+    GET /health, GET /v1/models
+    POST /v1/chat/completions (with "stream": true for server-sent events)
+
+Besides the OpenAI params (messages, max_tokens, temperature, top_p, n, stream, user), a
+request may set top_k, min_p, repetition_penalty, disallowed_scripts and script_penalty.
+Params that are not set fall back to the model's defaults.
+
+Requests are queued and batched dynamically: requests arriving within max_wait of each
+other (or while the model is busy) with the same params are answered with one
+generate_batch call. Streaming requests are batched the same way (with
+generate_batch_stream, if the backend has it) and run as tasks, so the scheduler keeps
+collecting and batching the requests that arrive during a stream. Requests for several
+choices (n > 1) run on their own. Requests that pass a "user" id keep their chat (and
+its KV cache) on the server between turns, so a single request only prefills the
+messages added since the previous one.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from interact_llm.data_models.chat import ChatMessage, CompactChatHistory
+
+DEFAULT_MAX_TOKENS = 3000
+SAMPLING_FIELDS = {
+    "temperature": "temp",
+    "top_p": "top_p",
+    "top_k": "top_k",
+    "min_p": "min_p",
+}
+PENALTY_FIELDS = ("repetition_penalty", "disallowed_scripts", "script_penalty")
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--model_name",
+        help="model name as specified in configs/models.toml",
+        type=str,
+        default="qwen2.5:7b",
+    )
+    parser.add_argument(
+        "--backend",
+        help=(
+            "whether to serve a quantized model with MLX or a model with HF "
+            "(transformers)"
+        ),
+        type=str,
+        default="hf",
+    )
+    parser.add_argument(
+        "--model_path",
+        help=(
+            "serve a local HF model directory with the hf backend instead of a model "
+            "from configs/models.toml"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--quantization",
+        help=(
+            "CPU weight quantization of hf models: int8, int4 or none (default: "
+            "quantization_hf in configs/models.toml, ignored on GPU)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--placement",
+        help=(
+            "placement profile of hf models in configs/models.toml, or none for "
+            "device_map='auto' (default: placement_hf of the model)"
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument("--host", help="host to bind", type=str, default="127.0.0.1")
+    parser.add_argument("--port", help="port to bind", type=int, default=8000)
+    parser.add_argument(
+        "--max_batch_size",
+        help="max number of requests answered with one generate call",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        help=(
+            "how long the first request of a batch waits for others to join it (in "
+            "milliseconds)"
+        ),
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--max_sessions",
+        help="max number of chats (and their KV caches) kept between turns",
+        type=int,
+        default=32,
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+class ChatCompletionRequest(BaseModel):
+    """
+    Body of a POST /v1/chat/completions request
+    """
+
+    messages: list[ChatMessage]
+    model: Optional[str] = None
+    max_tokens: Optional[int] = Field(default=None, gt=0)
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    min_p: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    disallowed_scripts: Optional[list[str]] = None
+    script_penalty: Optional[float] = None
+    n: int = Field(default=1, gt=0)
+    stream: bool = False
+    user: Optional[str] = None
+
+    def sampling_params(self) -> Optional[dict]:
+        params = {
+            name: getattr(self, field)
+            for field, name in SAMPLING_FIELDS.items()
+            if getattr(self, field) is not None
+        }
+        return params or None
+
+    def penalty_params(self) -> Optional[dict]:
+        params = {
+            field: getattr(self, field)
+            for field in PENALTY_FIELDS
+            if getattr(self, field) is not None
+        }
+        return params or None
+
+    def batch_key(self) -> str:
+        """
+        Requests with the same key can be answered with one generate_batch call
+        """
+        return json.dumps(
+            [self.sampling_params(), self.penalty_params(), self.max_tokens],
+            sort_keys=True,
+        )
+
+
+class Job:
+    """
+    A queued request with the future (or, for streaming requests, the chunk queue) its
+    handler waits on
+    """
+
+    def __init__(self, request: ChatCompletionRequest, loop: asyncio.AbstractEventLoop):
+        self.request = request
+        self.future: asyncio.Future = loop.create_future()
+        self.chunks: Optional[asyncio.Queue] = (
+            asyncio.Queue() if request.stream else None
+        )
+        self.cancelled = False  # set when the client of a streaming request disconnects
+
+
+class BatchScheduler:
+    """
+    Request queue in front of the model. Generation runs through the backend's async
+    interface (in its worker thread), and requests that queued up in the meantime are
+    batched into the next generate call.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_sessions: int = 32,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_sessions = max_sessions
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # user -> chat, least recently used first
+        self.sessions: OrderedDict[str, CompactChatHistory] = OrderedDict()
+        # running streams, the users whose session chat they generate from, and the
+        # requests of those users waiting for them to finish
+        self.streams: set[asyncio.Task] = set()
+        self.streaming_users: set[str] = set()
+        self.deferred: list[Job] = []
+        self.n_batches = 0
+        self.n_requests = 0
+
+    def get_history(self, request: ChatCompletionRequest) -> CompactChatHistory:
+        """
+        The chat of a request: the session chat of its user extended with the new
+        messages if it is a prefix of the request's messages (keeping its KV cache),
+        otherwise a new one
+        """
+        history = self.sessions.get(request.user) if request.user is not None else None
+
+        if history is None or not history.is_prefix_of(request.messages):
+            history = CompactChatHistory()
+
+        for message in request.messages[len(history) :]:
+            history.append(message)
+
+        if request.user is not None:
+            self.sessions[request.user] = history
+            self.sessions.move_to_end(request.user)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+        return history
+
+    async def submit(self, request: ChatCompletionRequest) -> list[ChatMessage]:
+        job = Job(request, asyncio.get_running_loop())
+        await self.queue.put(job)
+        return await job.future
+
+    async def submit_stream(
+        self, request: ChatCompletionRequest
+    ) -> tuple[Job, AsyncIterator[str]]:
+        job = Job(request, asyncio.get_running_loop())
+        await self.queue.put(job)
+
+        async def chunks() -> AsyncIterator[str]:
+            while (chunk := await job.chunks.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+
+        return job, chunks()
+
+    async def _collect(self) -> list[Job]:
+        """
+        Wait for a request, then for up to max_wait for others to join it
+        """
+        jobs = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+
+        while len(jobs) < self.max_batch_size:
+            if not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return jobs
+
+    async def _generate(self, jobs: list[Job]) -> list[list[ChatMessage]]:
+        """
+        Answer a group of compatible requests
+        """
+        request = jobs[0].request
+        max_new_tokens = request.max_tokens or DEFAULT_MAX_TOKENS
+        params = {
+            "sampling_params": request.sampling_params(),
+            "penalty_params": request.penalty_params(),
+        }
+        histories = [self.get_history(job.request) for job in jobs]
+
+        if request.n > 1:
+            return [
+                await self.model.agenerate_candidates(
+                    histories[0], request.n, max_new_tokens, **params
+                )
+            ]
+
+        if len(jobs) == 1:
+            # a single chat keeps its KV cache between turns
+            return [
+                [await self.model.agenerate(histories[0], max_new_tokens, **params)]
+            ]
+
+        return [
+            [message]
+            for message in await self.model.agenerate_batch(
+                histories, max_new_tokens, **params
+            )
+        ]
+
+    async def _stream(self, jobs: list[Job]) -> None:
+        """
+        Stream the answers of a group of compatible requests into their chunk queues.
+        A single request keeps its chat's KV cache between turns (as in _generate).
+        Generation stops early once the clients of all requests have disconnected (at
+        the end of the current sentence for a single request).
+        """
+        request = jobs[0].request
+        max_new_tokens = request.max_tokens or DEFAULT_MAX_TOKENS
+        params = {
+            "sampling_params": request.sampling_params(),
+            "penalty_params": request.penalty_params(),
+        }
+        histories = [self.get_history(job.request) for job in jobs]
+
+        if len(jobs) == 1:
+            stream = self.model.agenerate_stream(histories[0], max_new_tokens, **params)
+        else:
+            stream = self.model.agenerate_batch_stream(
+                histories, max_new_tokens, **params
+            )
+
+        try:
+            async for chunk in stream:
+                if all(job.cancelled for job in jobs):
+                    break
+                i, chunk = chunk if len(jobs) > 1 else (0, chunk)
+                jobs[i].chunks.put_nowait(chunk)
+        except Exception as e:
+            for job in jobs:
+                job.chunks.put_nowait(e)
+        finally:
+            # stop generation now rather than when the generator is garbage collected
+            await stream.aclose()
+        for job in jobs:
+            job.chunks.put_nowait(None)
+
+    def _start_stream(self, jobs: list[Job]) -> None:
+        """
+        Run a stream as a task, so that the scheduler keeps collecting and dispatching
+        requests while its clients read
+        """
+        users = {job.request.user for job in jobs} - {None}
+        self.streaming_users |= users
+        task = asyncio.create_task(self._stream(jobs))
+        self.streams.add(task)
+
+        def done(task: asyncio.Task) -> None:
+            self.streams.discard(task)
+            self.streaming_users -= users
+            # requeue the requests that waited for the stream's session chats
+            deferred, self.deferred = self.deferred, []
+            for job in deferred:
+                self.queue.put_nowait(job)
+
+        task.add_done_callback(done)
+
+    def _groups(self, jobs: list[Job]) -> list[list[Job]]:
+        """
+        Split collected requests into groups answered with one generate call each.
+        Requests of the same user go into separate groups (in order), as they extend the
+        same session chat.
+        """
+        batchable = hasattr(self.model, "generate_batch")
+        stream_batchable = hasattr(self.model, "generate_batch_stream")
+        groups: dict[tuple[bool, str], list[list[Job]]] = {}
+        singles = []
+
+        for job in jobs:
+            if job.request.n > 1 or not (
+                stream_batchable if job.request.stream else batchable
+            ):
+                singles.append([job])
+                continue
+
+            user = job.request.user
+            key_groups = groups.setdefault(
+                (job.request.stream, job.request.batch_key()), []
+            )
+            for group in key_groups:
+                if user is None or all(other.request.user != user for other in group):
+                    group.append(job)
+                    break
+            else:
+                key_groups.append([job])
+
+        return [
+            group for key_groups in groups.values() for group in key_groups
+        ] + singles
+
+    async def run(self) -> None:
+        try:
+            while True:
+                jobs = await self._collect()
+                await self._dispatch(jobs)
+        finally:
+            for task in self.streams:
+                task.cancel()
+
+    async def _dispatch(self, jobs: list[Job]) -> None:
+        """
+        Answer the collected requests. Groups run one after another and requests of
+        users with a running stream wait for it, so a session chat is never extended
+        while it is being generated from.
+        """
+        for group in self._groups(jobs):
+            ready = []
+            for job in group:
+                if job.request.user in self.streaming_users:
+                    self.deferred.append(job)
+                else:
+                    ready.append(job)
+            if not ready:
+                continue
+            group = ready
+
+            self.n_batches += 1
+            self.n_requests += len(group)
+
+            if group[0].request.stream:
+                self._start_stream(group)
+                continue
+
+            try:
+                results = await self._generate(group)
+            except Exception as e:
+                for job in group:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+
+            for job, messages in zip(group, results):
+                if not job.future.done():
+                    job.future.set_result(messages)
+
+
+class InferenceServer:
+    """
+    Minimal HTTP/1.1 server (one request per connection) exposing the OpenAI chat
+    completions API for a loaded backend
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_sessions: int = 32,
+    ):
+        self.model = model
+        self.scheduler = BatchScheduler(model, max_batch_size, max_wait, max_sessions)
+
+    @staticmethod
+    async def _write_json(
+        writer: asyncio.StreamWriter, status: int, payload: dict
+    ) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        reason = {
+            200: "OK",
+            400: "Bad Request",
+            404: "Not Found",
+            500: "Internal Server Error",
+        }[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode(
+                "latin-1"
+            )
+            + body
+        )
+        await writer.drain()
+
+    def _completion(self, messages: list[ChatMessage]) -> dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model.model_id,
+            "choices": [
+                {"index": i, "message": message.model_dump(), "finish_reason": "stop"}
+                for i, message in enumerate(messages)
+            ],
+        }
+
+    async def _stream_completion(
+        self, writer: asyncio.StreamWriter, request: ChatCompletionRequest
+    ) -> None:
+        job, chunks = await self.scheduler.submit_stream(request)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def event(delta: dict, finish_reason: Optional[str] = None) -> bytes:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": self.model.model_id,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+            )
+            writer.write(event({"role": "assistant", "content": ""}))
+            await writer.drain()
+
+            async for chunk in chunks:
+                if chunk:
+                    writer.write(event({"content": chunk}))
+                    await writer.drain()
+
+            writer.write(event({}, finish_reason="stop"))
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+        except ConnectionError:
+            job.cancelled = True
+            # let the worker finish the current sentence without blocking on a closed
+            # connection
+            async for _ in chunks:
+                pass
+        except Exception as e:
+            # the 200 header is already sent, so the error goes into the event stream
+            print(f"[ERROR]: Streaming request failed: {e!r}")
+            job.cancelled = True
+            error = {"error": {"message": str(e), "type": "server_error"}}
+            try:
+                writer.write(f"data: {json.dumps(error)}\n\n".encode("utf-8"))
+                writer.write(b"data: [DONE]\n\n")
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            path = path.split("?", 1)[0]
+            if method == "GET" and path == "/health":
+                await self._write_json(
+                    writer,
+                    200,
+                    {
+                        "status": "ok",
+                        "batches": self.scheduler.n_batches,
+                        "requests": self.scheduler.n_requests,
+                    },
+                )
+            elif method == "GET" and path == "/v1/models":
+                await self._write_json(
+                    writer,
+                    200,
+                    {
+                        "object": "list",
+                        "data": [{"id": self.model.model_id, "object": "model"}],
+                    },
+                )
+            elif method == "POST" and path == "/v1/chat/completions":
+                try:
+                    request = ChatCompletionRequest.model_validate_json(body)
+                except ValidationError as e:
+                    await self._write_json(
+                        writer,
+                        400,
+                        {"error": {"message": str(e), "type": "invalid_request_error"}},
+                    )
+                    return
+
+                if request.stream:
+                    await self._stream_completion(writer, request)
+                else:
+                    messages = await self.scheduler.submit(request)
+                    await self._write_json(writer, 200, self._completion(messages))
+            else:
+                await self._write_json(
+                    writer, 404, {"error": {"message": f"No route for {method} {path}"}}
+                )
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"[ERROR]: Request failed: {e!r}")
+            try:
+                await self._write_json(
+                    writer, 500, {"error": {"message": str(e), "type": "server_error"}}
+                )
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        ready: Optional[asyncio.Event] = None,
+    ) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        scheduler_task = asyncio.create_task(self.scheduler.run())
+
+        print(f"[INFO]: Serving {self.model.model_id} on http://{host}:{port}/v1")
+        if ready is not None:
+            ready.set()
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            scheduler_task.cancel()
+
+
+def main():
+    args = input_parse()
+
+    if args.model_path is not None:
+        from interact_llm.llm.hf_wrapper import ChatHF
+
+        placement = None
+        if args.placement not in (None, "none"):
+            from interact_llm.utils.config_registry import CONFIG_REGISTRY
+
+            placement = CONFIG_REGISTRY.get_placement(args.placement)
+
+        model = ChatHF(
+            model_id=args.model_path,
+            quantization=args.quantization,
+            placement=placement,
+        )
+        print(f"[INFO]: Loading model {args.model_path} ... please wait")
+        model.load()
+    else:
+        from interact_llm.utils.model_load import load_model_backend
+
+        model = load_model_backend(
+            models_config_path=Path(__file__).parents[2] / "configs" / "models.toml",
+            model_name=args.model_name,
+            backend=args.backend,
+            token_path=Path(__file__).parents[2] / "tokens" / "hf_token.txt",
+            cache_dir=Path(__file__).parents[3] / "models"
+            if args.backend == "hf"
+            else None,
+            # requests are batched, and assisted decoding only supports a batch size of
+            # 1
+            use_draft=False,
+            quantization=args.quantization,
+            placement=args.placement,
+        )
+
+    server = InferenceServer(
+        model,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        max_sessions=args.max_sessions,
+    )
+
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("[INFO]: Server stopped")
+
+
+if __name__ == "__main__":
+    main()
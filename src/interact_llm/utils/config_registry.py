@@ -0,0 +1,207 @@
+"""
+Registry of the TOML configs: prompts in configs/prompts/, and models and placement
+profiles in configs/models.toml
+
+Each file is parsed once (with the stdlib tomllib) into dicts indexed by prompt id and
+by model name, and only parsed again when its modification time (or size) changes.
+validate parses and validates every config up front, so that a broken file fails at
+startup rather than in the middle of a sweep.
+"""
+
+import tomllib
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from pydantic import ValidationError
+
+from interact_llm.data_models.model_config import ModelConfig, PlacementProfile
+from interact_llm.data_models.prompt import Prompt
+
+CONFIGS_DIR = Path(__file__).parents[3] / "configs"
+
+
+def _parse_prompts(data: dict, path: Path) -> dict[str, Prompt]:
+    """
+    Index the prompts of a prompt file by id (the version is the file stem, e.g.,
+    "v3.0")
+    """
+    prompts = {}
+    for entry in data.get("prompts", []):
+        prompt = Prompt.model_validate({**entry, "version": path.stem})
+        if prompt.id in prompts:
+            raise ValueError(f"Duplicate prompt id '{prompt.id}'")
+        prompts[prompt.id] = prompt
+    return prompts
+
+
+def _parse_models(data: dict, path: Path) -> dict[str, ModelConfig]:
+    """
+    Index the model entries of a models file by name (checking that their placement
+    profiles exist)
+    """
+    placements = _parse_placements(data, path)
+    models = {}
+    for entry in data.get("models", []):
+        model = ModelConfig.model_validate(entry)
+        if model.name in models:
+            raise ValueError(f"Duplicate model name '{model.name}'")
+        if model.placement_hf is not None and model.placement_hf not in placements:
+            raise ValueError(
+                f"Model '{model.name}' has an unknown placement "
+                f"'{model.placement_hf}', choose between {list(placements)}"
+            )
+        models[model.name] = model
+    return models
+
+
+def _parse_placements(data: dict, path: Path) -> dict[str, PlacementProfile]:
+    """
+    Index the placement profiles of a models file by name
+    """
+    placements = {}
+    for entry in data.get("placements", []):
+        placement = PlacementProfile.model_validate(entry)
+        if placement.name in placements:
+            raise ValueError(f"Duplicate placement name '{placement.name}'")
+        placements[placement.name] = placement
+    return placements
+
+
+def prompt_file_name(version: float | str) -> str:
+    """
+    File name of a prompt version in configs/prompts/ (e.g., 3.0 -> "v3.0.toml",
+    "999_new" -> "v999_new.toml")
+    """
+    version = str(version)
+    return f"{version if version.startswith('v') else f'v{version}'}.toml"
+
+
+class ConfigRegistry:
+    """
+    Parsed and validated config files, cached by path and invalidated by file
+    modification time
+    """
+
+    def __init__(self, configs_dir: Path = CONFIGS_DIR):
+        self.configs_dir = configs_dir
+        # (path, parser) -> ((mtime, size), parsed config)
+        self._files: dict[tuple[Path, str], tuple[tuple[int, int], Any]] = {}
+
+    def _load(self, path: Path, parse: Callable[[dict, Path], Any]) -> Any:
+        path = Path(path).resolve()
+        stat = path.stat()
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        cached = self._files.get((path, parse.__name__))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        try:
+            with open(path, "rb") as f:
+                parsed = parse(tomllib.load(f), path)
+        except (tomllib.TOMLDecodeError, ValidationError, ValueError) as e:
+            raise ValueError(f"Invalid config file '{path}': {e}") from e
+
+        self._files[(path, parse.__name__)] = (version, parsed)
+
+        return parsed
+
+    def prompts(self, toml_path: Path) -> dict[str, Prompt]:
+        """
+        Prompts of a prompt file by id
+        """
+        return self._load(toml_path, _parse_prompts)
+
+    def models(
+        self, models_config_path: Optional[Path] = None
+    ) -> dict[str, ModelConfig]:
+        """
+        Model entries of a models file by name (default: configs/models.toml)
+        """
+        return self._load(
+            models_config_path or self.configs_dir / "models.toml", _parse_models
+        )
+
+    def placements(
+        self, models_config_path: Optional[Path] = None
+    ) -> dict[str, PlacementProfile]:
+        """
+        Placement profiles of a models file by name (default: configs/models.toml)
+        """
+        return self._load(
+            models_config_path or self.configs_dir / "models.toml", _parse_placements
+        )
+
+    def get_placement(
+        self, name: str, models_config_path: Optional[Path] = None
+    ) -> PlacementProfile:
+        """
+        Placement profile by name
+        """
+        placements = self.placements(models_config_path)
+
+        if name not in placements:
+            raise ValueError(
+                f"No placement profile '{name}', choose between defined profiles: "
+                f"{list(placements)}"
+            )
+
+        return placements[name]
+
+    def get_prompt(self, version: float | str, prompt_id: str) -> Optional[Prompt]:
+        """
+        Prompt by (version, id) from configs/prompts/, None if the file has no prompt
+        with that id
+        """
+        return self.prompts(
+            self.configs_dir / "prompts" / prompt_file_name(version)
+        ).get(prompt_id)
+
+    def get_model(
+        self, model_name: str, models_config_path: Optional[Path] = None
+    ) -> ModelConfig:
+        """
+        Model entry by name. The HF or MLX id of a model is accepted in place of its
+        name.
+        """
+        models = self.models(models_config_path)
+
+        if model_name in models:
+            return models[model_name]
+
+        for model in models.values():
+            if model_name in (model.hf, model.mlx):
+                return model
+
+        path = models_config_path or self.configs_dir / "models.toml"
+        raise ValueError(
+            f"No model defined for '{model_name}. Add it to '{path.name}' or choose "
+            f"between defined models: {list(models)}'"
+        )
+
+    def validate(self) -> None:
+        """
+        Parse and validate the models file and every prompt file, raising one error that
+        lists all invalid files
+        """
+        errors = []
+        paths = [(self.configs_dir / "models.toml", _parse_models)]
+        paths += [
+            (path, _parse_prompts)
+            for path in sorted((self.configs_dir / "prompts").glob("*.toml"))
+        ]
+
+        for path, parse in paths:
+            try:
+                self._load(path, parse)
+            except (OSError, ValueError) as e:
+                errors.append(str(e))
+
+        if errors:
+            raise ValueError("Invalid configs:\n" + "\n".join(errors))
+
+    def clear(self) -> None:
+        self._files.clear()
+
+
+CONFIG_REGISTRY = ConfigRegistry()
@@ -1,23 +1,33 @@
 """
 Utils for model loading either with a HF or MLX backend
+
+The backends (and torch, transformers or mlx_lm with them) are only imported once a
+model is loaded with them, so that importing this module is cheap and works without the
+dependencies of the unused backends.
 """
 
+import re
+import sys
 from pathlib import Path
-from typing import Literal, Optional
+from typing import TYPE_CHECKING, Literal, Optional
 
 import toml
 
-from interact_llm.llm.hf_wrapper import ChatHF
-from interact_llm.llm.mlx_wrapper import ChatMLX
-from interact_llm.llm.hf_gemma import ChatHFGemma
+from interact_llm.utils.config_registry import CONFIG_REGISTRY
+
+if TYPE_CHECKING:
+    from interact_llm.llm.hf_gemma import ChatHFGemma
+    from interact_llm.llm.hf_wrapper import ChatHF
+    from interact_llm.llm.mlx_wrapper import ChatMLX
 
 
 def get_model_id(
     models_config_path: Path, model_name: str, backend: Literal["mlx", "hf"] = "mlx"
 ) -> str:
     """
-    Reads models from a TOML file and returns the correct model ID
-    based on the specified backend ('mlx' or 'hf') and an input model ID.
+    Reads models from a TOML file (parsed once, see
+    interact_llm/utils/config_registry.py) and returns the correct model ID based on the
+    specified backend ('mlx' or 'hf') and an input model ID.
 
     models_config_path: Path to the models.toml file (usually placed in /configs)
     model_name: name defined in toml with corresponding backends
@@ -32,23 +42,177 @@ def get_model_id(
     if backend not in {"mlx", "hf"}:
         raise ValueError("Backend must be 'mlx' or 'hf'")
 
-    models = toml.load(models_config_path)["models"]
+    model = CONFIG_REGISTRY.get_model(model_name, models_config_path)
 
-    for model in models:
-        if model_name in model.values():
-            if backend in model:
-                return model[backend]
-            raise ValueError(
-                f"Model '{model_name}' exists but has no backend '{backend}' entry."
-            )
+    if model.get(backend) is None:
+        raise ValueError(
+            f"Model '{model_name}' exists but has no backend '{backend}' entry."
+        )
 
-    model_names = [model["name"] for model in models]
-    raise ValueError(
-        f"No model defined for '{model_name}. Add it to '{models_config_path.name}' or choose between defined models: {model_names}'"
-    )
+    return model.get(backend)
+
+
+def get_draft_model_id(
+    models_config_path: Path, model_name: str, backend: Literal["mlx", "hf"] = "hf"
+) -> Optional[str]:
+    """
+    Reads models from a TOML file and returns the ID of the draft model for speculative
+    decoding (the optional 'draft_<backend>' key of the model entry), or None if no
+    draft model is configured.
+
+    models_config_path: Path to the models.toml file (usually placed in /configs)
+    model_name: name defined in toml with corresponding backends
+    backend: Either 'mlx' or 'hf'
+    """
+    model = CONFIG_REGISTRY.models(models_config_path).get(model_name)
+
+    return model.get(f"draft_{backend}") if model is not None else None
+
+
+def get_quantization(
+    models_config_path: Path, model_name: str, backend: Literal["mlx", "hf"] = "hf"
+) -> Optional[str]:
+    """
+    Reads models from a TOML file and returns the CPU weight quantization configured for
+    the model (the optional 'quantization_<backend>' key of the model entry, e.g.,
+    "int8"), or None if none is configured.
+
+    models_config_path: Path to the models.toml file (usually placed in /configs)
+    model_name: name defined in toml with corresponding backends
+    backend: Either 'mlx' or 'hf'
+    """
+    model = CONFIG_REGISTRY.models(models_config_path).get(model_name)
+
+    return model.get(f"quantization_{backend}") if model is not None else None
+
+
+def get_placement(
+    models_config_path: Path, model_name: str, backend: Literal["mlx", "hf"] = "hf"
+) -> Optional[str]:
+    """
+    Reads models from a TOML file and returns the name of the placement profile
+    configured for the model (the optional 'placement_<backend>' key of the model entry,
+    e.g., "multi-gpu"), or None if none is configured.
+
+    models_config_path: Path to the models.toml file (usually placed in /configs)
+    model_name: name defined in toml with corresponding backends
+    backend: Either 'mlx' or 'hf'
+    """
+    model = CONFIG_REGISTRY.models(models_config_path).get(model_name)
+
+    return model.get(f"placement_{backend}") if model is not None else None
+
+
+def record_measurement(
+    models_config_path: Path, model_name: str, key: str, measurement: dict
+) -> None:
+    """
+    Write a measured memory footprint / decode speed to the model entry in a TOML file
+    (as [models.measured.<key>], e.g., key "hf-int8-cpu"), replacing an earlier
+    measurement with the same key.
+
+    Comment lines at the top of the file are kept (other comments are not preserved by
+    the TOML writer).
+
+    models_config_path: Path to the models.toml file (usually placed in /configs)
+    model_name: name defined in toml with corresponding backends
+    key: name of the measured setup (backend, quantization and device)
+    measurement: measured values, e.g., {"weights_mb": ..., "decode_tok_per_s": ...}
+    """
+    text = models_config_path.read_text()
+    config = toml.loads(text)
+
+    for model in config["models"]:
+        if model["name"] == model_name:
+            model.setdefault("measured", {})[key] = measurement
+            break
+    else:
+        raise ValueError(
+            f"No model defined for '{model_name}' in '{models_config_path.name}'"
+        )
 
+    header = []
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            break
+        header.append(line)
 
-def login_hf_token(token_path: Path = Path(__file__).parents[3] / "tokens" / "hf_token.txt") -> None:
+    # one blank line before every table
+    entries = re.sub(r"\n+(?=\[)", "\n\n", toml.dumps(config)).strip()
+    models_config_path.write_text("\n".join(header) + "\n\n" + entries + "\n")
+
+
+class ModelRegistry:
+    """
+    Pool of loaded model backends, memoized by
+    (backend, model_id, dtype, device_map, draft_model_id, quantization, placement,
+    other init kwargs).
+
+    Init kwargs such as default sampling params are part of the key, so a model loaded
+    with other defaults is never returned. Pass sampling and penalty params per call to
+    generate instead, so that one loaded model can serve every run (and prompt id) in a
+    process.
+    """
+
+    def __init__(self):
+        self._models: dict[tuple, "ChatHF | ChatMLX | ChatHFGemma"] = {}
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def get(self, key: tuple) -> Optional["ChatHF | ChatMLX | ChatHFGemma"]:
+        return self._models.get(key)
+
+    def put(self, key: tuple, model: "ChatHF | ChatMLX | ChatHFGemma") -> None:
+        self._models[key] = model
+
+    def evict(self, key: tuple) -> None:
+        """
+        Drop a model from the pool (it is freed once no other references to it remain),
+        together with its shared system prompt KV states
+        """
+        model = self._models.pop(key, None)
+        if model is not None:
+            _evict_prompt_prefixes(model)
+
+    def clear(self) -> None:
+        for model in self._models.values():
+            _evict_prompt_prefixes(model)
+        self._models.clear()
+
+
+def _freeze(value):
+    """
+    Hashable version of an init kwarg for the registry key (dicts and lists become
+    tuples)
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _evict_prompt_prefixes(model) -> None:
+    """
+    Drop the system prompt KV states of a model instance (see
+    interact_llm/llm/kv_cache.py), if the HF backend was imported at all
+    """
+    kv_cache = sys.modules.get("interact_llm.llm.kv_cache")
+    owner = getattr(model, "cache_owner", None)
+    if kv_cache is not None and owner is not None:
+        kv_cache.PROMPT_PREFIX_CACHE.evict(owner)
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def login_hf_token(
+    token_path: Path = Path(__file__).parents[3] / "tokens" / "hf_token.txt",
+) -> None:
     """
     Load HF token from "tokens" folder and login.
     """
@@ -61,28 +225,54 @@ def login_hf_token(token_path: Path = Path(__file__).parents[3] / "tokens" / "hf
 
         login(hf_token)
         print("Logged in to Hugging Face successfully.")
-    
+
     except Exception as e:
         print(f"Error during Hugging Face login: {e}")
         raise  # Re-raise the exception after printing
 
+
 def load_model_backend(
     models_config_path: Path,
     model_name: str,
     backend: Literal["mlx", "hf"] = "mlx",
     token_path: Path = Path(__file__).parents[3] / "tokens" / "hf_token.txt",
     cache_dir: Optional[Path] = None,
+    dtype: Optional[str] = None,
+    device_map: Optional[str] = None,
+    use_registry: bool = True,
+    use_draft: bool = False,
+    quantization: Optional[str] = None,
+    placement: Optional[str] = None,
+    offline: bool = False,
     **model_kwargs,
-) -> ChatHF | ChatMLX | ChatHFGemma:
+) -> "ChatHF | ChatMLX | ChatHFGemma":
     """
-    Loads a model based on the specified backend ("mlx" or "hf"). Will try to login to HF 
+    Loads a model based on the specified backend ("mlx" or "hf"). Will try to login to
+    HF
 
     Args:
         models_config_path: Path to the models configuration.
         model_name: The name of the model to load.
         backend: The backend to use for loading the model, default is "mlx".
-        **model_kwargs: Additional keyword arguments passed to the model's initialization 
-            (e.g., sampling params, see documentation for ChatHF or ChatMLX)
+        dtype: torch dtype for HF models (None uses the backend's default).
+        device_map: device map for the model (None uses the backend's default).
+        use_registry: Whether to return an already loaded model from MODEL_REGISTRY (and
+            register newly loaded ones).
+        use_draft: Whether to load the draft model configured for the model ('draft_hf'
+            in the models config) for speculative decoding (HF backends only, opt-in).
+        quantization: CPU weight quantization of HF models, "int8" or "int4" (see
+            interact_llm/llm/quantization.py). None uses 'quantization_hf' in the models
+            config, "none" loads the model unquantized.
+        placement: Name of a placement profile in the models config (HF backends only),
+            which places the weights on CPU, one GPU or several GPUs within memory caps.
+            None uses 'placement_hf' in the models config, "none" uses device_map.
+            Ignored if device_map is set.
+        offline: Whether to load the model from its downloaded snapshot in cache_dir
+            without any request to the HF Hub (faster repeated loads; fails if the model
+            has not been downloaded).
+        **model_kwargs: Additional keyword arguments passed to the model's
+            initialization (e.g., default sampling params, see documentation for ChatHF
+            or ChatMLX)
 
     Returns:
         ChatHF | ChatMLX | ChatGemma: The loaded model object.
@@ -91,34 +281,121 @@ def load_model_backend(
         models_config_path=models_config_path, model_name=model_name, backend=backend
     )
 
-    if "gemma" in model_name: 
+    draft_model_id = None
+    if use_draft and backend == "hf":
+        draft_model_id = get_draft_model_id(
+            models_config_path=models_config_path,
+            model_name=model_name,
+            backend=backend,
+        )
+
+    if quantization is None and backend == "hf":
+        quantization = get_quantization(
+            models_config_path=models_config_path,
+            model_name=model_name,
+            backend=backend,
+        )
+    if quantization is not None:
+        from interact_llm.llm.quantization import check_quantization
+
+        quantization = check_quantization(quantization)
+
+    if placement is None and backend == "hf" and device_map is None:
+        placement = get_placement(
+            models_config_path=models_config_path,
+            model_name=model_name,
+            backend=backend,
+        )
+    if placement == "none" or device_map is not None:
+        placement = None
+
+    registry_key = (
+        backend,
+        model_id,
+        dtype,
+        device_map,
+        draft_model_id,
+        quantization,
+        placement,
+        _freeze(model_kwargs),
+    )
+    if use_registry and registry_key in MODEL_REGISTRY:
+        print(
+            f"[INFO]: Reusing loaded model {model_name} ({backend} backend, model_id "
+            f"= {model_id})"
+        )
+        return MODEL_REGISTRY.get(registry_key)
+
+    # only pass dtype/device_map if set, so that each backend keeps its own defaults
+    if dtype is not None:
+        model_kwargs["torch_dtype"] = dtype
+    if device_map is not None:
+        model_kwargs["device_map"] = device_map
+    if draft_model_id is not None:
+        model_kwargs["draft_model_id"] = draft_model_id
+        print(f"[INFO]: Using draft model {draft_model_id} for speculative decoding")
+    if quantization is not None:
+        if backend != "hf" or "gemma" in model_name:
+            raise ValueError(
+                f"{quantization} quantization is only supported for the hf backend "
+                "(and not for Gemma)"
+            )
+        model_kwargs["quantization"] = quantization
+    if placement is not None:
+        if backend != "hf":
+            raise ValueError("Placement profiles are only supported for the hf backend")
+        model_kwargs["placement"] = CONFIG_REGISTRY.get_placement(
+            placement, models_config_path
+        )
+        print(f"[INFO]: Using placement profile '{placement}'")
+    if offline:
+        model_kwargs["offline"] = True
+
+    if "gemma" in model_name:
         if backend == "mlx":
             raise ValueError("Model is not supported in mlx yet")
         # Gemma should be returned immediately if `backend == "hf"`
+        from interact_llm.llm.hf_gemma import ChatHFGemma
+
         model = ChatHFGemma(model_id=model_id, cache_dir=cache_dir, **model_kwargs)
     else:
         # instantiate model based on backend
         if backend == "mlx":
+            # MLX models keep the dtype of their weights
+            model_kwargs.pop("torch_dtype", None)
+            from interact_llm.llm.mlx_wrapper import ChatMLX
+
             model = ChatMLX(model_id=model_id, **model_kwargs)
         elif backend == "hf":
+            from interact_llm.llm.hf_wrapper import ChatHF
+
             model = ChatHF(model_id=model_id, cache_dir=cache_dir, **model_kwargs)
         else:
             raise ValueError(f"Unsupported backend: {backend}")
 
-    try: 
+    try:
         model.load()
-        print(f"Model {model_name} loaded successfully using {backend} backend (model_id = {model_id})")
+        print(
+            f"Model {model_name} loaded successfully using {backend} backend "
+            f"(model_id = {model_id})"
+        )
 
     except OSError as e:
         # If the error is related to gated access (authentication error)
-        if '401 Client Error' in str(e):
+        if "401 Client Error" in str(e):
             print(f"Error loading model {model_name} from {backend} backend: {e}")
             print("Attempting to log in to Hugging Face...")
-            login_hf_token(token_path)  
+            login_hf_token(token_path)
             model.load()
-            print(f"Model {model_name} loaded successfully using {backend} backend (model_id = {model_id})")
+            print(
+                f"Model {model_name} loaded successfully using {backend} backend "
+                f"(model_id = {model_id})"
+            )
         else:
             print(f"Unexpected error occurred: {e}")
             raise  # Reraise other unexpected errors
 
+    if use_registry:
+        MODEL_REGISTRY.put(registry_key, model)
+
     return model
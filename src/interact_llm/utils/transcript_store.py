@@ -0,0 +1,338 @@
+"""
+Append-only JSONL store for chat transcripts
+
+Every message is appended to the log as soon as it is produced (one JSON record per
+line), so a crash loses at most the turn in progress. Records are flushed on every
+append and fsynced in batches. An index of byte offsets per conversation key (model_id,
+prompt_version, prompt_id, run_id) is kept next to the log, and loading all
+conversations is a single sequential read.
+"""
+
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from interact_llm.data_models.chat import ChatHistory, ChatMessage
+
+
+class ConversationKey(NamedTuple):
+    model_id: str
+    prompt_version: str
+    prompt_id: str
+    run_id: str
+
+
+def new_run_id() -> str:
+    """
+    Unique run id (timestamps with second resolution collide when runs finish in the
+    same second)
+    """
+    return uuid.uuid4().hex
+
+
+def _scan_log(path: Path) -> Iterator[tuple[int, dict]]:
+    """
+    Sequential read of a log, yielding (byte offset, record). A partially written last
+    line is skipped.
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.endswith(b"\n"):
+                yield offset, json.loads(line)
+            offset += len(line)
+
+
+def iter_conversations(
+    path: Path, status: Optional[str] = "complete"
+) -> Iterator[tuple[ConversationKey, ChatHistory]]:
+    """
+    Load all conversations of a log with the given status (None for all) with a single
+    sequential read, without opening the log for writing
+
+    Args:
+        path: Path to the JSONL log.
+        status: Status of the conversations to load (conversations without an end record
+            have status None).
+    """
+    messages: dict[ConversationKey, list[ChatMessage]] = {}
+    statuses: dict[ConversationKey, str] = {}
+
+    for _, record in _scan_log(path):
+        key = ConversationKey(
+            record["model_id"],
+            record["prompt_version"],
+            record["prompt_id"],
+            record["run_id"],
+        )
+        if "status" in record:
+            statuses[key] = record["status"]
+        else:
+            messages.setdefault(key, []).append(
+                ChatMessage(role=record["role"], content=record["content"])
+            )
+
+    for key, key_messages in messages.items():
+        if status is None or statuses.get(key) == status:
+            yield key, ChatHistory(messages=key_messages)
+
+
+def conversation_statuses(path: Path) -> dict[ConversationKey, Optional[str]]:
+    """
+    Status of every conversation of a log (None if it has no end record, e.g., it was
+    interrupted), with a single sequential read
+    """
+    statuses: dict[ConversationKey, Optional[str]] = {}
+
+    for _, record in _scan_log(path):
+        key = ConversationKey(
+            record["model_id"],
+            record["prompt_version"],
+            record["prompt_id"],
+            record["run_id"],
+        )
+        statuses[key] = record.get("status", statuses.get(key))
+
+    return statuses
+
+
+class TranscriptStore:
+    """
+    Append-only JSONL log of chat messages with an index by conversation key.
+
+    Message records hold the conversation key, the turn (position in the history), role
+    and content. A conversation is closed with an end record holding its status (e.g.,
+    "complete" or "rejected").
+    """
+
+    def __init__(self, path: Path, fsync_every: int = 16):
+        """
+        Args:
+            path: Path to the JSONL log (created if it does not exist).
+            fsync_every: Number of appended records between fsyncs (records are flushed
+                on every append regardless).
+        """
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix(".index.json")
+        self.fsync_every = fsync_every
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._truncate_partial_line()
+        self._file = open(self.path, "ab")
+        self._n_unsynced = 0
+        # appends may come from worker threads (e.g., asimulate_conversation)
+        self._lock = threading.RLock()
+
+        self._offsets: dict[ConversationKey, list[int]] = {}
+        self._status: dict[ConversationKey, str] = {}
+        self._load_index()
+
+    def _truncate_partial_line(self) -> None:
+        """
+        Drop a partially written last line (left by a crash) so that new records start
+        on a fresh line
+        """
+        if not self.path.exists():
+            return
+
+        with open(self.path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+
+            # search backwards for the end of the last complete line
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    f.truncate(position - step + newline + 1)
+                    return
+                position -= step
+            f.truncate(0)
+
+    # index
+    def _load_index(self) -> None:
+        """
+        Load the index if it matches the current log size, otherwise rebuild it from the
+        log
+        """
+        log_size = self.path.stat().st_size
+
+        if self.index_path.exists():
+            index = json.loads(self.index_path.read_text())
+            if index["log_size"] == log_size:
+                for entry in index["conversations"]:
+                    key = ConversationKey(*entry["key"])
+                    self._offsets[key] = entry["offsets"]
+                    if entry["status"] is not None:
+                        self._status[key] = entry["status"]
+                return
+
+        for offset, record in _scan_log(self.path):
+            self._index_record(offset, record)
+
+    def _index_record(self, offset: int, record: dict) -> None:
+        key = ConversationKey(
+            record["model_id"],
+            record["prompt_version"],
+            record["prompt_id"],
+            record["run_id"],
+        )
+        if "status" in record:
+            self._status[key] = record["status"]
+        else:
+            self._offsets.setdefault(key, []).append(offset)
+
+    def _write_index(self) -> None:
+        index = {
+            "log_size": self.path.stat().st_size,
+            "conversations": [
+                {"key": list(key), "offsets": offsets, "status": self._status.get(key)}
+                for key, offsets in self._offsets.items()
+            ],
+        }
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, self.index_path)
+
+    # writing
+    def _append_record(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+
+            self._n_unsynced += 1
+            if self._n_unsynced >= self.fsync_every:
+                self.sync()
+
+            self._index_record(offset, record)
+
+    def append(self, key: ConversationKey, turn: int, message: ChatMessage) -> None:
+        """
+        Append a single message of a conversation
+        """
+        self._append_record({**key._asdict(), "turn": turn, **message.model_dump()})
+
+    def append_history(
+        self, key: ConversationKey, chat: ChatHistory, start: int = 0
+    ) -> None:
+        """
+        Append the messages of a chat history from position start onwards
+        """
+        for turn, message in enumerate(chat.messages[start:], start=start):
+            self.append(key, turn, message)
+
+    def end(self, key: ConversationKey, status: str = "complete") -> None:
+        """
+        Close a conversation (conversations without an end record are treated as
+        incomplete, e.g., after a crash)
+        """
+        self._append_record({**key._asdict(), "status": status})
+        self.sync()
+
+    def sync(self) -> None:
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._n_unsynced = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+            self._write_index()
+
+    def __enter__(self) -> "TranscriptStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    # reading
+    def keys(self, status: Optional[str] = "complete") -> list[ConversationKey]:
+        """
+        Keys of all conversations with the given status (None for all conversations)
+        """
+        return [
+            key
+            for key in self._offsets
+            if status is None or self._status.get(key) == status
+        ]
+
+    def status(self, key: ConversationKey) -> Optional[str]:
+        return self._status.get(key)
+
+    def load(self, key: ConversationKey) -> ChatHistory:
+        """
+        Load a single conversation by seeking to its records
+        """
+        self._file.flush()
+        messages = []
+        with open(self.path, "rb") as f:
+            for offset in self._offsets[key]:
+                f.seek(offset)
+                record = json.loads(f.readline())
+                messages.append(
+                    ChatMessage(role=record["role"], content=record["content"])
+                )
+
+        return ChatHistory(messages=messages)
+
+    def iter_conversations(
+        self, status: Optional[str] = "complete"
+    ) -> Iterator[tuple[ConversationKey, ChatHistory]]:
+        """
+        Load all conversations with the given status (None for all) with a single
+        sequential read of the log
+        """
+        self._file.flush()
+        yield from iter_conversations(self.path, status)
+
+    def compact(self, parquet_path: Optional[Path] = None) -> Path:
+        """
+        Write all message records to a Parquet file (default: next to the log) for
+        columnar analysis
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._file.flush()
+        parquet_path = parquet_path or self.path.with_suffix(".parquet")
+
+        columns = {field: [] for field in ConversationKey._fields}
+        columns.update({"turn": [], "role": [], "content": [], "status": []})
+
+        for _, record in _scan_log(self.path):
+            if "status" in record:
+                continue
+            for field in ConversationKey._fields:
+                columns[field].append(record[field])
+            columns["turn"].append(record["turn"])
+            columns["role"].append(record["role"])
+            columns["content"].append(record["content"])
+
+        # status is only known once the whole log is read
+        for model_id, prompt_version, prompt_id, run_id in zip(
+            *(columns[field] for field in ConversationKey._fields)
+        ):
+            columns["status"].append(
+                self._status.get(
+                    ConversationKey(model_id, prompt_version, prompt_id, run_id)
+                )
+            )
+
+        pq.write_table(pa.table(columns), parquet_path)
+
+        return parquet_path
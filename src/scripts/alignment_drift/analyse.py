@@ -0,0 +1,240 @@
+"""
+Language detection over all simulated conversations, written to a per-turn Parquet table
+
+Conversations are read from the transcript logs in simulated_data/transcripts/*.jsonl
+(complete conversations only) and from the older one-file-per-run layout
+simulated_data/<model>/<version>/<prompt_id>/*.json. Language detection runs over all
+tutor turns on a pool of worker processes. Only conversations not yet listed in the
+manifest of the output dir are processed, so each run appends a new part file with the
+new conversations.
+"""
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from interact_llm.utils.transcript_store import iter_conversations
+from scripts.alignment_drift.detect_lang import LANGUAGES, _detect_lang_batch
+
+DATA_DIR = Path(__file__).parents[4] / "simulated_data"
+CHUNK_SIZE = 64  # files per worker task
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--data_dir",
+        help="dir with simulated conversations",
+        type=Path,
+        default=DATA_DIR,
+    )
+    parser.add_argument(
+        "--out_dir",
+        help=(
+            "dir for the Parquet part files and manifest (default: "
+            "<data_dir>/.analysis)"
+        ),
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--n_workers", help="number of worker processes", type=int, default=None
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+def find_conversation_files(data_dir: Path) -> list[Path]:
+    """
+    All conversation files in <model>/<version>/<prompt_id>/ (hidden dirs such as sweep
+    checkpoints are skipped)
+    """
+    return sorted(
+        path
+        for path in data_dir.glob("*/*/*/*.json")
+        if not any(part.startswith(".") for part in path.relative_to(data_dir).parts)
+    )
+
+
+def analyse_conversations(
+    conversations: list[tuple[str, str, str, str, list[str]]],
+) -> dict[str, list]:
+    """
+    Run language detection over the tutor turns of a chunk of conversations (in a worker
+    process)
+
+    Args:
+        conversations: (model, version, prompt_id, conversation id, tutor turns) per
+            conversation
+
+    Returns:
+        columns: Column name -> values, one value per tutor turn
+    """
+    columns = {
+        "model": [],
+        "version": [],
+        "prompt_id": [],
+        "conversation": [],
+        "round": [],
+        "n_sentences": [],
+    }
+    for language in LANGUAGES:
+        columns[f"{language.name.lower()}_max"] = []
+        columns[f"{language.name.lower()}_mean"] = []
+
+    turns = []
+    for model, version, prompt_id, conversation, tutor_turns in conversations:
+        for n_round, content in enumerate(tutor_turns):
+            turns.append(content)
+            columns["model"].append(model)
+            columns["version"].append(version)
+            columns["prompt_id"].append(prompt_id)
+            columns["conversation"].append(conversation)
+            columns["round"].append(n_round)
+
+    for confidences in _detect_lang_batch(turns):
+        columns["n_sentences"].append(len(confidences))
+        for i, language in enumerate(LANGUAGES):
+            has_sents = len(confidences) > 0
+            columns[f"{language.name.lower()}_max"].append(
+                float(confidences[:, i].max()) if has_sents else None
+            )
+            columns[f"{language.name.lower()}_mean"].append(
+                float(confidences[:, i].mean()) if has_sents else None
+            )
+
+    return columns
+
+
+def analyse_files(files: list[Path], data_dir: Path) -> dict[str, list]:
+    """
+    Read a chunk of conversation files and run language detection over their tutor turns
+    (in a worker process)
+    """
+    conversations = []
+    for file in files:
+        model, version, prompt_id = file.relative_to(data_dir).parts[:3]
+        messages = json.loads(file.read_text())
+        tutor_turns = [msg["content"] for msg in messages if msg["role"] == "assistant"]
+        conversations.append((model, version, prompt_id, file.stem, tutor_turns))
+
+    return analyse_conversations(conversations)
+
+
+def read_transcripts(
+    data_dir: Path, manifest: dict
+) -> tuple[list[str], list[tuple[str, str, str, str, list[str]]]]:
+    """
+    Read the complete conversations in the transcript logs that are not in the manifest
+    (one sequential read per log)
+
+    Returns:
+        manifest_keys: Manifest key per new conversation ("<log path>#<run_id>")
+        conversations: (model, version, prompt_id, run_id, tutor turns) per new
+            conversation
+    """
+    manifest_keys, conversations = [], []
+
+    for log_path in sorted((data_dir / "transcripts").glob("*.jsonl")):
+        for key, chat in iter_conversations(log_path, status="complete"):
+            manifest_key = f"{log_path.relative_to(data_dir)}#{key.run_id}"
+            if manifest_key in manifest:
+                continue
+
+            tutor_turns = [
+                msg.content for msg in chat.messages if msg.role == "assistant"
+            ]
+            manifest_keys.append(manifest_key)
+            conversations.append(
+                (
+                    key.model_id.replace("/", "--"),
+                    key.prompt_version,
+                    key.prompt_id,
+                    key.run_id,
+                    tutor_turns,
+                )
+            )
+
+    return manifest_keys, conversations
+
+
+def main():
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    args = input_parse()
+    data_dir = args.data_dir
+    out_dir = args.out_dir or data_dir / ".analysis"
+    manifest_file = out_dir / "manifest.json"
+
+    # only process conversations added since the last run
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+    files = [
+        file
+        for file in find_conversation_files(data_dir)
+        if str(file.relative_to(data_dir)) not in manifest
+    ]
+    transcript_keys, transcripts = read_transcripts(data_dir, manifest)
+
+    print(
+        f"[INFO]: {len(transcripts)} new conversation(s) in transcript logs and "
+        f"{len(files)} new conversation file(s) "
+        f"({len(manifest)} already analysed)"
+    )
+
+    if not files and not transcripts:
+        return
+
+    file_chunks = [files[i : i + CHUNK_SIZE] for i in range(0, len(files), CHUNK_SIZE)]
+    transcript_chunks = [
+        transcripts[i : i + CHUNK_SIZE] for i in range(0, len(transcripts), CHUNK_SIZE)
+    ]
+
+    with ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+        results = list(executor.map(analyse_conversations, transcript_chunks))
+        results += list(
+            executor.map(analyse_files, file_chunks, [data_dir] * len(file_chunks))
+        )
+
+    schema = pa.schema(
+        [
+            ("model", pa.string()),
+            ("version", pa.string()),
+            ("prompt_id", pa.string()),
+            ("conversation", pa.string()),
+            ("round", pa.int32()),
+            ("n_sentences", pa.int32()),
+        ]
+        + [
+            (f"{language.name.lower()}_{stat}", pa.float64())
+            for language in LANGUAGES
+            for stat in ("max", "mean")
+        ]
+    )
+    table = pa.concat_tables(pa.table(columns, schema=schema) for columns in results)
+
+    (out_dir / "turns").mkdir(parents=True, exist_ok=True)
+    part_file = (
+        out_dir
+        / "turns"
+        / f"part-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.parquet"
+    )
+    pq.write_table(table, part_file)
+
+    # update manifest only after the part file is written
+    manifest.update({str(file.relative_to(data_dir)): part_file.name for file in files})
+    manifest.update({key: part_file.name for key in transcript_keys})
+    manifest_file.write_text(json.dumps(manifest, indent=1))
+
+    print(f"[INFO]: Wrote {table.num_rows} tutor turns to {part_file}")
+
+
+if __name__ == "__main__":
+    main()
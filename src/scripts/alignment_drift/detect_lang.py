@@ -1,8 +1,11 @@
 import re
+from functools import lru_cache
 
-from lingua import Language, LanguageDetectorBuilder
+import numpy as np
+from lingua import Language, LanguageDetector, LanguageDetectorBuilder
 
 LANGUAGES = [Language.ENGLISH, Language.SPANISH, Language.CHINESE]
+LANGUAGE_THRESHOLDS = [(Language.ENGLISH, 0.80), (Language.CHINESE, 0.80)]
 
 test_text_with_english = "Me alegra saber que estás disfrutando de la clase. A mí también me parece divertida hoy, especialmente porque vamos a hablar sobre las festividades en España. ¿Sabías que la fiesta más famosa es el Carnaval? (I'm glad you're enjoying the class. I find it fun today too, especially because we're going to talk about festivals in Spain. Did you know that the most famous party is Carnival?)"
 
@@ -10,6 +13,7 @@ test_text_without_english = "Me alegra saber que estás disfrutando de la clase.
 
 test_text_CHINESE = "¡Genial! Has hecho un excelente trabajo改进你的翻译和修订。以下是稍作调整后更流畅和完善的一些文字：### 结构化的短篇故事《公园的一天》> **Un Día en el Parque** Antes de unos días, decidimos ir al parque con mis amigos María y Juan. Ese día estaba soleado y hermoso, perfecto para pasar una jornada divertida al aire libre. Primero, caminamos por las diferentes atracciones del parque, disfrutando de los jardines y observando a las aves que revoloteaban por todos lados. Luego, nos dirigimos a la zona de juegos, donde pasamos gran parte del tiempo. Fue especialmente divertido el día que jugamos al volante virtual, donde pudimos vivir la experiencia de conducir sin peligro. Finalmente, cenamos en uno de los restaurantes cercanos, degustando exquisita comida. Ese día no solo disfrutamos de la diversión, sino que también aprendimos sobre la importancia de cuidar nuestros cuerpos al realizar ejercicios en el parque. ### 在线游戏以提高发音 我会继续尝试这些游戏：- **Duolingo中的音素拼图**：从基础开始，反复练习直到熟悉每个单词的发音。记得多次听并模仿发音"
 
+
 def _split_text(text: str) -> list[str]:
     sents = re.split(r"([.?!])", text)  # capture sent delimiters
     result = []
@@ -24,44 +28,120 @@ def _split_text(text: str) -> list[str]:
     return result
 
 
+@lru_cache(maxsize=None)
+def _get_detector(languages: frozenset[Language]) -> LanguageDetector:
+    """
+    Build a detector once per language set (building loads the language models, so it is
+    slow)
+    """
+    return LanguageDetectorBuilder.from_languages(*languages).build()
+
+
+def _detect_lang_batch(
+    texts: list[list[str] | str],
+    languages_to_consider: list[Language] = LANGUAGES,
+) -> list[np.ndarray]:
+    """
+    Compute language confidences for every sentence of many texts with a single
+    (multi-threaded) lingua call
+
+    Args:
+        texts: Texts to detect language in (a text is either a string which is split
+            into sentences or a list of sentences)
+        languages_to_consider: Languages to consider in detection
+
+    Returns:
+        list[np.ndarray]: Per text, an array of shape (n_sentences, n_languages) with
+        the confidence of each language
+            in languages_to_consider (same column order)
+    """
+    if not texts:
+        return []
+
+    sents_per_text = [
+        text if isinstance(text, list) else _split_text(text) for text in texts
+    ]
+    all_sents = [sent for sents in sents_per_text for sent in sents]
+
+    detector = _get_detector(frozenset(languages_to_consider))
+    confidence_values = detector.compute_language_confidence_values_in_parallel(
+        all_sents
+    )
+
+    column = {language: i for i, language in enumerate(languages_to_consider)}
+    confidences = np.zeros((len(all_sents), len(languages_to_consider)))
+    for row, sent_values in enumerate(confidence_values):
+        for confidence in sent_values:
+            confidences[row, column[confidence.language]] = confidence.value
+
+    # split rows back into one array per text
+    offsets = np.cumsum([len(sents) for sents in sents_per_text])[:-1]
+    return np.split(confidences, offsets)
+
+
+def _exceeds_thresholds(
+    confidences: np.ndarray,
+    languages_to_consider: list[Language] = LANGUAGES,
+    language_thresholds: list[tuple[Language, float]] = LANGUAGE_THRESHOLDS,
+) -> bool:
+    """
+    Returns true if any sentence (row of confidences from _detect_lang_batch) meets any
+    language threshold
+    """
+    for language, threshold in language_thresholds:
+        if language in languages_to_consider and np.any(
+            confidences[:, languages_to_consider.index(language)] >= threshold
+        ):
+            print(
+                f"[INFO]: Text contains at least one sentence with {language.name} "
+                f"(confidence of {threshold})"
+            )
+            return True
+
+    return False
+
+
+def _drift_score(
+    confidences: np.ndarray,
+    languages_to_consider: list[Language] = LANGUAGES,
+    language_thresholds: list[tuple[Language, float]] = LANGUAGE_THRESHOLDS,
+) -> float:
+    """
+    Highest confidence of any thresholded language in any sentence (rows of confidences
+    from _detect_lang_batch), i.e., how close a text is to being rejected (lower is
+    better, 0.0 for a text without sentences)
+    """
+    columns = [
+        languages_to_consider.index(language)
+        for language, _ in language_thresholds
+        if language in languages_to_consider
+    ]
+    if len(confidences) == 0 or not columns:
+        return 0.0
+
+    return float(confidences[:, columns].max())
+
+
 def _detect_lang(
     text: list[str] | str,
     languages_to_consider: list[Language] = LANGUAGES,
-    language_thresholds: list[tuple[Language, float]] = [(Language.ENGLISH, 0.80), (Language.CHINESE, 0.80)],
+    language_thresholds: list[tuple[Language, float]] = LANGUAGE_THRESHOLDS,
 ) -> bool:
     """
     Returns true if any language threshold (specific language, confidence that X contains language) is met
-    
+
     Args:
         text: Text to detect language in
         languages_to_consider: Languages to consider in detection
         language_thresholds: List of (language, confidence) thresholds to check
-    
+
     Returns:
         bool: True if any language threshold is met, False otherwise
     """
-    if not isinstance(text, list):
-        sents = _split_text(text)
-    else:
-        sents = text
-
-    detector = LanguageDetectorBuilder.from_languages(*languages_to_consider).build()
-
-    for sent in sents:
-        confidence_values = detector.compute_language_confidence_values(sent)
-
-        for threshold in language_thresholds:
-            for confidence in confidence_values:
-                if (
-                    confidence.language == threshold[0]
-                    and confidence.value >= threshold[1]
-                ):
-                    print(
-                        f"[INFO]: Text contains at least one sentence with {threshold[0].name} (confidence of {threshold[1]})"
-                    )
-                    return True  # If any sentence meets any threshold, return True
-
-    return False  # If no sentences meet any threshold, return False
+    confidences = _detect_lang_batch([text], languages_to_consider)[0]
+
+    return _exceeds_thresholds(confidences, languages_to_consider, language_thresholds)
+
 
 if __name__ == "__main__":
     # Case 1: Text with both Spanish and English
@@ -3,21 +3,67 @@ Simulate two chat LLMs talking to each other
 """
 
 import argparse
-import json
+import asyncio
+import os
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Generator, Optional
 
 from tqdm import tqdm
 
-from interact_llm.data_models.chat import ChatHistory, ChatMessage
+from interact_llm.data_models.chat import ChatMessage, CompactChatHistory
 from interact_llm.data_models.prompt import SystemPrompt, load_prompt_by_id
-from interact_llm.llm.hf_wrapper import ChatHF
-from interact_llm.llm.mlx_wrapper import ChatMLX
+from interact_llm.llm.http_client import ChatHTTP
+from interact_llm.llm.telemetry import record_retries, telemetry_labels
+from interact_llm.utils.config_registry import CONFIG_REGISTRY
 from interact_llm.utils.model_load import load_model_backend
-from scripts.alignment_drift.detect_lang import _detect_lang
+from interact_llm.utils.transcript_store import (
+    ConversationKey,
+    TranscriptStore,
+    new_run_id,
+)
+from scripts.alignment_drift.detect_lang import (
+    _detect_lang,
+    _detect_lang_batch,
+    _drift_score,
+    _exceeds_thresholds,
+)
+
+# the local backends are imported by load_model_backend once one is selected
+if TYPE_CHECKING:
+    from interact_llm.llm.hf_gemma import ChatHFGemma
+    from interact_llm.llm.hf_wrapper import ChatHF
+    from interact_llm.llm.mlx_wrapper import ChatMLX
 
 DEFAULT_PROMPT_VERSION = 3.0
 
+N_RUNS = 30
+TRANSCRIPTS_DIR = Path(__file__).parents[4] / "simulated_data" / "transcripts"
+TELEMETRY_DIR = Path(__file__).parents[4] / "simulated_data" / "telemetry"
+
+SAMPLING_PARAMS = {
+    "temp": 1,
+    "top_p": 1.0,
+    "min_p": 0.05,
+    "top_k": 50,
+}
+PENALTY_PARAMS = {"repetition_penalty": 1.1}
+
+STUDENT_SYSTEM_PROMPT = SystemPrompt(
+    id="student",
+    content="You are a student learning Spanish, responding to a teacher who is facilitating a natural dialogue with you.",
+)
+
+
+def make_penalty_params(disallowed_scripts: Optional[list[str]] = None) -> dict:
+    """
+    PENALTY_PARAMS, optionally with tokens of disallowed scripts (e.g., CJK) masked
+    during generation
+    """
+    if not disallowed_scripts:
+        return PENALTY_PARAMS
+    return {**PENALTY_PARAMS, "disallowed_scripts": disallowed_scripts}
+
 
 def input_parse():
     parser = argparse.ArgumentParser()
@@ -42,169 +88,754 @@ def input_parse():
 
     parser.add_argument(
         "--backend",
-        help="whether to run a quantized model with MLX or a model with HF (transformers)",
+        help=(
+            "whether to run a quantized model with MLX or a model with HF "
+            "(transformers), or 'http' to use a model server (see --server_url)"
+        ),
         type=str,
         default="hf",
     )
 
+    parser.add_argument(
+        "--server_url",
+        help=(
+            "URL of the model server used with the http backend (see "
+            "interact_llm.serve)"
+        ),
+        type=str,
+        default="http://127.0.0.1:8000",
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        help=(
+            "number of conversations to simulate in lockstep (only supported for the "
+            "hf backend)"
+        ),
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        help=(
+            "number of conversations interleaved under one event loop (batch_size 1 "
+            "only), so language detection and transcript writes overlap with decoding"
+        ),
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--n_candidates",
+        help=(
+            "number of tutor responses sampled per attempt in one batched call, "
+            "keeping the best fully Spanish one (batch_size 1 only)"
+        ),
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--disallowed_scripts",
+        help=(
+            "scripts whose tokens are masked during generation, e.g., 'cjk' (see "
+            "interact_llm/llm/script_mask.py)"
+        ),
+        type=str,
+        nargs="+",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--quantization",
+        help=(
+            "CPU weight quantization of the hf model: int8, int4 or none (default: "
+            "quantization_hf in configs/models.toml, ignored on GPU)"
+        ),
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--placement",
+        help=(
+            "placement profile of the hf model in configs/models.toml, or none for "
+            "device_map='auto' (default: placement_hf of the model)"
+        ),
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--draft",
+        help=(
+            "use the draft model configured for speculative decoding (draft_hf in "
+            "configs/models.toml, batch_size 1 only)"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--offline",
+        help=(
+            "load the model from its downloaded snapshot in models/ without any "
+            "request to the HF Hub"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--telemetry",
+        help=(
+            "save per-call telemetry (tokens, prefill/decode time, time to first "
+            "token, peak memory, retries) to simulated_data/telemetry/ as JSONL and "
+            "Prometheus text"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile_calls",
+        help=(
+            "indices of generate calls to profile (0 is the first call), saved to "
+            "profiles/"
+        ),
+        type=int,
+        nargs="+",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profiler",
+        help="profiler for --profile_calls: cprofile or torch (hf backend only)",
+        type=str,
+        choices=["cprofile", "torch"],
+        default="cprofile",
+    )
+
     # save arguments to be parsed from the CLI
     args = parser.parse_args()
 
     return args
 
 
-def simulate_conversation(
-    model: ChatMLX | ChatHF, n_total_rounds: int = 9, tutor_system_prompt=SystemPrompt
-) -> ChatHistory:
+def select_candidate(candidates: list[ChatMessage]) -> Optional[ChatMessage]:
     """
-    Simulate an LLM conversation
+    Score candidate tutor responses with one batched language detection pass and return
+    the best compliant one (the non-empty candidate furthest from the language
+    thresholds), or None if no candidate is compliant
+    """
+    confidences = _detect_lang_batch([candidate.content for candidate in candidates])
 
-    Note that we are interested in the tutor only, but each has their own history in which they are the assistant, responding to a user.
+    compliant = [
+        (_drift_score(confidence), i)
+        for i, (candidate, confidence) in enumerate(zip(candidates, confidences))
+        if candidate.content.strip() and not _exceeds_thresholds(confidence)
+    ]
 
-    Args:
-        model: The chat model to use for the simulation.
-        n_total_rounds: The number of rounds of conversation to simulate.
-        tutor_system_prompt: The system prompt for the tutor LLM.
+    if not compliant:
+        return None
 
-    Returns:
-        tutor_history: The chat history of the tutor after the simulation.
-    """
+    return candidates[min(compliant)[1]]
+
+
+# a step of a conversation: (name of a model method or a blocking function, args,
+# kwargs), answered with its result
+Step = tuple[str | Callable, tuple, dict]
 
-    # define histories
-    student_history = ChatHistory(
-        messages=[
-            ChatMessage(
-                role="system",
-                content="You are a student learning Spanish, responding to a teacher who is facilitating a natural dialogue with you.",
-            )
-        ]
-    )
 
-    tutor_history = ChatHistory(
+def _conversation_steps(
+    n_total_rounds: int,
+    tutor_system_prompt: SystemPrompt,
+    sampling_params: Optional[dict],
+    penalty_params: Optional[dict],
+    on_message: Optional[Callable[[int, ChatMessage], None]],
+    max_new_tokens: int,
+    early_abort: bool,
+    n_candidates: int,
+    max_retries: int,
+    progress: bool = False,
+) -> Generator[Step, object, Optional[CompactChatHistory]]:
+    """
+    Turn logic of a simulated conversation, shared by simulate_conversation and
+    asimulate_conversation. Yields the calls to make (generate calls by method name,
+    language detection and on_message as functions), so that the sync and async
+    versions only differ in how they run them.
+    """
+    generate_kwargs = {
+        "max_new_tokens": max_new_tokens,
+        "sampling_params": sampling_params,
+        "penalty_params": penalty_params,
+    }
+    stop_on = _detect_lang if early_abort else None
+
+    # define histories (made from system prompts so that HF backends can share their KV
+    # state across runs, compact so that each turn only tokenizes the new messages)
+    student_history = CompactChatHistory.from_system_prompt(STUDENT_SYSTEM_PROMPT)
+
+    tutor_history = CompactChatHistory.from_system_prompt(
+        tutor_system_prompt,
         messages=[
-            ChatMessage(
-                role=tutor_system_prompt.role, content=tutor_system_prompt.content
-            ),
             ChatMessage(
                 role="user", content="Hola"
             ),  # pre-fixed what the tutor LLM receives in the first round
-        ]
+        ],
     )
 
-    for _ in tqdm(range(n_total_rounds)):
+    if on_message is not None:
+        for turn, message in enumerate(tutor_history.messages):
+            yield on_message, (turn, message), {}
+
+    rounds = range(n_total_rounds)
+    for _ in tqdm(rounds) if progress else rounds:
         # tutor in assistant role responds to user (first time to the pre-fixed "hola")
-        max_retries = 10
         tutor_message = None
 
         for attempt in range(max_retries):
-            tutor_message = model.generate(tutor_history)
-            if not _detect_lang(tutor_message.content):  # If no English is detected, proceed
+            if n_candidates > 1:
+                candidates = yield (
+                    "generate_candidates",
+                    (tutor_history, n_candidates),
+                    {**generate_kwargs, "stop_on": stop_on},
+                )
+                tutor_message = yield select_candidate, (candidates,), {}
+                if tutor_message is not None:
+                    break
+                print(
+                    f"[WARNING]: None of the {n_candidates} tutor candidates is fully "
+                    f"Spanish (attempt {attempt + 1}/{max_retries}). Regenerating..."
+                )
+                continue
+
+            tutor_message = yield (
+                "generate",
+                (tutor_history,),
+                {**generate_kwargs, "stop_on": stop_on},
+            )
+            # an aborted response ends with the offending sentence, so it fails the full
+            # check as well
+            # If no English is detected, proceed
+            if not (yield _detect_lang, (tutor_message.content,), {}):
                 break
-            print(f"[WARNING]: Tutor response contains English (attempt {attempt + 1}/{max_retries}). Regenerating...")
+            print(
+                "[WARNING]: Tutor response contains English (attempt "
+                f"{attempt + 1}/{max_retries}). Regenerating..."
+            )
 
-        else: 
-            print("[ERROR]: Tutor failed to generate a fully Spanish response after max retries. Returning None...")
-            return None 
+        else:
+            print(
+                "[ERROR]: Tutor failed to generate a fully Spanish response after max "
+                "retries. Returning None..."
+            )
+            return None
 
-        tutor_history.messages.append(tutor_message)
+        record_retries(tutor_message, attempt)
+        tutor_history.append(tutor_message)
+        if on_message is not None:
+            yield on_message, (len(tutor_history) - 1, tutor_message), {}
 
         # student receives tutor response as a user message
-        student_history.messages.append(
-            ChatMessage(role="user", content=tutor_message.content)
-        )
+        student_history.append(ChatMessage(role="user", content=tutor_message.content))
 
         # student in assistant role responds to user, append to teacher chat history
-        student_message = model.generate(student_history)
-        student_history.messages.append(student_message)
+        student_message = yield "generate", (student_history,), generate_kwargs
+        student_history.append(student_message)
 
         # tutor receives student response as a user message
-        tutor_history.messages.append(
-            ChatMessage(role="user", content=student_message.content)
-        )
+        student_turn = ChatMessage(role="user", content=student_message.content)
+        tutor_history.append(student_turn)
+        if on_message is not None:
+            yield on_message, (len(tutor_history) - 1, student_turn), {}
 
     return tutor_history
 
 
-def main():
-    args = input_parse()
+def simulate_conversation(
+    model: "ChatMLX | ChatHF | ChatHTTP",
+    n_total_rounds: int = 9,
+    tutor_system_prompt=SystemPrompt,
+    sampling_params: Optional[dict] = None,
+    penalty_params: Optional[dict] = None,
+    on_message: Optional[Callable[[int, ChatMessage], None]] = None,
+    max_new_tokens: int = 3000,
+    early_abort: bool = True,
+    n_candidates: int = 1,
+    max_retries: int = 10,
+) -> CompactChatHistory:
+    """
+    Simulate an LLM conversation
+
+    Note that we are interested in the tutor only, but each has their own history in
+    which they are the assistant, responding to a user.
+
+    Args:
+        model: The chat model to use for the simulation.
+        n_total_rounds: The number of rounds of conversation to simulate.
+        tutor_system_prompt: The system prompt for the tutor LLM.
+        sampling_params: Sampling params passed to every generate call (None uses the
+            model's defaults).
+        penalty_params: Penalty params passed to every generate call (None uses the
+            model's defaults).
+        on_message: Called with (turn, message) for every message added to the tutor
+            history, as it is added.
+        max_new_tokens: Max number of tokens per generated message.
+        early_abort: Whether to run language detection on every finished sentence while
+            the tutor response is generated and stop as soon as one sentence crosses the
+            thresholds (the response is then regenerated).
+        n_candidates: Number of tutor responses sampled per attempt in one batched call
+            (requires generate_candidates). The best compliant candidate is kept, so a
+            turn rarely needs more than one attempt.
+        max_retries: The max number of attempts at a fully Spanish tutor response per
+            round.
+
+    Returns:
+        tutor_history: The chat history of the tutor after the simulation.
+    """
+    steps = _conversation_steps(
+        n_total_rounds,
+        tutor_system_prompt,
+        sampling_params,
+        penalty_params,
+        on_message,
+        max_new_tokens,
+        early_abort,
+        n_candidates,
+        max_retries,
+        progress=True,
+    )
+
+    result = None
+    while True:
+        try:
+            fn, args, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+        if isinstance(fn, str):
+            fn = getattr(model, fn)
+        result = fn(*args, **kwargs)
+
+
+async def asimulate_conversation(
+    model: "ChatMLX | ChatHF | ChatHFGemma | ChatHTTP",
+    n_total_rounds: int = 9,
+    tutor_system_prompt=SystemPrompt,
+    sampling_params: Optional[dict] = None,
+    penalty_params: Optional[dict] = None,
+    on_message: Optional[Callable[[int, ChatMessage], None]] = None,
+    max_new_tokens: int = 3000,
+    early_abort: bool = True,
+    n_candidates: int = 1,
+    max_retries: int = 10,
+) -> Optional[CompactChatHistory]:
+    """
+    Async version of simulate_conversation (same args), so that several conversations
+    can be interleaved under one event loop: while one conversation runs language
+    detection or writes its transcript, another one is decoding.
+
+    Generation goes through the backend's agenerate methods, language detection and
+    on_message (e.g., appending to a transcript store) run in a worker thread.
+    """
+    steps = _conversation_steps(
+        n_total_rounds,
+        tutor_system_prompt,
+        sampling_params,
+        penalty_params,
+        on_message,
+        max_new_tokens,
+        early_abort,
+        n_candidates,
+        max_retries,
+    )
+
+    result = None
+    while True:
+        try:
+            fn, args, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+        if isinstance(fn, str):
+            result = await getattr(model, f"a{fn}")(*args, **kwargs)
+        else:
+            result = await asyncio.to_thread(fn, *args, **kwargs)
+
+
+async def asimulate_conversations(
+    model: "ChatMLX | ChatHF | ChatHFGemma | ChatHTTP",
+    n_conversations: int,
+    on_message: Optional[Callable[[int, int, ChatMessage], None]] = None,
+    labels: Optional[list[dict]] = None,
+    **kwargs,
+) -> list[Optional[CompactChatHistory]]:
+    """
+    Simulate several conversations concurrently under one event loop (kwargs are passed
+    to asimulate_conversation). on_message is called with (conversation index, turn,
+    message), and labels (one dict per conversation, e.g., its run id) are attached to
+    the telemetry records of its generate calls.
+    """
+
+    def conversation_callback(i: int) -> Optional[Callable[[int, ChatMessage], None]]:
+        if on_message is None:
+            return None
+        return lambda turn, message: on_message(i, turn, message)
+
+    tasks = []
+    for i in range(n_conversations):
+        # a task runs in a copy of the context it is created in
+        with telemetry_labels(**(labels[i] if labels else {})):
+            tasks.append(
+                asyncio.ensure_future(
+                    asimulate_conversation(
+                        model, on_message=conversation_callback(i), **kwargs
+                    )
+                )
+            )
+
+    return await asyncio.gather(*tasks)
+
+
+def simulate_conversations_batch(
+    model: "ChatHF | ChatHFGemma | ChatHTTP",
+    n_conversations: int,
+    n_total_rounds: int = 9,
+    tutor_system_prompt=SystemPrompt,
+    max_retries: int = 10,
+    sampling_params: Optional[dict] = None,
+    penalty_params: Optional[dict] = None,
+    on_message: Optional[Callable[[int, int, ChatMessage], None]] = None,
+    max_new_tokens: int = 3000,
+    early_abort: bool = True,
+) -> list[CompactChatHistory | None]:
+    """
+    Simulate several independent LLM conversations in lockstep, using one batched
+    generate call per role per round.
+
+    Conversations where the tutor fails to respond in Spanish within max_retries drop
+    out of the batch.
+
+    Args:
+        model: The chat model to use for the simulation (must implement generate_batch).
+        n_conversations: The number of conversations to simulate.
+        n_total_rounds: The number of rounds of conversation to simulate.
+        tutor_system_prompt: The system prompt for the tutor LLM.
+        max_retries: The max number of attempts at a fully Spanish tutor response per
+            round.
+        sampling_params: Sampling params passed to every generate call (None uses the
+            model's defaults).
+        penalty_params: Penalty params passed to every generate call (None uses the
+            model's defaults).
+        on_message: Called with (conversation index, turn, message) for every message
+            added to a tutor history, as it is added.
+        max_new_tokens: Max number of tokens per generated message.
+        early_abort: Whether to stop a tutor response as soon as one of its finished
+            sentences crosses the language thresholds (the other responses in the batch
+            continue).
+
+    Returns:
+        tutor_histories: The chat history of the tutor for each conversation (None if
+            rejected).
+    """
+    student_histories = [
+        CompactChatHistory.from_system_prompt(STUDENT_SYSTEM_PROMPT)
+        for _ in range(n_conversations)
+    ]
+    tutor_histories = [
+        CompactChatHistory.from_system_prompt(
+            tutor_system_prompt, messages=[ChatMessage(role="user", content="Hola")]
+        )
+        for _ in range(n_conversations)
+    ]
+    active = list(range(n_conversations))
+
+    def add_to_tutor_history(i: int, message: ChatMessage) -> None:
+        tutor_histories[i].append(message)
+        if on_message is not None:
+            on_message(i, len(tutor_histories[i]) - 1, message)
+
+    if on_message is not None:
+        for i, tutor_history in enumerate(tutor_histories):
+            for turn, message in enumerate(tutor_history.messages):
+                on_message(i, turn, message)
+
+    for _ in tqdm(range(n_total_rounds)):
+        # tutor turn: regenerate only the conversations whose response was rejected
+        pending = active
+        for attempt in range(max_retries):
+            tutor_messages = model.generate_batch(
+                [tutor_histories[i] for i in pending],
+                max_new_tokens=max_new_tokens,
+                sampling_params=sampling_params,
+                penalty_params=penalty_params,
+                stop_on=_detect_lang if early_abort else None,
+            )
+
+            # one language detection call for the whole batch
+            confidences = _detect_lang_batch(
+                [message.content for message in tutor_messages]
+            )
+
+            rejected = []
+            for i, tutor_message, confidence in zip(
+                pending, tutor_messages, confidences
+            ):
+                if _exceeds_thresholds(confidence):
+                    rejected.append(i)
+                    continue
+                record_retries(tutor_message, attempt)
+                add_to_tutor_history(i, tutor_message)
+                student_histories[i].append(
+                    ChatMessage(role="user", content=tutor_message.content)
+                )
+
+            if not rejected:
+                break
+
+            print(
+                f"[WARNING]: {len(rejected)} tutor response(s) contain English "
+                f"(attempt {attempt + 1}/{max_retries}). Regenerating..."
+            )
+            pending = rejected
+
+        else:
+            print(
+                f"[ERROR]: {len(pending)} conversation(s) failed to generate a fully "
+                "Spanish response after max retries. Dropping them..."
+            )
+            for i in pending:
+                tutor_histories[i] = None
+            active = [i for i in active if i not in pending]
+
+        if not active:
+            break
+
+        # student turn for every conversation still in the batch
+        student_messages = model.generate_batch(
+            [student_histories[i] for i in active],
+            max_new_tokens=max_new_tokens,
+            sampling_params=sampling_params,
+            penalty_params=penalty_params,
+        )
+        for i, student_message in zip(active, student_messages):
+            student_histories[i].append(student_message)
+            add_to_tutor_history(
+                i, ChatMessage(role="user", content=student_message.content)
+            )
+
+    return tutor_histories
+
+
+def run_simulations(
+    model: "ChatMLX | ChatHF | ChatHFGemma | ChatHTTP",
+    system_prompt: SystemPrompt,
+    store: TranscriptStore,
+    n_runs: int = N_RUNS,
+    batch_size: int = 1,
+    sampling_params: Optional[dict] = SAMPLING_PARAMS,
+    penalty_params: Optional[dict] = PENALTY_PARAMS,
+    n_candidates: int = 1,
+    concurrency: int = 1,
+) -> int:
+    """
+    Simulate n_runs conversations for a single prompt with an already loaded model.
+
+    Tutor messages are appended to the transcript store as they are produced, keyed by
+    (model_id, prompt_version, prompt_id, run_id), and each conversation is closed as
+    "complete" or "rejected".
+
+    Args:
+        model: The loaded chat model.
+        system_prompt: The system prompt for the tutor LLM.
+        store: The transcript store to append the tutor messages to.
+        n_runs: The number of conversations to simulate.
+        batch_size: The number of conversations to simulate in lockstep (requires
+            generate_batch).
+        sampling_params: Sampling params passed to every generate call.
+        penalty_params: Penalty params passed to every generate call.
+        n_candidates: Number of tutor candidates sampled per attempt (only used with
+            batch_size 1).
+        concurrency: The number of conversations interleaved under one event loop (only
+            used with batch_size 1).
+
+    Returns:
+        n_saved: The number of complete conversations (rejected runs are skipped).
+    """
+    n_saved = 0
+    step = batch_size if batch_size > 1 else concurrency
+
+    for n in range(0, n_runs, step):
+        n_batch = min(step, n_runs - n)
+        print(
+            f"[INFO]: Running simulation run(s) {n + 1}-{n + n_batch} out of {n_runs}"
+        )
 
-    n_runs = 30
+        keys = [
+            ConversationKey(
+                model.model_id, system_prompt.version, system_prompt.id, new_run_id()
+            )
+            for _ in range(n_batch)
+        ]
 
-    for n in range(n_runs):
-        print(f"[INFO]: Running simulation run {n + 1} out of {n_runs}")
+        # simulate (calls are labelled with the run id for telemetry, a batched call
+        # with the ids of all its runs)
+        with telemetry_labels(
+            run_id=keys[0].run_id if n_batch == 1 else [key.run_id for key in keys]
+        ):
+            if batch_size > 1:
+                tutor_histories = simulate_conversations_batch(
+                    model=model,
+                    n_conversations=n_batch,
+                    n_total_rounds=9,
+                    tutor_system_prompt=system_prompt,
+                    sampling_params=sampling_params,
+                    penalty_params=penalty_params,
+                    on_message=lambda i, turn, message: store.append(
+                        keys[i], turn, message
+                    ),
+                )
+            elif concurrency > 1:
+                tutor_histories = asyncio.run(
+                    asimulate_conversations(
+                        model=model,
+                        n_conversations=n_batch,
+                        on_message=lambda i, turn, message: store.append(
+                            keys[i], turn, message
+                        ),
+                        n_total_rounds=9,
+                        tutor_system_prompt=system_prompt,
+                        sampling_params=sampling_params,
+                        penalty_params=penalty_params,
+                        n_candidates=n_candidates,
+                        labels=[{"run_id": key.run_id} for key in keys],
+                    )
+                )
+            else:
+                tutor_histories = [
+                    simulate_conversation(
+                        model=model,
+                        n_total_rounds=9,
+                        tutor_system_prompt=system_prompt,
+                        sampling_params=sampling_params,
+                        penalty_params=penalty_params,
+                        on_message=lambda turn, message: store.append(
+                            keys[0], turn, message
+                        ),
+                        n_candidates=n_candidates,
+                    )
+                ]
+
+        for i, tutor_history in enumerate(tutor_histories):
+            if tutor_history is None:
+                store.end(keys[i], status="rejected")
+                print(f"[INFO]: Skipping run {n + i + 1}")
+                continue  # skip this run and continue to the next one
+
+            store.end(keys[i], status="complete")
+            n_saved += 1
+
+    return n_saved
 
-        # MODEL LOADING
-        sampling_params = {
-            "temp": 1,
-            "top_p": 1.0,
-            "min_p": 0.05,
-            "top_k": 50,
-        } 
-        penalty_params = {"repetition_penalty": 1.1}
 
-        cache_dir = Path(__file__).parents[4] / "models"
-        models_config_file = Path(__file__).parents[3] / "configs" / "models.toml"
+def main():
+    args = input_parse()
 
+    batch_size = args.batch_size if args.backend in {"hf", "http"} else 1
+
+    # fail on a broken config before the model is loaded
+    CONFIG_REGISTRY.validate()
+
+    # MODEL LOADING (once, the same model serves every run)
+    if args.offline:
+        # set before huggingface_hub is imported with a backend
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    cache_dir = Path(__file__).parents[4] / "models"
+    models_config_file = Path(__file__).parents[3] / "configs" / "models.toml"
+
+    if args.backend == "http":
+        # the model is loaded by the server, shared with other simulation workers (and
+        # batched across them)
+        model = ChatHTTP(base_url=args.server_url)
+        model.load()
+        print(f"[INFO]: Using model {model.model_id} served at {args.server_url}")
+    else:
         model = load_model_backend(
             models_config_path=models_config_file,
             model_name=args.model_name,
             backend=args.backend,
             token_path=Path(__file__).parents[3] / "tokens" / "hf_token.txt",
             cache_dir=cache_dir if args.backend == "hf" else None,
-            sampling_params=sampling_params,
-            penalty_params=penalty_params
+            # assisted decoding only supports a batch size of 1
+            use_draft=args.draft and batch_size == 1,
+            quantization=args.quantization,
+            placement=args.placement,
+            offline=args.offline,
         )
 
-        # PROMPT FORMATTING
-        prompt_version = args.prompt_version
-        prompt_id = args.prompt_id
-        prompt_file = (
-            Path(__file__).parents[3]
-            / "configs"
-            / "prompts"
-            / f"v{str(prompt_version)}.toml"
-        )
+    telemetry = getattr(model, "telemetry", None)  # local backends only
+    if telemetry is not None:
+        # calls are only recorded (and profiled) when asked for
+        telemetry.enabled = args.telemetry or bool(args.profile_calls)
+        if args.profile_calls:
+            telemetry.profile(args.profile_calls, profiler=args.profiler)
+
+    # PROMPT FORMATTING
+    prompt_version = args.prompt_version
+    prompt_id = args.prompt_id
+    prompt_file = (
+        Path(__file__).parents[3]
+        / "configs"
+        / "prompts"
+        / f"v{str(prompt_version)}.toml"
+    )
 
-        print(
-            f"[INFO]: Formatting prompts using toml file version {prompt_version} and prompt id {prompt_id}"
-        )
+    print(
+        f"[INFO]: Formatting prompts using toml file version {prompt_version} and prompt id {prompt_id}"
+    )
 
-        system_prompt = load_prompt_by_id(
-            toml_path=prompt_file, prompt_id=prompt_id, system_prompt=True
-        )
+    system_prompt = load_prompt_by_id(
+        toml_path=prompt_file, prompt_id=prompt_id, system_prompt=True
+    )
 
-        # simulate
-        tutor_history = simulate_conversation(
-            model=model, n_total_rounds=9, tutor_system_prompt=system_prompt
+    # one append-only transcript log per invocation
+    log_name = (
+        f"simulate-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{new_run_id()[:8]}.jsonl"
+    )
+    with TranscriptStore(TRANSCRIPTS_DIR / log_name) as store:
+        run_simulations(
+            model=model,
+            system_prompt=system_prompt,
+            store=store,
+            n_runs=N_RUNS,
+            batch_size=batch_size,
+            penalty_params=make_penalty_params(args.disallowed_scripts),
+            n_candidates=args.n_candidates,
+            concurrency=args.concurrency,
         )
 
-        if tutor_history is None:
-            print(f"[INFO]: Skipping run {n + 1}")
-            continue  # skip this run and continue to the next one
+    print(f"[INFO]: Transcripts saved to {TRANSCRIPTS_DIR / log_name}")
 
-        # save chat
-        chat_json = json.dumps(
-            [msg.model_dump() for msg in tutor_history.messages],
-            indent=3,
-            ensure_ascii=False,
+    if args.telemetry and telemetry is not None:
+        telemetry.write_jsonl(TELEMETRY_DIR / log_name)
+        (TELEMETRY_DIR / log_name).with_suffix(".prom").write_text(
+            telemetry.prometheus()
         )
-
-        save_dir = (
-            Path(__file__).parents[4]
-            / "simulated_data"
-            / model.model_id.replace("/", "--")
-            / f"v{str(prompt_version)}"
-            / prompt_id
+        print(f"[INFO]: Telemetry {telemetry.summary()}")
+        print(
+            f"[INFO]: Telemetry of {len(telemetry.records)} generate calls saved to "
+            f"{TELEMETRY_DIR / log_name}"
         )
 
-        save_dir.mkdir(exist_ok=True, parents=True)
+    if args.backend == "hf":
+        from interact_llm.llm.kv_cache import PROMPT_PREFIX_CACHE
+        from interact_llm.llm.prompt_artifacts import PROMPT_ARTIFACTS
 
-        save_file_name = datetime.now().strftime("%Y%m%d-%H%M%S")
-        with open(save_dir / f"{save_file_name}.json", "w") as outfile:
-            outfile.write(chat_json)
+        print(f"[INFO]: System prompt KV cache {PROMPT_PREFIX_CACHE.stats()}")
+        print(f"[INFO]: Prompt artifact cache {PROMPT_ARTIFACTS.stats()}")
+        if model.draft_model is not None:
+            from interact_llm.llm.speculative import log_draft_stats
 
-        # remove from mem 
-        del model
+            log_draft_stats(model.draft_stats)
 
 
 if __name__ == "__main__":
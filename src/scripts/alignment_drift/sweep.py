@@ -0,0 +1,458 @@
+"""
+Run simulate.py over a grid of models, prompt versions and prompt ids on a pool of
+worker processes
+
+Jobs are grouped by model so that each worker only loads a model once, and every
+finished cell (model, prompt version, prompt id) is checkpointed so that an interrupted
+sweep resumes where it left off. Within an unfinished cell, the runs closed in the
+transcript logs of earlier sweeps are kept, so only the missing runs are simulated.
+
+Checkpoints and transcript logs are tagged with a fingerprint of the settings that
+affect generation (backend, batch size, candidates, masked scripts, draft model,
+quantization and placement), so a sweep with other settings neither skips nor resumes
+from them.
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import product
+from pathlib import Path
+from typing import Optional
+
+from interact_llm.utils.config_registry import CONFIG_REGISTRY, prompt_file_name
+from interact_llm.utils.model_load import get_model_id
+
+CONFIGS_DIR = Path(__file__).parents[3] / "configs"
+CHECKPOINT_DIR = Path(__file__).parents[4] / "simulated_data" / ".sweep"
+TRANSCRIPTS_DIR = Path(__file__).parents[4] / "simulated_data" / "transcripts"
+
+# (model name, prompt version, prompt id, settings fingerprint)
+Cell = tuple[str, float, str, str]
+
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    # add arguments
+    parser.add_argument(
+        "--model_names",
+        help=(
+            "model names as specified in configs/models.toml (default: all models "
+            "with the chosen backend)"
+        ),
+        type=str,
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--prompt_ids",
+        help="ids of prompts in toml",
+        type=str,
+        nargs="+",
+        default=["A1", "B1", "C1"],
+    )
+    parser.add_argument(
+        "--prompt_versions",
+        help="versions of prompt toml files in configs/prompts/",
+        type=float,
+        nargs="+",
+        default=[3.0],
+    )
+    parser.add_argument(
+        "--backend",
+        help=(
+            "whether to run a quantized model with MLX or a model with HF "
+            "(transformers)"
+        ),
+        type=str,
+        default="hf",
+    )
+    parser.add_argument(
+        "--n_runs", help="number of conversations per cell", type=int, default=30
+    )
+    parser.add_argument(
+        "--batch_size",
+        help=(
+            "number of conversations to simulate in lockstep (only supported for the "
+            "hf backend)"
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--n_workers",
+        help="number of worker processes (one resident model each)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--n_candidates",
+        help=(
+            "number of tutor responses sampled per attempt in one batched call "
+            "(batch_size 1 only)"
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--disallowed_scripts",
+        help=(
+            "scripts whose tokens are masked during generation, e.g., 'cjk' (see "
+            "interact_llm/llm/script_mask.py)"
+        ),
+        type=str,
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--draft",
+        help=(
+            "use the draft model configured for speculative decoding (draft_hf in "
+            "configs/models.toml, batch_size 1 only)"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--devices",
+        help=(
+            "CUDA devices to assign to workers round-robin, e.g., '0 1' or '0,1 2,3' "
+            "(default: all visible to every worker)"
+        ),
+        type=str,
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--offline",
+        help=(
+            "load models from their downloaded snapshots in models/ without any "
+            "request to the HF Hub"
+        ),
+        action="store_true",
+    )
+
+    # save arguments to be parsed from the CLI
+    args = parser.parse_args()
+
+    return args
+
+
+def cell_settings(
+    model_name: str,
+    backend: str,
+    batch_size: int,
+    n_candidates: int,
+    disallowed_scripts: Optional[list[str]],
+    use_draft: bool,
+) -> dict:
+    """
+    The settings a cell of model_name is simulated with (as resolved by run_lane and
+    load_model_backend), including the model's quantization and placement from the
+    models config
+    """
+    model = CONFIG_REGISTRY.get_model(model_name, CONFIGS_DIR / "models.toml")
+    hf = backend == "hf"
+    batch_size = batch_size if hf else 1
+    # assisted decoding only supports a batch size of 1
+    draft = use_draft and hf and batch_size == 1 and model.get("draft_hf") is not None
+
+    return {
+        "backend": backend,
+        "batch_size": batch_size,
+        # candidates are only sampled with a batch size of 1
+        "n_candidates": n_candidates if batch_size == 1 else 1,
+        "disallowed_scripts": sorted(disallowed_scripts or []),
+        "draft": draft,
+        "quantization": model.get("quantization_hf") if hf else None,
+        "placement": model.get("placement_hf") if hf else None,
+    }
+
+
+def settings_fingerprint(settings: dict) -> str:
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def cell_name(
+    model_name: str, prompt_version: float, prompt_id: str, fingerprint: str
+) -> str:
+    model_dir_name = model_name.replace(":", "_").replace("/", "--")
+    return f"{model_dir_name}__v{prompt_version}__{prompt_id}__{fingerprint}"
+
+
+def is_done(cell: Cell, checkpoint_dir: Path = CHECKPOINT_DIR) -> bool:
+    return (checkpoint_dir / f"{cell_name(*cell)}.done").exists()
+
+
+def mark_done(cell: Cell, n_saved: int, checkpoint_dir: Path = CHECKPOINT_DIR) -> None:
+    """
+    Checkpoint a finished cell (one marker file per cell, so workers never write to the
+    same file)
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    (checkpoint_dir / f"{cell_name(*cell)}.done").write_text(f"{n_saved}\n")
+
+
+def write_settings(
+    fingerprint: str, settings: dict, checkpoint_dir: Path = CHECKPOINT_DIR
+) -> None:
+    """
+    Save the settings behind a fingerprint, so checkpoints and logs can be traced back
+    to them
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    (checkpoint_dir / f"settings-{fingerprint}.json").write_text(
+        json.dumps(settings, indent=2) + "\n"
+    )
+
+
+def log_path(log_prefix: Path, fingerprint: str) -> Path:
+    """
+    Transcript log of a worker for the cells with one settings fingerprint
+    """
+    return log_prefix.with_name(f"{log_prefix.name}-{fingerprint}.jsonl")
+
+
+def finished_runs(fingerprint: str, transcripts_dir: Path = TRANSCRIPTS_DIR) -> Counter:
+    """
+    Number of closed (complete or rejected) conversations per (model_id, prompt_version,
+    prompt_id) in the transcript logs of earlier sweeps with the same settings
+    fingerprint. Conversations without an end record were interrupted and are simulated
+    again.
+    """
+    from interact_llm.utils.transcript_store import conversation_statuses
+
+    counts = Counter()
+    for path in sorted(transcripts_dir.glob(f"sweep-*-{fingerprint}.jsonl")):
+        for key, status in conversation_statuses(path).items():
+            if status is not None:
+                counts[key.model_id, key.prompt_version, key.prompt_id] += 1
+
+    return counts
+
+
+def build_lanes(cells: list[Cell], n_workers: int) -> list[list[Cell]]:
+    """
+    Group cells by model and distribute the groups over n_workers lanes (largest groups
+    first, onto the least loaded lane). A lane runs its groups back to back, so each
+    model is loaded once.
+    """
+    groups: dict[str, list[Cell]] = {}
+    for cell in cells:
+        groups.setdefault(cell[0], []).append(cell)
+
+    lanes: list[list[Cell]] = [[] for _ in range(min(n_workers, len(groups)))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(lanes, key=len).extend(group)
+
+    return lanes
+
+
+def run_lane(
+    cells: list[Cell],
+    backend: str,
+    n_runs: int,
+    batch_size: int,
+    log_prefix: Path,
+    device: Optional[str] = None,
+    disallowed_scripts: Optional[list[str]] = None,
+    n_candidates: int = 1,
+    offline: bool = False,
+    use_draft: bool = False,
+) -> list[tuple[Cell, int]]:
+    """
+    Run the cells of a lane in a worker process, keeping one model resident at a time.
+    Transcripts are appended to the lane's own log per settings fingerprint (see
+    log_path), so workers never write to the same file.
+    """
+    if device is not None:
+        # set before torch is imported in this process
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    if offline:
+        # set before huggingface_hub is imported in this process
+        os.environ["HF_HUB_OFFLINE"] = "1"
+
+    # heavy imports in the worker only
+    from interact_llm.data_models.prompt import load_prompt_by_id
+    from interact_llm.llm.speculative import log_draft_stats
+    from interact_llm.utils.model_load import MODEL_REGISTRY, load_model_backend
+    from interact_llm.utils.transcript_store import TranscriptStore
+    from scripts.alignment_drift.simulate import make_penalty_params, run_simulations
+
+    results = []
+    model = None
+    loaded_model_name = None
+    store = None
+    # runs of each cell finished by earlier (interrupted) sweeps, per fingerprint
+    done_runs: dict[str, Counter] = {}
+
+    try:
+        for cell in cells:
+            model_name, prompt_version, prompt_id, fingerprint = cell
+
+            if model_name != loaded_model_name:
+                if getattr(model, "draft_model", None) is not None:
+                    log_draft_stats(model.draft_stats)
+
+                # free the previous model before loading the next one (the registry and
+                # this lane hold the only references to it)
+                MODEL_REGISTRY.clear()
+                model = None
+                gc.collect()
+
+                model = load_model_backend(
+                    models_config_path=CONFIGS_DIR / "models.toml",
+                    model_name=model_name,
+                    backend=backend,
+                    token_path=Path(__file__).parents[3] / "tokens" / "hf_token.txt",
+                    cache_dir=Path(__file__).parents[4] / "models"
+                    if backend == "hf"
+                    else None,
+                    # assisted decoding only supports a batch size of 1
+                    use_draft=use_draft and batch_size == 1,
+                    offline=offline,
+                )
+                loaded_model_name = model_name
+
+            if store is None or store.path != log_path(log_prefix, fingerprint):
+                if store is not None:
+                    store.close()
+                store = TranscriptStore(log_path(log_prefix, fingerprint))
+            if fingerprint not in done_runs:
+                done_runs[fingerprint] = finished_runs(fingerprint)
+
+            print(f"[INFO]: Running cell {cell_name(*cell)}")
+            system_prompt = load_prompt_by_id(
+                toml_path=CONFIGS_DIR / "prompts" / f"v{str(prompt_version)}.toml",
+                prompt_id=prompt_id,
+                system_prompt=True,
+            )
+
+            n_done = done_runs[fingerprint][
+                model.model_id, system_prompt.version, system_prompt.id
+            ]
+            if n_done > 0:
+                print(f"[INFO]: Resuming after {n_done} of {n_runs} finished runs")
+
+            n_saved = run_simulations(
+                model=model,
+                system_prompt=system_prompt,
+                store=store,
+                n_runs=max(n_runs - n_done, 0),
+                batch_size=batch_size if backend == "hf" else 1,
+                penalty_params=make_penalty_params(disallowed_scripts),
+                n_candidates=n_candidates,
+            )
+
+            mark_done(cell, n_saved)
+            results.append((cell, n_saved))
+    finally:
+        if store is not None:
+            store.close()
+
+    if getattr(model, "draft_model", None) is not None:
+        log_draft_stats(model.draft_stats)
+
+    return results
+
+
+def main():
+    args = input_parse()
+
+    # parse and validate every config (and the grid) before any worker starts, rather
+    # than failing mid-sweep
+    CONFIG_REGISTRY.validate()
+
+    if args.model_names is None:
+        models = CONFIG_REGISTRY.models(CONFIGS_DIR / "models.toml")
+        args.model_names = [
+            name
+            for name, model in models.items()
+            if model.get(args.backend) is not None
+        ]
+
+    for model_name in args.model_names:
+        get_model_id(CONFIGS_DIR / "models.toml", model_name, backend=args.backend)
+
+    for prompt_version, prompt_id in product(args.prompt_versions, args.prompt_ids):
+        if CONFIG_REGISTRY.get_prompt(prompt_version, prompt_id) is None:
+            raise ValueError(
+                f"No prompt with id '{prompt_id}' in "
+                f"configs/prompts/{prompt_file_name(prompt_version)}"
+            )
+
+    # settings fingerprint per model (its quantization and placement are part of it)
+    fingerprints = {}
+    for model_name in args.model_names:
+        settings = cell_settings(
+            model_name,
+            args.backend,
+            args.batch_size,
+            args.n_candidates,
+            args.disallowed_scripts,
+            args.draft,
+        )
+        fingerprints[model_name] = settings_fingerprint(settings)
+        write_settings(fingerprints[model_name], settings)
+        print(
+            f"[INFO]: Settings of {model_name} ({fingerprints[model_name]}): {settings}"
+        )
+
+    cells = [
+        (model_name, prompt_version, prompt_id, fingerprints[model_name])
+        for model_name, prompt_version, prompt_id in product(
+            args.model_names, args.prompt_versions, args.prompt_ids
+        )
+    ]
+    todo = [cell for cell in cells if not is_done(cell)]
+
+    print(
+        f"[INFO]: {len(cells) - len(todo)} of {len(cells)} cells already done "
+        f"(checkpoints in {CHECKPOINT_DIR})"
+    )
+
+    if not todo:
+        return
+
+    lanes = build_lanes(todo, args.n_workers)
+
+    # one transcript log per sweep invocation, worker and settings fingerprint
+    sweep_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    # spawn (not fork) so that every worker initialises CUDA on its own
+    with ProcessPoolExecutor(
+        max_workers=len(lanes), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_lane,
+                lane,
+                args.backend,
+                args.n_runs,
+                args.batch_size,
+                TRANSCRIPTS_DIR / f"sweep-{sweep_id}-worker{i}",
+                args.devices[i % len(args.devices)] if args.devices else None,
+                args.disallowed_scripts,
+                args.n_candidates,
+                args.offline,
+                args.draft,
+            )
+            for i, lane in enumerate(lanes)
+        ]
+
+        for future in as_completed(futures):
+            for cell, n_saved in future.result():
+                print(
+                    f"[INFO]: Finished cell {cell_name(*cell)} ({n_saved} "
+                    "conversations saved)"
+                )
+
+
+if __name__ == "__main__":
+    main()